@@ -0,0 +1,182 @@
+"""
+Content addressed storage for binary data such as images
+"""
+import hashlib
+import os
+import tempfile
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
+from importlib import import_module
+
+from fastapi.concurrency import run_in_threadpool
+
+from .config import settings
+
+
+class BlobStore:
+    """Base class for blob storage backends
+
+    Blobs are addressed by the hex SHA-256 digest of their content, so the
+    same image uploaded twice is stored once.
+    """
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data: bytes) -> str:
+        """Store data and return its key"""
+        raise NotImplementedError
+
+    def put_stream(self, chunks: Iterable[bytes]) -> str:
+        """Store data arriving in chunks and return its key
+
+        Backends should override it to avoid holding the whole blob in
+        memory.
+        """
+        return self.put(b''.join(chunks))
+
+    def iter_chunks(self, key: str,
+                    chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """Iterate over the content of a blob"""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def read(self, key: str) -> bytes:
+        return b''.join(self.iter_chunks(key))
+
+
+class LocalBlobStore(BlobStore):
+    """Stores blobs as files in a local directory"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data: bytes) -> str:
+        key = self.key_for(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so readers never see partial blobs
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return key
+
+    def put_stream(self, chunks: Iterable[bytes]) -> str:
+        # The key is only known at the end, so the blob is written to the
+        # root first and moved to its directory afterwards
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    fout.write(chunk)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        key = digest.hexdigest()
+        path = self._path(key)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return key
+
+    def iter_chunks(self, key: str,
+                    chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        with open(self._path(key), 'rb') as fin:
+            while chunk := fin.read(chunk_size):
+                yield chunk
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+BACKENDS = {
+    'local': LocalBlobStore,
+}
+
+
+@lru_cache
+def get_blob_store() -> BlobStore:
+    """Instantiate the blob store configured in the settings
+
+    ``blob_store_backend`` is either one of the names in :data:`BACKENDS` or
+    the dotted path of a :class:`BlobStore` subclass. The backend is built
+    with ``blob_store_path`` as its only argument.
+    """
+    backend = BACKENDS.get(settings.blob_store_backend)
+
+    if backend is None:
+        module_name, _, name = settings.blob_store_backend.rpartition('.')
+        backend = getattr(import_module(module_name), name)
+
+    return backend(settings.blob_store_path)
+
+
+def read_blob(key: str | None) -> bytes | None:
+    """Read a blob from the configured store, if there is one"""
+    if key is None:
+        return None
+    return get_blob_store().read(key)
+
+
+class BlobLoader:
+    """Blobs to embed in a response, read together in the threadpool
+
+    Blob stores read files or call remote services, which would block the
+    event loop. Responses are built with :meth:`embed` marking the fields
+    that take a blob, then :meth:`load` reads them and fills the fields in.
+    """
+
+    def __init__(self):
+        self._pending = []
+
+    def embed(self, target, field: str, key: str | None):
+        """Fill ``field`` of ``target`` with the blob ``key`` on load"""
+        if key is not None:
+            self._pending.append((target, field, key))
+        return target
+
+    async def load(self):
+        """Read the blobs, each once, and fill in the fields"""
+        keys = {key for _, _, key in self._pending}
+        if not keys:
+            return
+
+        blobs = await run_in_threadpool(
+            lambda: {key: read_blob(key) for key in keys}
+        )
+        for target, field, key in self._pending:
+            setattr(target, field, blobs[key])
+        self._pending.clear()
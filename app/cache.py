@@ -0,0 +1,430 @@
+"""
+Response cache for the read routes
+
+Read routes opt in with the :func:`cache_response` dependency, which tags
+their responses with the entities they are built from, e.g. ``rule:<id>``.
+:class:`ResponseCacheMiddleware` serves and stores those responses, keyed by
+path and normalized query string, and the write routes call
+:func:`invalidate` with the tags they affected once their commit succeeded.
+
+Routes that set an ``ETag`` header answer conditional requests with
+:func:`not_modified`, and cached responses keep their ``ETag`` so the
+middleware does the same for cache hits.
+
+With read replicas, a replica may answer a read with rows a write just
+replaced. Such responses are not stored while any of their tags was
+invalidated less than ``db_primary_pin_seconds`` ago, and the requests of
+clients pinned to the primary after a write skip the cache altogether.
+"""
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from importlib import import_module
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi import Depends, Request, Response
+
+from .config import settings
+from .db.session import PRIMARY_PIN_COOKIE
+from .metrics import RESPONSE_CACHE_LOOKUPS
+
+
+# Reads that took longer than this are not cached, so invalidations only
+# need to be remembered for this long to catch the reads they raced with
+RACE_WINDOW = 30
+
+
+class CacheBackend:
+    """Base class for response cache backends
+
+    Lookups return a token along with the value. Storing a value fetched
+    before an invalidation of one of its tags must be a no-op, so a read that
+    raced with a write can't put stale data back in the cache. So must
+    storing a value one of whose tags was invalidated less than ``settle``
+    seconds ago, which is at most :data:`RACE_WINDOW`.
+    """
+
+    async def get(self, key: str) -> tuple[bytes | None, object]:
+        raise NotImplementedError
+
+    async def store(self, key: str, value: bytes, tags: set[str],
+                    ttl: float, token: object, settle: float = 0):
+        raise NotImplementedError
+
+    async def invalidate(self, tags: set[str]):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """Caches nothing"""
+
+    async def get(self, key):
+        return None, None
+
+    async def store(self, key, value, tags, ttl, token, settle=0):
+        pass
+
+    async def invalidate(self, tags):
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU cache with per-entry expiry
+
+    Each worker has its own cache, so with several workers an invalidation
+    only reaches the worker that handled the write. Use a shared backend
+    there.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # key -> (expires_at, value, tags), least recently used first
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        # Bumped by every invalidation. Tags remember the epoch and time of
+        # their last invalidation, oldest first.
+        self._epoch = 0
+        self._tag_epochs = OrderedDict()
+
+    def _drop(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, self._epoch
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None, self._epoch
+        self._entries.move_to_end(key)
+        return entry[1], self._epoch
+
+    async def store(self, key, value, tags, ttl, token, settle=0):
+        now = time.monotonic()
+        for tag in tags:
+            epoch, when = self._tag_epochs.get(tag, (-1, None))
+            if epoch >= token or (when is not None and now - when < settle):
+                return
+
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (now + ttl, value, tags)
+        for tag in tags:
+            self._keys_by_tag.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    async def invalidate(self, tags):
+        now = time.monotonic()
+        for tag in tags:
+            self._tag_epochs.pop(tag, None)
+            self._tag_epochs[tag] = (self._epoch, now)
+            for key in list(self._keys_by_tag.get(tag, ())):
+                self._drop(key)
+        self._epoch += 1
+
+        while self._tag_epochs:
+            _, (_, when) = next(iter(self._tag_epochs.items()))
+            if now - when < RACE_WINDOW:
+                break
+            self._tag_epochs.popitem(last=False)
+
+
+# Seconds since the epoch, on the Redis server clock
+_NOW = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+"""
+
+# KEYS: entry, then the key set and the last invalidation of each tag
+# ARGV: value, ttl, token, settle
+_SET_SCRIPT = _NOW + """
+for i = 3, #KEYS, 2 do
+    local last = redis.call('GET', KEYS[i])
+    if last then
+        local epoch, at = string.match(last, '^(%d+) ?(.*)$')
+        if tonumber(epoch) >= tonumber(ARGV[3]) then
+            return 0
+        end
+        at = tonumber(at)
+        if at and now - at < tonumber(ARGV[4]) then
+            return 0
+        end
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+for i = 2, #KEYS, 2 do
+    redis.call('SADD', KEYS[i], KEYS[1])
+    if redis.call('TTL', KEYS[i]) < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    end
+end
+return 1
+"""
+
+# KEYS: global epoch, then the key set and the last invalidation of each
+# tag, which holds its epoch and time
+# ARGV: race window
+_INVALIDATE_SCRIPT = _NOW + """
+local epoch = redis.call('INCR', KEYS[1]) - 1
+local last = string.format('%d %.6f', epoch, now)
+for i = 2, #KEYS, 2 do
+    local entries = redis.call('SMEMBERS', KEYS[i])
+    for _, entry in ipairs(entries) do
+        redis.call('DEL', entry)
+    end
+    redis.call('DEL', KEYS[i])
+    redis.call('SET', KEYS[i + 1], last, 'EX', ARGV[1])
+end
+"""
+
+
+class RedisCache(CacheBackend):
+    """Cache shared by every worker, kept in Redis
+
+    Redis should be configured with an LRU ``maxmemory-policy`` to bound its
+    size.
+    """
+
+    PREFIX = 'agg:cache:'
+
+    def __init__(self, url: str):
+        from redis.asyncio import Redis
+
+        self.redis = Redis.from_url(url)
+        self._set = self.redis.register_script(_SET_SCRIPT)
+        self._invalidate = self.redis.register_script(_INVALIDATE_SCRIPT)
+
+    def _tag_keys(self, tags):
+        keys = []
+        for tag in sorted(tags):
+            keys.append(f'{self.PREFIX}tag:{tag}')
+            keys.append(f'{self.PREFIX}tag_epoch:{tag}')
+        return keys
+
+    async def get(self, key):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.PREFIX + key)
+            pipe.get(self.PREFIX + 'epoch')
+            value, epoch = await pipe.execute()
+        return value, int(epoch or 0)
+
+    async def store(self, key, value, tags, ttl, token, settle=0):
+        await self._set(
+            keys=[self.PREFIX + key, *self._tag_keys(tags)],
+            args=[value, max(1, round(ttl)), token, settle],
+        )
+
+    async def invalidate(self, tags):
+        if tags:
+            await self._invalidate(
+                keys=[self.PREFIX + 'epoch', *self._tag_keys(tags)],
+                args=[RACE_WINDOW],
+            )
+
+
+BACKENDS = {
+    'none': lambda: NullCache(),
+    'memory': lambda: MemoryCache(settings.cache_max_entries),
+    'redis': lambda: RedisCache(settings.cache_url),
+}
+
+
+@lru_cache
+def get_cache() -> CacheBackend:
+    """Instantiate the cache backend configured in the settings
+
+    ``cache_backend`` is either one of the names in :data:`BACKENDS` or the
+    dotted path of a :class:`CacheBackend` subclass, which is built with
+    ``cache_url`` as its only argument.
+    """
+    factory = BACKENDS.get(settings.cache_backend)
+
+    if factory is None:
+        module_name, _, name = settings.cache_backend.rpartition('.')
+        backend = getattr(import_module(module_name), name)
+        return backend(settings.cache_url)
+
+    return factory()
+
+
+async def invalidate(*tags: str):
+    """Drop the cached responses built from any of the given entities
+
+    Call it after the commit of the write, never before: a read in between
+    would cache the old rows again.
+    """
+    await get_cache().invalidate(set(tags))
+
+
+def tag_response(request: Request, *tags: str):
+    """Tag the response of a cached route with entities it only finds out
+    about while it is built, e.g. the rule of a tape"""
+    request.state.cache_tags.update(tags)
+
+
+def profile_tag(address: str) -> str:
+    """Tag of the responses built from a profile"""
+    return f'profile:{address.lower()}'
+
+
+def etag_for(*versions) -> str:
+    """Strong ETag of a representation built from the given versions"""
+    return '"' + '-'.join(str(x) for x in versions) + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an ``If-None-Match`` header lists the given ETag"""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored
+    return any(
+        tag.strip().removeprefix('W/') == etag
+        for tag in if_none_match.split(',')
+    )
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """The ``304 Not Modified`` response, if the client has this ETag"""
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'etag': etag})
+
+
+def cache_response(*tags: str, ttl: float | None = None):
+    """Dependency marking the response of a route as cacheable
+
+    Parameters
+    ----------
+    tags : str
+        Entities the response is built from. They are formatted with the
+        path parameters of the request, e.g. ``'rule:{rule_id}'``.
+    ttl : float, optional
+        Seconds to keep the response, by default ``cache_ttl``
+    """
+    def dependency(request: Request):
+        params = {
+            # Addresses are stored in lower case whatever the path says
+            name: value.lower() if name == 'address' else value
+            for name, value in request.path_params.items()
+        }
+        request.state.cache_tags = {tag.format(**params) for tag in tags}
+        request.state.cache_ttl = ttl or settings.cache_ttl
+
+    return Depends(dependency)
+
+
+def _cache_key(scope) -> str:
+    query = parse_qsl(scope['query_string'].decode('latin-1'),
+                      keep_blank_values=True)
+    return f'{scope["path"]}?{urlencode(sorted(query))}'
+
+
+def _pack(content_type: bytes, etag: bytes, body: bytes) -> bytes:
+    return content_type + b'\n' + etag + b'\n' + body
+
+
+def _unpack(value: bytes) -> tuple[bytes, bytes, bytes]:
+    content_type, _, rest = value.partition(b'\n')
+    etag, _, body = rest.partition(b'\n')
+    return content_type, etag, body
+
+
+class ResponseCacheMiddleware:
+    """Serve the GET routes that opted in with :func:`cache_response`"""
+
+    def __init__(self, app, prefix: str = '/agg/'):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' \
+                or not scope['path'].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+
+        cache = get_cache()
+        key = _cache_key(scope)
+        value, token = await cache.get(key)
+
+        # Clients that just wrote must read their writes, which a response
+        # cached from a lagging replica may not show
+        if PRIMARY_PIN_COOKIE in Request(scope).cookies:
+            value = None
+
+        if value is not None:
+            RESPONSE_CACHE_LOOKUPS.labels('hit').inc()
+            await self._send_cached(scope, send, value)
+            return
+
+        started_at = time.monotonic()
+        start = None
+        chunks = []
+
+        def cacheable():
+            return start is not None and start['status'] == 200 \
+                and 'cache_tags' in scope.get('state', {})
+
+        async def capture(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+            # Other responses may be endless streams, don't hold on to them
+            elif message['type'] == 'http.response.body' and cacheable():
+                chunks.append(message.get('body', b''))
+            await send(message)
+
+        await self.app(scope, receive, capture)
+
+        if not cacheable():
+            return
+        state = scope['state']
+        tags = state['cache_tags']
+        if time.monotonic() - started_at > RACE_WINDOW:
+            return
+
+        RESPONSE_CACHE_LOOKUPS.labels('miss').inc()
+        headers = dict(start['headers'])
+        value = _pack(
+            headers.get(b'content-type', b''),
+            headers.get(b'etag', b''),
+            b''.join(chunks),
+        )
+        settle = 0
+        if state.get('replica_read'):
+            settle = min(settings.db_primary_pin_seconds, RACE_WINDOW)
+        # The client already has the whole response at this point
+        await cache.store(key, value, tags, state['cache_ttl'], token,
+                          settle)
+
+    async def _send_cached(self, scope, send, value: bytes):
+        content_type, etag, body = _unpack(value)
+        headers = [(b'content-type', content_type)]
+        status = 200
+
+        if etag:
+            headers.append((b'etag', etag))
+            if_none_match = dict(scope['headers']).get(b'if-none-match')
+            if if_none_match is not None and etag_matches(
+                if_none_match.decode('latin-1'), etag.decode('latin-1')
+            ):
+                status = 304
+                headers = [(b'etag', etag)]
+                body = b''
+
+        if status == 200:
+            headers.append((b'content-length', str(len(body)).encode()))
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({'type': 'http.response.body', 'body': body})
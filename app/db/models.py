@@ -1,9 +1,16 @@
 import datetime
+from typing import Annotated, TypeVar
 
-from sqlmodel import Field, LargeBinary, SQLModel, Relationship
+from pydantic import AfterValidator
+from sqlalchemy import BigInteger, desc, text
+from sqlmodel import Field, Index, SQLModel, Relationship
 
 
 class CollectedTapes(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_collectedtapes_profile_address', 'profile_address'),
+    )
+
     tape_id: str | None = Field(
         default=None,
         foreign_key='tape.id',
@@ -15,7 +22,7 @@ class CollectedTapes(SQLModel, table=True):
         primary_key=True
     )
     contract_address: str | None = Field(default=None, primary_key=True)
-    asset_id: str | None
+    asset_id: str | None = None
     ballance: int = 0
 
     profile: "Profile" = Relationship(back_populates='collected_tapes')
@@ -23,6 +30,14 @@ class CollectedTapes(SQLModel, table=True):
 
 
 class Tape(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_tape_creator_address', 'creator_address'),
+        Index(
+            'ix_tape_rule_id_score',
+            'rule_id', desc('score'), 'created_at', 'id',
+        ),
+    )
+
     id: str = Field(default=None, primary_key=True)
 
     name: str | None = None
@@ -43,6 +58,8 @@ class Tape(SQLModel, table=True):
 
     rule_id: str | None = Field(default=None, foreign_key='rule.id')
     rule: "Rule" = Relationship(back_populates='tapes')
+    # Dense rank by score within the rule, see app.db.tape_ranks
+    rank: int | None = None
 
     tape: str | None = None
     incard: str | None = None
@@ -53,12 +70,19 @@ class Tape(SQLModel, table=True):
         back_populates='tape'
     )
 
+    # Bumped on every update, see app.db.session.create_or_update
+    version: int = 1
+
     console_achievements: list["AwardedConsoleAchievement"] = Relationship(
         back_populates='tape'
     )
 
 
 class CollectedCartridges(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_collectedcartridges_profile_address', 'profile_address'),
+    )
+
     cartridge_id: str | None = Field(
         default=None,
         foreign_key='cartridge.id',
@@ -78,6 +102,10 @@ class CollectedCartridges(SQLModel, table=True):
 
 
 class Cartridge(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_cartridge_creator_address', 'creator_address'),
+    )
+
     id: str = Field(default=None, primary_key=True)
 
     name: str | None = None
@@ -99,6 +127,8 @@ class Cartridge(SQLModel, table=True):
     )
     rules: list["Rule"] = Relationship(back_populates='cartridge')
 
+    version: int = 1
+
 
 class Profile(SQLModel, table=True):
     address: str = Field(default=None, primary_key=True)
@@ -127,6 +157,41 @@ class Profile(SQLModel, table=True):
     )
 
 
+class ProfileStats(SQLModel, table=True):
+    """Per-profile counters kept up to date by the write routes"""
+    __table_args__ = (
+        Index('ix_profilestats_rives_points', 'rives_points', 'address'),
+        Index('ix_profilestats_portfolio_value', 'portfolio_value',
+              'address'),
+    )
+
+    address: str = Field(
+        default=None,
+        foreign_key='profile.address',
+        primary_key=True,
+    )
+
+    n_tapes_collected: int = 0
+    n_cartridges_collected: int = 0
+    n_tapes_created: int = 0
+    n_cartridges_created: int = 0
+    n_console_achievements: int = 0
+    rives_points: int = 0
+    # Sum of balance times sell value of the collected tapes and cartridges
+    portfolio_value: int = Field(default=0, sa_type=BigInteger)
+
+    version: int = 1
+
+
+class PointsHistogram(SQLModel, table=True):
+    """Number of profiles with each nonzero total of rives points"""
+    rives_points: int = Field(
+        primary_key=True,
+        sa_column_kwargs={'autoincrement': False},
+    )
+    n_profiles: int = 0
+
+
 class RuleConsoleAchievement(SQLModel, table=True):
     rule_id: str | None = Field(
         default=None,
@@ -156,7 +221,7 @@ class Rule(SQLModel, table=True):
     created_by: str | None = None
 
     sponsor_name: str | None = None
-    sponsor_image_data: bytes | None = Field(default=None, sa_type=LargeBinary)
+    sponsor_image_hash: str | None = None
     sponsor_image_type: str | None = None
 
     prize: str | None = None
@@ -168,8 +233,21 @@ class Rule(SQLModel, table=True):
         link_model=RuleConsoleAchievement,
     )
 
+    version: int = 1
+
 
 class AwardedConsoleAchievement(SQLModel, table=True):
+    __table_args__ = (
+        Index(
+            'ix_awardedconsoleachievement_profile_address_created_at',
+            'profile_address', 'created_at', 'id',
+        ),
+        Index(
+            'ix_awardedconsoleachievement_ca_slug_created_at',
+            'ca_slug', 'created_at', 'id',
+        ),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
 
     profile_address: str | None = Field(
@@ -203,7 +281,7 @@ class ConsoleAchievement(SQLModel, table=True):
 
     points: int = 0
 
-    image_data: bytes | None = Field(sa_type=LargeBinary)
+    image_hash: str | None = None
     image_type: str | None = None
 
     awarded: list[AwardedConsoleAchievement] = Relationship(
@@ -215,8 +293,36 @@ class ConsoleAchievement(SQLModel, table=True):
         link_model=RuleConsoleAchievement,
     )
 
+    version: int = 1
+
+
+class ImageRendition(SQLModel, table=True):
+    """Pre-sized variant of an uploaded image, see app.images"""
+    source_hash: str = Field(primary_key=True)
+    size: str = Field(primary_key=True)
+    mime_type: str = Field(primary_key=True)
+
+    width: int
+    height: int
+    blob_hash: str
+
 
 class Notification(SQLModel, table=True):
+    __table_args__ = (
+        Index(
+            'ix_notification_profile_address_created_at',
+            'profile_address', 'created_at', 'id',
+        ),
+        # Only unread notifications are indexed, so counting them doesn't
+        # grow with the history of the profile
+        Index(
+            'ix_notification_profile_address_unread',
+            'profile_address',
+            postgresql_where=text('unread'),
+            sqlite_where=text('unread'),
+        ),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
 
     created_at: datetime.datetime | None = None
@@ -230,3 +336,18 @@ class Notification(SQLModel, table=True):
         foreign_key='profile.address',
     )
     profile: Profile = Relationship(back_populates='notifications')
+
+
+def _validate(instance: SQLModel) -> SQLModel:
+    # Only the fields that were sent, so partial updates stay partial
+    return type(instance).model_validate(
+        {name: getattr(instance, name) for name in instance.model_fields_set}
+    )
+
+
+T = TypeVar('T', bound=SQLModel)
+
+# Table models skip validation when FastAPI builds them from a request body,
+# e.g. a date would reach the database as a string. Annotate request bodies
+# with this to validate them as ``model_validate`` does.
+Validated = Annotated[T, AfterValidator(_validate)]
@@ -0,0 +1,195 @@
+"""
+Pagination on either kind of session returned by ``get_read_session``
+"""
+import base64
+import datetime
+import json
+from typing import Generic, TypeVar
+
+from fastapi import HTTPException, Query
+from fastapi_pagination.ext.sqlmodel import paginate as _paginate
+from pydantic import BaseModel
+from sqlalchemy import DateTime, and_, false, or_, tuple_
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+T = TypeVar('T')
+
+
+async def paginate(session, query, **kwargs):
+    """Paginate a query, running the sync paginator through ``run_sync``"""
+    return await session.run_sync(_paginate, query, **kwargs)
+
+
+class CursorPage(BaseModel, Generic[T]):
+    items: list[T]
+    size: int
+    next_cursor: str | None = None
+
+
+class CursorParams(BaseModel):
+    cursor: str | None = Query(
+        None,
+        description=(
+            'Opaque token from the `next_cursor` of the previous page. Leave '
+            'empty to get the first page.'
+        ),
+    )
+    size: int = Query(50, ge=1, le=100, description='Page size')
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    if value is not None and isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def encode_cursor(keys, values) -> str:
+    # The names of the keys come along, so a cursor is never applied to
+    # another ordering, e.g. another sort_by
+    data = json.dumps({
+        'keys': [key.key for key in keys],
+        'values': [_encode_value(x) for x in values],
+    })
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str, keys) -> list:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor))
+        if data['keys'] != [key.key for key in keys]:
+            raise ValueError('Cursor of another ordering')
+        values = data['values']
+        if len(values) != len(keys):
+            raise ValueError('Wrong number of values')
+        return [_decode_value(key, value) for key, value in zip(keys, values)]
+    except (TypeError, ValueError, KeyError):
+        raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+
+def _key_values(item, keys):
+    return [getattr(item, key.key) for key in keys]
+
+
+def _parse_key(key):
+    """Split a key into its column and whether it is sorted descending"""
+    if isinstance(key, UnaryExpression):
+        if key.modifier is operators.asc_op:
+            return key.element, False
+        if key.modifier is operators.desc_op:
+            return key.element, True
+    return key, True
+
+
+def _nullable(column) -> bool:
+    return getattr(getattr(column, 'expression', column), 'nullable', True)
+
+
+def _order_by(column, descending: bool):
+    # NULLs sort above every value, the Postgres default, which plain
+    # indexes serve in both directions. SQLite needs it spelled out.
+    if descending:
+        return column.desc().nulls_first()
+    return column.asc().nulls_last()
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _past(column, descending: bool, value):
+    """Condition on the values of a key that come after ``value``"""
+    if value is None:
+        # Only values come after NULLs going down, nothing going up
+        return column.is_not(None) if descending else false()
+    if descending:
+        return column < value
+    return or_(column > value, column.is_(None)) if _nullable(column) \
+        else column > value
+
+
+def _after(columns, directions, values):
+    """Condition on the rows that come after ``values`` in the ordering"""
+    # A row value comparison is a single index range, but it is NULL as soon
+    # as either side has a NULL
+    if len(set(directions)) == 1 and None not in values \
+            and (directions[0] or not any(map(_nullable, columns))):
+        if directions[0]:
+            return tuple_(*columns) < tuple_(*values)
+        return tuple_(*columns) > tuple_(*values)
+
+    # Otherwise spell it out
+    return or_(*(
+        and_(
+            *(_equal(column, value)
+              for column, value in zip(columns[:i], values[:i])),
+            _past(columns[i], directions[i], values[i]),
+        )
+        for i in range(len(columns))
+    ))
+
+
+async def keyset_paginate(session, query, keys, params: CursorParams,
+                          transformer=None) -> dict:
+    """Paginate a query in the order of ``keys`` with a cursor
+
+    Each page continues strictly after the keys of the last item of the
+    previous page, so it is a range scan on an index over ``keys`` no matter
+    how deep it is, and rows inserted meanwhile don't shift the pages.
+
+    Parameters
+    ----------
+    session : AsyncSession
+        Database session
+    query : Select
+        Query without ordering. Every key must be selected by it.
+    keys : list
+        Columns that uniquely identify a row, most significant first. They
+        are sorted descending unless given as ``column.asc()``.
+    params : CursorParams
+        Cursor and page size
+    transformer : callable, optional
+        Applied to the list of items of the page
+
+    Returns
+    -------
+    dict
+        Content of a :class:`CursorPage`
+    """
+    columns, directions = zip(*map(_parse_key, keys))
+
+    if params.cursor:
+        values = decode_cursor(params.cursor, columns)
+        query = query.where(_after(columns, directions, values))
+
+    query = (
+        query
+        .order_by(*map(_order_by, columns, directions))
+        .limit(params.size + 1)
+    )
+
+    result = await session.execute(query)
+    if len(query.column_descriptions) == 1:
+        items = result.scalars().all()
+    else:
+        items = result.all()
+
+    next_cursor = None
+    if len(items) > params.size:
+        items = items[:params.size]
+        next_cursor = encode_cursor(columns, _key_values(items[-1], columns))
+
+    if transformer is not None:
+        items = transformer(items)
+
+    return {
+        'items': items,
+        'size': params.size,
+        'next_cursor': next_cursor,
+    }
@@ -0,0 +1,41 @@
+"""
+Connection pools that measure how long checkouts wait for a connection
+"""
+import time
+from functools import lru_cache
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from ..metrics import DB_POOL_TIMEOUTS, DB_POOL_WAIT
+
+
+class _WaitTimingMixin:
+    engine_label = ''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS.labels(self.engine_label).inc()
+            raise
+        finally:
+            DB_POOL_WAIT.labels(self.engine_label).observe(
+                time.perf_counter() - start
+            )
+
+
+@lru_cache
+def instrumented_pool_class(label: str, is_async: bool = False):
+    """Queue pool class reporting wait times under the given engine label
+
+    The label lives on the class because SQLAlchemy recreates pools from
+    their class when an engine is disposed.
+    """
+    base = AsyncAdaptedQueuePool if is_async else QueuePool
+    return type(
+        f'Instrumented{base.__name__}',
+        (_WaitTimingMixin, base),
+        {'engine_label': label},
+    )
@@ -1,21 +1,142 @@
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
 from functools import lru_cache
+from http.cookies import SimpleCookie
 
-from sqlalchemy import inspect
-from sqlalchemy.exc import IntegrityError
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import inspect, make_url
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine, SQLModel, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..config import settings
+from ..instrumentation import instrument_engine
+from ..metrics import POOL_COLLECTOR
+from .pool import instrumented_pool_class
 
 
-@lru_cache
-def get_engine():
-    engine = create_engine(
-        settings.db_url,
-        echo=True,
+logger = logging.getLogger(__name__)
+
+# Async drivers used when the async URL is derived from ``db_url``
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def _engine_options(url, label: str, is_async: bool = False) -> dict:
+    options = {
+        'echo': settings.db_echo,
+        'pool_pre_ping': settings.db_pool_pre_ping,
+    }
+
+    # SQLite picks its own pool classes, which don't take these settings
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update(
+            poolclass=instrumented_pool_class(label, is_async),
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+        )
+
+    return options
+
+
+def _create_engine(url, label: str):
+    engine = create_engine(url, **_engine_options(url, label))
+    POOL_COLLECTOR.register(label, engine)
+    instrument_engine(engine)
+    return engine
+
+
+def _create_async_engine(url, label: str):
+    engine = create_async_engine(
+        url,
+        **_engine_options(url, label, is_async=True),
     )
+    POOL_COLLECTOR.register(label, engine)
+    instrument_engine(engine)
     return engine
 
 
+def _async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+@lru_cache
+def get_engine():
+    """Engine of the primary database"""
+    return _create_engine(settings.db_url, 'sync')
+
+
+def get_async_db_url():
+    if settings.db_async_url is not None:
+        return settings.db_async_url
+    return _async_url(settings.db_url)
+
+
+@lru_cache
+def get_async_engine():
+    """Async engine of the primary database"""
+    return _create_async_engine(get_async_db_url(), 'async')
+
+
+class ReplicaSet:
+    """Round-robin over the read replicas that did not fail recently
+
+    A replica that fails to serve a request is left out for
+    ``db_replica_retry_after`` seconds, then tried again.
+    """
+
+    def __init__(self, engines: list):
+        self.engines = engines
+        self._turns = itertools.count()
+        self._down_until = [0.0] * len(engines)
+
+    def pick(self):
+        """Engine of the next healthy replica, None if there is none"""
+        if not self.engines:
+            return None
+        now = time.monotonic()
+        start = next(self._turns)
+        for i in range(len(self.engines)):
+            index = (start + i) % len(self.engines)
+            if self._down_until[index] <= now:
+                return self.engines[index]
+        return None
+
+    def mark_down(self, engine):
+        index = self.engines.index(engine)
+        logger.warning('Leaving read replica %d out for %ss', index,
+                       settings.db_replica_retry_after)
+        self._down_until[index] = (
+            time.monotonic() + settings.db_replica_retry_after
+        )
+
+
+@lru_cache
+def get_replicas() -> ReplicaSet:
+    return ReplicaSet([
+        _create_engine(url, f'sync_replica_{i}')
+        for i, url in enumerate(settings.db_replica_urls)
+    ])
+
+
+@lru_cache
+def get_async_replicas() -> ReplicaSet:
+    return ReplicaSet([
+        _create_async_engine(_async_url(url), f'async_replica_{i}')
+        for i, url in enumerate(settings.db_replica_urls)
+    ])
+
+
 def create_db_and_tables():
     engine = get_engine()
     SQLModel.metadata.create_all(engine)
@@ -27,6 +148,170 @@ def get_session():
         yield session
 
 
+class ThreadedSession:
+    """Sync session behind the subset of the AsyncSession API the routers use
+
+    Used when ``db_async`` is disabled. Every database call runs the blocking
+    driver in the threadpool, like sync route handlers would.
+    """
+
+    def __init__(self, sync_session: Session):
+        self.sync_session = sync_session
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute,
+                                       *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars,
+                                       *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar,
+                                       *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance):
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def connection(self):
+        return await run_in_threadpool(self.sync_session.connection)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+
+def _is_connection_error(exc: Exception) -> bool:
+    if isinstance(exc, DBAPIError) and exc.connection_invalidated:
+        return True
+    # Drivers don't always wrap failures to connect
+    return isinstance(exc, (OSError, OperationalError, InterfaceError))
+
+
+def _new_session(engine):
+    if settings.db_async:
+        return AsyncSession(engine, expire_on_commit=False)
+    return ThreadedSession(Session(engine, expire_on_commit=False))
+
+
+@asynccontextmanager
+async def open_session(replica: bool = False):
+    """Open a session on the engine selected by ``db_async``
+
+    Objects are not expired on commit, since in async mode attributes can't be
+    lazily reloaded once the handler returns.
+
+    Parameters
+    ----------
+    replica : bool, optional
+        Use the next healthy read replica, if any, rather than the primary.
+        Only for sessions that never write. A replica that can't be
+        connected to is replaced by the primary.
+    """
+    replicas = get_async_replicas() if settings.db_async else get_replicas()
+    engine = replicas.pick() if replica else None
+    primary = get_async_engine() if settings.db_async else get_engine()
+    session = _new_session(engine or primary)
+
+    try:
+        if engine is not None:
+            try:
+                # Connected before anything runs on it, so the request can
+                # still go to the primary
+                await session.connection()
+            except Exception as exc:
+                if not _is_connection_error(exc):
+                    raise
+                replicas.mark_down(engine)
+                await session.close()
+                engine = None
+                session = _new_session(primary)
+
+        yield session
+    except Exception as exc:
+        if engine is not None and _is_connection_error(exc):
+            replicas.mark_down(engine)
+        raise
+    finally:
+        await session.close()
+
+
+# Set on the responses of writes, so the reads of the same client go to the
+# primary until the replicas caught up with the write
+PRIMARY_PIN_COOKIE = 'agg_primary'
+
+
+async def get_read_session(request: Request):
+    """Session for routes that only read, on a replica when there are any"""
+    pinned = PRIMARY_PIN_COOKIE in request.cookies
+    if settings.db_replica_urls and not pinned:
+        # Replicas may not have replayed the latest writes yet, the response
+        # cache must not keep what they answer for now
+        request.state.replica_read = True
+
+    async with open_session(replica=not pinned) as session:
+        yield session
+
+
+async def get_write_session(request: Request):
+    """Session on the primary, for routes that write"""
+    if settings.db_replica_urls:
+        request.state.pin_primary = True
+    async with open_session() as session:
+        yield session
+
+
+def _pin_cookie_header() -> tuple[bytes, bytes]:
+    cookie = SimpleCookie()
+    cookie[PRIMARY_PIN_COOKIE] = '1'
+    cookie[PRIMARY_PIN_COOKIE].update({
+        'max-age': settings.db_primary_pin_seconds,
+        'path': '/',
+        'httponly': True,
+        'samesite': 'lax',
+    })
+    return b'set-cookie', cookie[PRIMARY_PIN_COOKIE].OutputString().encode()
+
+
+class PrimaryPinMiddleware:
+    """Set the primary pin cookie on the responses of requests that wrote
+
+    Done here rather than on the response of the route, since routes may
+    return a response of their own, e.g. a redirect, which would drop it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def pin(message):
+            if message['type'] == 'http.response.start' \
+                    and scope.get('state', {}).get('pin_primary'):
+                message['headers'] = [
+                    *message.get('headers', ()), _pin_cookie_header(),
+                ]
+            await send(message)
+
+        await self.app(scope, receive, pin)
+
+
 def _get_pk_dict(instance: SQLModel):
     insp = inspect(instance)
 
@@ -38,36 +323,90 @@ def _get_pk_dict(instance: SQLModel):
     }
 
 
-def create_or_update(instance: SQLModel, session: Session):
+def _upsert_for(session: Session):
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert
+    if dialect == 'sqlite':
+        return sqlite.insert
+    raise NotImplementedError(f'Upsert is not supported on {dialect}')
+
 
+def create_or_update(instance: SQLModel, session: Session, commit=True):
+    """Insert a record or partially update the existing one
+
+    This is done with a single ``INSERT ... ON CONFLICT`` statement on the
+    primary key. On conflict only the fields that were explicitly set on
+    `instance` and are not None get updated, and the ``version`` column of
+    models that have one is incremented.
+
+    Parameters
+    ----------
+    instance : SQLModel
+        Transient instance holding the values to write
+    session : Session
+        Database session
+    commit : bool, optional
+        Whether to commit the transaction, by default True. When False the
+        caller is responsible for committing.
+
+    Returns
+    -------
+    SQLModel
+        The persisted record
+    """
     insp = inspect(instance)
     assert insp.session is None
 
-    # Try the create route
-    try:
-        session.add(instance)
-        session.commit()
-        session.refresh(instance)
-        return instance
-    except IntegrityError as exc:
-        session.rollback()
-
-        # Profile probably already exists. Let's try to get it
-        instance_pk = _get_pk_dict(instance)
-        model = insp.class_
+    model = insp.class_
+    instance_pk = _get_pk_dict(instance)
+    pk_fields = list(instance_pk)
 
-        db_record = session.get(model, instance_pk)
+    # Primary keys left empty are generated by the database
+    values = {
+        column.name: getattr(instance, column.name)
+        for column in model.__table__.columns
+        if not (column.name in pk_fields and instance_pk[column.name] is None)
+        and column.name != 'version'
+    }
 
-        if db_record is None:
-            # This is another error
-            raise exc
+    stmt = _upsert_for(session)(model).values(**values)
 
-    # Try the partial update flow
     update_data = instance.model_dump(exclude_unset=True, exclude_none=True)
-    for field, value in update_data.items():
-        setattr(db_record, field, value)
+    update_set = {
+        field: stmt.excluded[field]
+        for field in update_data
+        if (field in values) and (field not in pk_fields)
+    }
+    if update_set and 'version' in model.__table__.columns:
+        update_set['version'] = model.__table__.c.version + 1
+
+    if update_set:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=pk_fields,
+            set_=update_set,
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=pk_fields)
+
+    db_record = session.scalars(
+        stmt.returning(model),
+        execution_options={'populate_existing': True},
+    ).one_or_none()
+
+    if db_record is None:
+        # Nothing to update and the record already exists
+        db_record = session.get(model, instance_pk)
+
+    if commit:
+        session.commit()
 
-    session.add(db_record)
-    session.commit()
-    session.refresh(db_record)
     return db_record
+
+
+async def async_create_or_update(instance: SQLModel, session: AsyncSession,
+                                 commit=True):
+    """Async version of :func:`create_or_update`"""
+    return await session.run_sync(
+        lambda sync_session: create_or_update(instance, sync_session, commit)
+    )
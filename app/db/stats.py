@@ -0,0 +1,395 @@
+"""
+Incrementally maintained profile statistics
+
+The write routes call these helpers before committing, so the counters in
+:class:`~app.db.models.ProfileStats` change in the same transaction as the
+rows they summarize.
+
+The portfolio value of a profile is the sum of the balance of each tape and
+cartridge it collected times their current sell value. It is kept up to
+date by applying the difference made by every write of a balance or a sell
+value, so no write or read ever sums all the holdings of a profile.
+"""
+from sqlalchemy import case
+from sqlmodel import Session, select, func, update
+
+from . import models
+from .session import _get_pk_dict, _upsert_for, create_or_update
+
+
+# Collection model of each asset, with its asset key and balance columns
+HOLDINGS = {
+    models.Tape: (
+        models.CollectedTapes,
+        models.CollectedTapes.tape_id,
+        models.CollectedTapes.ballance,
+    ),
+    models.Cartridge: (
+        models.CollectedCartridges,
+        models.CollectedCartridges.cartridge_id,
+        models.CollectedCartridges.balance,
+    ),
+}
+
+
+def _insert_stats(session: Session,
+                  address: str) -> models.ProfileStats | None:
+    """Insert the empty statistics row of a profile, unless it exists
+
+    Concurrent writes to a new profile all get here, so the insert must not
+    fail on the row another one just created.
+    """
+    insert = _upsert_for(session)
+    stmt = (
+        insert(models.ProfileStats)
+        .values(**models.ProfileStats(address=address).model_dump())
+        .on_conflict_do_nothing()
+        .returning(models.ProfileStats)
+    )
+    return session.scalars(stmt).one_or_none()
+
+
+def _lock_stats(session: Session, address: str) -> models.ProfileStats:
+    """Statistics row of a profile, created if needed, locked until commit
+
+    Writes that recount or read something to apply as a delta take this
+    lock first, so concurrent writes to the same profile run one after the
+    other and each sees what the previous one committed.
+    """
+    stmt = (
+        select(models.ProfileStats)
+        .where(models.ProfileStats.address == address)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    stats = session.scalars(stmt).one_or_none()
+    if stats is None:
+        _insert_stats(session, address)
+        stats = session.scalars(stmt).one()
+    return stats
+
+
+def ensure_profile_stats(session: Session, address: str) -> bool:
+    """Make sure a statistics row exists for the given profile
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    address : str
+        Address of the profile
+
+    Returns
+    -------
+    bool
+        Whether the row was created, which puts the profile on the
+        leaderboard
+    """
+    return _insert_stats(session, address) is not None
+
+
+def refresh_profile_stats(session: Session, address: str):
+    """Recount collections and creations of a single profile
+
+    Collections and creations arrive as upserts, so we can't tell a new row
+    from an update. Recounting a single profile is an index lookup per
+    counter, which is still far cheaper than doing it for every profile on
+    every read.
+
+    The statistics row is locked before counting. A concurrent write to the
+    same profile then recounts once this one committed, and sees its rows,
+    instead of both counting without the other and the last to commit
+    leaving a count that misses a row.
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    address : str
+        Address of the profile
+    """
+    stats = _lock_stats(session, address)
+
+    stmt = select(
+        select(func.count(models.CollectedTapes.tape_id))
+        .where(models.CollectedTapes.profile_address == address)
+        .scalar_subquery().label('n_tapes_collected'),
+        select(func.count(models.CollectedCartridges.cartridge_id))
+        .where(models.CollectedCartridges.profile_address == address)
+        .scalar_subquery().label('n_cartridges_collected'),
+        select(func.count(models.Tape.id))
+        .where(models.Tape.creator_address == address)
+        .scalar_subquery().label('n_tapes_created'),
+        select(func.count(models.Cartridge.id))
+        .where(models.Cartridge.creator_address == address)
+        .scalar_subquery().label('n_cartridges_created'),
+    )
+    counts = session.execute(stmt).one()
+
+    changed = False
+    for name, value in counts._mapping.items():
+        if getattr(stats, name) != value:
+            setattr(stats, name, value)
+            changed = True
+
+    if changed:
+        stats.version += 1
+    session.flush()
+
+
+def _move_points(session: Session, old: int, new: int):
+    """Move a profile between buckets of the points histogram"""
+    if old == new:
+        return
+
+    if old != 0:
+        session.execute(
+            update(models.PointsHistogram)
+            .where(models.PointsHistogram.rives_points == old)
+            .values(n_profiles=models.PointsHistogram.n_profiles - 1)
+        )
+
+    if new != 0:
+        insert = _upsert_for(session)
+        stmt = insert(models.PointsHistogram).values(
+            rives_points=new,
+            n_profiles=1,
+        )
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=['rives_points'],
+            set_={'n_profiles': models.PointsHistogram.n_profiles + 1},
+        ))
+
+
+def add_award(session: Session, address: str, points: int, count: int = 1):
+    """Account for newly awarded Console Achievements
+
+    Awards are append-only, so they are applied as a delta instead of a
+    recount.
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    address : str
+        Address of the awarded profile
+    points : int
+        Points granted by the awards
+    count : int, optional
+        Number of awards being accounted for, by default 1
+    """
+    # Let the database do the increment to avoid lost updates. The row stays
+    # locked until commit, so the histogram moves with it.
+    stmt = (
+        update(models.ProfileStats)
+        .where(models.ProfileStats.address == address)
+        .values(
+            n_console_achievements=(
+                models.ProfileStats.n_console_achievements + count
+            ),
+            rives_points=models.ProfileStats.rives_points + points,
+            version=models.ProfileStats.version + 1,
+        )
+        .returning(models.ProfileStats.rives_points)
+    )
+    new_points = session.scalar(stmt)
+    if new_points is None:
+        _insert_stats(session, address)
+        new_points = session.scalar(stmt)
+
+    _move_points(session, new_points - points, new_points)
+    session.flush()
+
+
+def _n_above(points):
+    """Number of profiles with more points, from the histogram"""
+    return (
+        select(func.coalesce(func.sum(models.PointsHistogram.n_profiles), 0))
+        .where(models.PointsHistogram.rives_points > points)
+        .scalar_subquery()
+    )
+
+
+def _n_zero():
+    # Profiles without points aren't in the histogram, they are only
+    # counted when ranking negative totals
+    return (
+        select(func.count())
+        .select_from(models.ProfileStats)
+        .where(models.ProfileStats.rives_points == 0)
+        .correlate(None)
+        .scalar_subquery()
+    )
+
+
+def ranks_for_points(session: Session, points: set[int]) -> dict[int, int]:
+    """Leaderboard rank of each of the given totals of rives points
+
+    The rank is one plus the number of profiles with more points, so tied
+    profiles share a rank. It is summed from the points histogram, which has
+    a row per distinct total rather than per profile.
+
+    Parameters
+    ----------
+    session : Session
+        Database session
+    points : set[int]
+        Totals of rives points to rank
+
+    Returns
+    -------
+    dict[int, int]
+        Rank of each total
+    """
+    if not points:
+        return {}
+
+    # One aggregate per total, summed by the database over the index of the
+    # histogram, all in a single statement
+    points = sorted(points)
+    above = [
+        _n_above(value) + _n_zero() if value < 0 else _n_above(value)
+        for value in points
+    ]
+
+    counts = session.execute(select(*above)).one()
+    return {value: count + 1 for value, count in zip(points, counts)}
+
+
+def rank_expression(points):
+    """Rank of a column of rives points, as :func:`ranks_for_points` has it
+
+    Lets a query select the rank of its rows along with them.
+    """
+    return _n_above(points) + case((points < 0, _n_zero()), else_=0) + 1
+
+
+def save_holding(
+    session: Session,
+    holding: models.CollectedTapes | models.CollectedCartridges,
+) -> models.CollectedTapes | models.CollectedCartridges:
+    """Create or update a collection and the portfolio value of its profile
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    holding : models.CollectedTapes | models.CollectedCartridges
+        Transient instance holding the values to write
+
+    Returns
+    -------
+    models.CollectedTapes | models.CollectedCartridges
+        The persisted collection
+    """
+    model = type(holding)
+    asset_model, asset_key, balance = next(
+        (asset, key, balance)
+        for asset, (holding_model, key, balance) in HOLDINGS.items()
+        if holding_model is model
+    )
+
+    # The asset first, then the statistics row, like writes to the asset do.
+    # Shared lock: a concurrent price change either waits for this
+    # transaction, and then sees the new balance, or commits first, and then
+    # this reads the new price.
+    price = session.scalar(
+        select(asset_model.sell_value)
+        .where(asset_model.id == getattr(holding, asset_key.key))
+        .with_for_update(read=True)
+    ) or 0
+
+    # Locking the collection row would not do, there is none yet on the
+    # first write. Concurrent writes to the profile wait here instead, and
+    # then read the balance the previous one committed.
+    _lock_stats(session, holding.profile_address)
+    old_balance = session.scalar(
+        select(balance).filter_by(**_get_pk_dict(holding))
+    ) or 0
+    record = create_or_update(holding, session, commit=False)
+
+    delta = (getattr(record, balance.key) - old_balance) * price
+    if delta != 0:
+        session.execute(
+            update(models.ProfileStats)
+            .where(models.ProfileStats.address == record.profile_address)
+            .values(
+                portfolio_value=models.ProfileStats.portfolio_value + delta,
+                version=models.ProfileStats.version + 1,
+            )
+        )
+    return record
+
+
+def revalue_holdings(session: Session,
+                     asset: models.Tape | models.Cartridge,
+                     old_sell_value: int | None):
+    """Apply a change of sell value to the profiles holding the asset
+
+    A single ``UPDATE`` of the holders, which the collection index on the
+    asset key finds.
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written, in which the row of the
+        asset was locked before reading ``old_sell_value``
+    asset : models.Tape | models.Cartridge
+        The persisted asset
+    old_sell_value : int | None
+        Sell value before this write, None if the asset is new
+    """
+    delta = asset.sell_value - (old_sell_value or 0)
+    if delta == 0:
+        return
+
+    holding_model, asset_key, balance = HOLDINGS[type(asset)]
+    holders = select(holding_model.profile_address).where(
+        asset_key == asset.id
+    )
+    # A profile may hold the asset under several contracts
+    held = (
+        select(func.sum(balance))
+        .where(asset_key == asset.id)
+        .where(holding_model.profile_address == models.ProfileStats.address)
+        .scalar_subquery()
+    )
+    session.execute(
+        update(models.ProfileStats)
+        .where(models.ProfileStats.address.in_(holders))
+        .values(
+            portfolio_value=models.ProfileStats.portfolio_value
+            + delta * held,
+            version=models.ProfileStats.version + 1,
+        )
+        .execution_options(synchronize_session='fetch')
+    )
+
+
+def save_cartridge(
+    session: Session,
+    cartridge: models.Cartridge,
+) -> tuple[models.Cartridge, str | None]:
+    """Create or update a cartridge and the portfolio value of its holders
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    cartridge : models.Cartridge
+        Transient instance holding the values to write
+
+    Returns
+    -------
+    tuple[models.Cartridge, str | None]
+        The persisted cartridge and the address of its creator before this
+        write
+    """
+    old_sell_value, old_creator = session.execute(
+        select(models.Cartridge.sell_value, models.Cartridge.creator_address)
+        .where(models.Cartridge.id == cartridge.id)
+        .with_for_update()
+    ).first() or (None, None)
+    record = create_or_update(cartridge, session, commit=False)
+    revalue_holdings(session, record, old_sell_value)
+    return record, old_creator
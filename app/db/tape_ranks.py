@@ -0,0 +1,136 @@
+"""
+Dense ranks of tapes on the leaderboard of their rule
+
+:attr:`~app.db.models.Tape.rank` is maintained as tapes are written, so the
+leaderboard of a rule is read straight from the ``(rule_id, score DESC)``
+index. Tied scores share a rank, hence only a score that appears on a rule
+for the first time, or the last tape leaving a score, moves the tapes below
+it, and it does so with a single ``UPDATE``.
+"""
+from sqlmodel import Session, select, update
+
+from . import models
+from .session import create_or_update
+from .stats import revalue_holdings
+
+
+def _lock_rules(session: Session, rule_ids):
+    # Writes to the same leaderboard must not interleave. Locking all the
+    # rules of a write at once, in a fixed order, keeps tapes moving between
+    # rules from deadlocking.
+    rule_ids = sorted(x for x in rule_ids if x is not None)
+    if rule_ids:
+        session.execute(
+            select(models.Rule.id)
+            .where(models.Rule.id.in_(rule_ids))
+            .order_by(models.Rule.id)
+            .with_for_update()
+        )
+
+
+def _tied(session: Session, rule_id: str, score: int, tape_id: str):
+    """Another tape of the rule with the same score, if any"""
+    return session.execute(
+        select(models.Tape.rank)
+        .where(models.Tape.rule_id == rule_id)
+        .where(models.Tape.score == score)
+        .where(models.Tape.id != tape_id)
+        .limit(1)
+    ).first()
+
+
+def _shift_below(session: Session, rule_id: str, score: int, delta: int):
+    session.execute(
+        update(models.Tape)
+        .where(models.Tape.rule_id == rule_id)
+        .where(models.Tape.score < score)
+        .values(rank=models.Tape.rank + delta,
+                version=models.Tape.version + 1)
+    )
+
+
+def _rerank(session: Session, tape: models.Tape,
+            old_rule_id: str | None, old_score: int | None):
+    if (old_rule_id, old_score) == (tape.rule_id, tape.score) \
+            and tape.rank is not None:
+        return
+
+    if old_rule_id is not None and old_score is not None \
+            and _tied(session, old_rule_id, old_score, tape.id) is None:
+        _shift_below(session, old_rule_id, old_score, -1)
+
+    if tape.rule_id is None or tape.score is None:
+        tape.rank = None
+        return
+
+    tied = _tied(session, tape.rule_id, tape.score, tape.id)
+    if tied is not None:
+        tape.rank = tied.rank
+        return
+
+    above = session.scalar(
+        select(models.Tape.rank)
+        .where(models.Tape.rule_id == tape.rule_id)
+        .where(models.Tape.score > tape.score)
+        .order_by(models.Tape.score)
+        .limit(1)
+    )
+    _shift_below(session, tape.rule_id, tape.score, 1)
+    tape.rank = (above or 0) + 1
+
+
+def save_tape(
+    session: Session,
+    tape: models.Tape,
+) -> tuple[models.Tape, str | None, str | None]:
+    """Create or update a tape and keep the ranks of its rule up to date
+
+    The portfolio value of the profiles holding the tape follows its sell
+    value too.
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    tape : models.Tape
+        Transient instance holding the values to write. Its rank is ignored.
+
+    Returns
+    -------
+    tuple[models.Tape, str | None, str | None]
+        The persisted tape, then the rule it belonged to and the address of
+        its creator before this write
+    """
+    # Ranks are only ever computed here
+    tape.rank = None
+
+    # Both rules are locked in one sorted batch before the tape row, so tapes
+    # moving between two rules in opposite directions can't deadlock
+    locked = {
+        tape.rule_id,
+        session.scalar(
+            select(models.Tape.rule_id).where(models.Tape.id == tape.id)
+        ),
+    }
+    _lock_rules(session, locked)
+    old_rule_id, old_score, old_sell_value, old_creator = session.execute(
+        select(
+            models.Tape.rule_id,
+            models.Tape.score,
+            models.Tape.sell_value,
+            models.Tape.creator_address,
+        )
+        .where(models.Tape.id == tape.id)
+        .with_for_update()
+    ).first() or (None, None, None, None)
+    if old_rule_id not in locked:
+        # Moved by a concurrent write in between, which is rare enough to
+        # lock out of order. Postgres reports a deadlock rather than hang.
+        _lock_rules(session, [old_rule_id])
+
+    record = create_or_update(tape, session, commit=False)
+    _rerank(session, record, old_rule_id, old_score)
+    revalue_holdings(session, record, old_sell_value)
+    session.flush()
+
+    return record, old_rule_id, old_creator
@@ -2,6 +2,9 @@
 File signature identitication
 """
 
+# Bytes of the start of a file that the signatures need
+SIGNATURE_LENGTH = 12
+
 
 def guess_mime_type(data: bytes) -> str:
     """Guess the MIME type based on a few known signatures
@@ -9,7 +12,8 @@ def guess_mime_type(data: bytes) -> str:
     Parameters
     ----------
     data : bytes
-        Original data of the file
+        Original data of the file, or its first bytes. Anything after the
+        first ``SIGNATURE_LENGTH`` bytes is ignored.
 
     Returns
     -------
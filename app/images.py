@@ -0,0 +1,324 @@
+"""
+Pre-sized renditions of uploaded images
+
+Uploads are streamed to the blob store in chunks, bounded by
+``image_max_size`` and checked against the known image signatures as they
+arrive, so a worker never holds a whole upload in memory. The stored upload
+is then decoded and validated once, and re-encoded into every size of
+:data:`RENDITIONS`, in WebP and in a format any client displays: PNG for
+images with transparency, JPEG otherwise. That work runs in a pool of
+worker processes, off the event loop, which read the upload from and store
+the renditions in the blob store.
+
+Image routes serve the rendition of the requested size, in WebP when the
+client accepts it. Images uploaded before renditions existed have none, and
+are served as they were uploaded.
+"""
+import asyncio
+import base64
+import io
+import multiprocessing
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Literal
+
+from fastapi import Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_
+from sqlmodel import Session, select
+
+from .blob_store import get_blob_store
+from .cache import etag_for, not_modified
+from .config import settings
+from .db import models
+from .db.session import _upsert_for
+from .file_signatures import SIGNATURE_LENGTH, guess_mime_type
+
+
+# Longest side of each rendition in pixels, largest first since each one is
+# scaled down from the previous. Images are never scaled up.
+RENDITIONS = {
+    'full': 2048,
+    'card': 512,
+    'thumbnail': 128,
+}
+ImageSize = Literal['full', 'card', 'thumbnail']
+DEFAULT_SIZE = 'full'
+
+WEBP = 'image/webp'
+# Pillow format and encoder options of each MIME type
+ENCODINGS = {
+    WEBP: ('WEBP', {'quality': 85, 'method': 4}),
+    'image/png': ('PNG', {'optimize': True}),
+    'image/jpeg': ('JPEG', {'quality': 85, 'optimize': True,
+                            'progressive': True}),
+}
+
+SIZE_DESCRIPTION = (
+    'Rendition to serve, by longest side: '
+    + ', '.join(f'`{name}` ({pixels}px)' for name, pixels in
+                RENDITIONS.items())
+)
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class InvalidImage(ValueError):
+    status_code = 422
+
+
+class ImageTooLarge(InvalidImage):
+    status_code = 413
+
+    def __init__(self):
+        super().__init__(
+            f'Images are limited to {settings.image_max_size} bytes.'
+        )
+
+
+@dataclass
+class StoredImage:
+    """An upload and its renditions, stored in the blob store"""
+    hash: str
+    mime_type: str
+    # Rows of models.ImageRendition
+    renditions: list[dict] = field(default_factory=list)
+
+
+def _has_alpha(image) -> bool:
+    return image.mode in ('RGBA', 'LA', 'PA') \
+        or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def build_renditions(key: str) -> tuple[str, list[dict]]:
+    """Decode a stored image, then encode and store all its renditions
+
+    Runs in the image worker processes. Animated images keep their first
+    frame.
+
+    Returns
+    -------
+    tuple[str, list[dict]]
+        MIME type of the image and rows of ``models.ImageRendition``
+    """
+    from PIL import Image, ImageOps
+
+    store = get_blob_store()
+    try:
+        with Image.open(io.BytesIO(store.read(key))) as image:
+            image.load()
+            image_format = image.format
+            # Phones store the orientation in the EXIF data
+            image = ImageOps.exif_transpose(image)
+    except Image.DecompressionBombError:
+        raise InvalidImage('Image is too large.') from None
+    except (OSError, SyntaxError, ValueError):
+        raise InvalidImage('Not a valid image.') from None
+
+    mime_type = Image.MIME.get(image_format)
+    if mime_type is None:
+        raise InvalidImage(f'Unsupported image format {image_format}.')
+
+    fallback = 'image/png' if _has_alpha(image) else 'image/jpeg'
+    image = image.convert('RGBA' if fallback == 'image/png' else 'RGB')
+
+    renditions = []
+    for size, longest in RENDITIONS.items():
+        image.thumbnail((longest, longest), Image.Resampling.LANCZOS)
+        for rendition_type in (WEBP, fallback):
+            image_format, options = ENCODINGS[rendition_type]
+            output = io.BytesIO()
+            image.save(output, image_format, **options)
+            renditions.append({
+                'source_hash': key,
+                'size': size,
+                'mime_type': rendition_type,
+                'width': image.width,
+                'height': image.height,
+                'blob_hash': store.put(output.getvalue()),
+            })
+
+    return mime_type, renditions
+
+
+@lru_cache
+def get_image_pool() -> ProcessPoolExecutor:
+    """Pool of the processes building renditions"""
+    # Spawned rather than forked, the workers never inherit the threads and
+    # connections of the server
+    return ProcessPoolExecutor(
+        settings.image_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+def _check_signature(prefix: bytes):
+    if not guess_mime_type(prefix).startswith('image/'):
+        raise InvalidImage('Not a supported image format.')
+
+
+def _checked_chunks(file) -> Iterator[bytes]:
+    """Read a file in chunks, up to ``image_max_size`` bytes"""
+    prefix = b''
+    size = 0
+    while chunk := file.read(CHUNK_SIZE):
+        size += len(chunk)
+        if size > settings.image_max_size:
+            raise ImageTooLarge()
+        # Reads may come up short, the signature is checked once there are
+        # enough bytes
+        if prefix is not None:
+            prefix += chunk
+            if len(prefix) >= SIGNATURE_LENGTH:
+                _check_signature(prefix)
+                prefix = None
+        yield chunk
+
+    if prefix is not None:
+        _check_signature(prefix)
+
+
+async def _process_blob(key: str) -> StoredImage:
+    loop = asyncio.get_running_loop()
+    mime_type, renditions = await loop.run_in_executor(
+        get_image_pool(), build_renditions, key,
+    )
+    return StoredImage(key, mime_type, renditions)
+
+
+async def process_upload(uploaded: UploadFile) -> StoredImage:
+    """Validate an uploaded file and store it along with its renditions
+
+    The file is streamed to the blob store, its bytes are never all in
+    memory at once.
+
+    Parameters
+    ----------
+    uploaded : UploadFile
+        Uploaded image
+
+    Returns
+    -------
+    StoredImage
+        The stored image. Save its renditions with :func:`save_renditions`.
+
+    Raises
+    ------
+    ImageTooLarge
+        If the file is larger than ``image_max_size``
+    InvalidImage
+        If the file is not an image Pillow can decode
+    """
+    # Known when the whole request body was received already
+    if uploaded.size is not None and uploaded.size > settings.image_max_size:
+        raise ImageTooLarge()
+
+    key = await run_in_threadpool(get_blob_store().put_stream,
+                                  _checked_chunks(uploaded.file))
+    return await _process_blob(key)
+
+
+async def process_image(data: bytes | None) -> StoredImage | None:
+    """Validate an inline image and store it along with its renditions
+
+    Parameters
+    ----------
+    data : bytes | None
+        Content of the image
+
+    Returns
+    -------
+    StoredImage | None
+        The stored image, None when there is no data. Save its renditions
+        with :func:`save_renditions`.
+
+    Raises
+    ------
+    ImageTooLarge
+        If the data is larger than ``image_max_size``
+    InvalidImage
+        If the data is not an image Pillow can decode
+    """
+    if data is None:
+        return None
+    if len(data) > settings.image_max_size:
+        raise ImageTooLarge()
+    _check_signature(data[:SIGNATURE_LENGTH])
+
+    key = await run_in_threadpool(get_blob_store().put, data)
+    return await _process_blob(key)
+
+
+def decode_image_data(value: str) -> bytes:
+    """Decode a base64 inline image, bounded by ``image_max_size``"""
+    # Checked before decoding, 4 base64 characters hold 3 bytes
+    if len(value) // 4 * 3 > settings.image_max_size + 3:
+        raise ImageTooLarge()
+    return base64.b64decode(value)
+
+
+def save_renditions(session: Session, image: StoredImage | None):
+    """Record the renditions of an image, once per distinct image"""
+    if image is None or not image.renditions:
+        return
+    insert = _upsert_for(session)
+    session.execute(
+        insert(models.ImageRendition).on_conflict_do_nothing(),
+        image.renditions,
+    )
+
+
+def rendition_query(hash_column, type_column, size: str, webp: bool):
+    """Select the blob to serve for an image column
+
+    The image is the original upload when it has no renditions. Filter the
+    query down to the row holding the image.
+    """
+    condition = and_(
+        models.ImageRendition.source_hash == hash_column,
+        models.ImageRendition.size == size,
+    )
+    if not webp:
+        condition = and_(condition, models.ImageRendition.mime_type != WEBP)
+
+    return (
+        select(
+            hash_column.label('source_hash'),
+            type_column.label('source_type'),
+            models.ImageRendition.blob_hash,
+            models.ImageRendition.mime_type,
+        )
+        .outerjoin(models.ImageRendition, condition)
+        .order_by((models.ImageRendition.mime_type == WEBP).desc())
+        .limit(1)
+    )
+
+
+def accepts_webp(request: Request) -> bool:
+    return WEBP in request.headers.get('accept', '')
+
+
+def image_response(request: Request, row):
+    """Stream the blob selected by :func:`rendition_query`"""
+    if row.blob_hash is None:
+        blob_hash, mime_type = row.source_hash, row.source_type
+    else:
+        blob_hash, mime_type = row.blob_hash, row.mime_type
+
+    # Every rendition is a blob of its own, addressed by its hash, which
+    # makes for a strong ETag. The rendition depends on the Accept header.
+    headers = {'etag': etag_for(blob_hash), 'vary': 'accept'}
+    unchanged = not_modified(request, headers['etag'])
+    if unchanged is not None:
+        unchanged.headers['vary'] = 'accept'
+        return unchanged
+
+    return StreamingResponse(
+        get_blob_store().iter_chunks(blob_hash),
+        media_type=mime_type,
+        headers=headers,
+    )
@@ -0,0 +1,184 @@
+"""
+Per-route request metrics, SQL statements included
+
+:class:`MetricsMiddleware` times every request and labels its metrics with
+the template of the route it matched, e.g. ``/agg/profile/{address}``, so
+path parameters never end up in a label. The SQLAlchemy hooks installed by
+:func:`instrument_engine` add the statements a request executes, and the
+time they took, to the :class:`RequestStats` of the request being served.
+
+Routes declare how many statements they may execute with the
+:func:`query_budget` dependency, and those that work through their input in
+chunks add the budget of each chunk with :func:`extend_query_budget`.
+:class:`QueryBudgetMiddleware` checks them when ``query_budget_mode`` is
+``'log'``, e.g. in staging, or ``'raise'``, which fails the request in the
+test client on any regression.
+"""
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from fastapi import Depends, Request
+from sqlalchemy import event
+from starlette.routing import Match
+
+from .metrics import (
+    HTTP_REQUEST_DB_SECONDS,
+    HTTP_REQUEST_DB_STATEMENTS,
+    HTTP_REQUEST_DURATION,
+    HTTP_RESPONSE_SIZE,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestStats:
+    """Database work done while serving a request"""
+    statements: int = 0
+    db_seconds: float = 0
+
+
+# Async sessions run the engine in greenlets, which inherit this context
+current_request_stats: ContextVar[RequestStats | None] = ContextVar(
+    'current_request_stats', default=None,
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += time.perf_counter() - context._query_start
+
+
+def instrument_engine(engine):
+    """Account the statements of an engine to the requests running them"""
+    engine = getattr(engine, 'sync_engine', engine)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def route_template(app, scope) -> str:
+    """Path template of the route matching a request
+
+    Matched here rather than read from the scope, since responses served by
+    middlewares, such as cache hits, never reach the router.
+    """
+    partial = None
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or 'unmatched'
+
+
+class MetricsMiddleware:
+    """Record latency, response size and database work of every request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def measure(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measure)
+        finally:
+            current_request_stats.reset(token)
+            route = route_template(scope['app'], scope)
+            method = scope['method']
+            HTTP_REQUEST_DURATION.labels(method, route, status).observe(
+                time.perf_counter() - start
+            )
+            HTTP_RESPONSE_SIZE.labels(method, route).observe(size)
+            HTTP_REQUEST_DB_STATEMENTS.labels(method, route).observe(
+                stats.statements
+            )
+            HTTP_REQUEST_DB_SECONDS.labels(method, route).observe(
+                stats.db_seconds
+            )
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(max_statements: int):
+    """Dependency declaring how many SQL statements a route may execute
+
+    Parameters
+    ----------
+    max_statements : int
+        Most statements a request to the route executes, whatever the data
+    """
+    def dependency(request: Request):
+        request.state.query_budget = max_statements
+
+    return Depends(dependency)
+
+
+def extend_query_budget(request: Request, statements: int):
+    """Allow the request more statements, for routes whose work grows with
+    the size of their input
+
+    Parameters
+    ----------
+    request : Request
+        Request of a route that declared a :func:`query_budget`
+    statements : int
+        Statements the request may execute on top of its budget
+    """
+    request.state.query_budget += statements
+
+
+class QueryBudgetMiddleware:
+    """Report requests that executed more statements than their route allows
+
+    Goes inside :class:`MetricsMiddleware`, which counts the statements.
+    """
+
+    def __init__(self, app, mode: str = 'log'):
+        self.app = app
+        self.mode = mode
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+
+        stats = current_request_stats.get()
+        budget = scope.get('state', {}).get('query_budget')
+        if stats is None or budget is None or stats.statements <= budget:
+            return
+
+        message = (
+            f'{scope["method"]} {scope["path"]} executed {stats.statements} '
+            f'SQL statements, its route allows {budget}'
+        )
+        if self.mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
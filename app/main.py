@@ -1,11 +1,19 @@
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from anyio import to_thread
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 from fastapi_pagination import add_pagination
 
-from .db.session import get_engine
+from .cache import ResponseCacheMiddleware
+from .config import settings
+from .images import InvalidImage, get_image_pool
+from .instrumentation import MetricsMiddleware, QueryBudgetMiddleware
+from .db.session import PrimaryPinMiddleware, get_engine, get_async_engine
+from .metrics import metrics_response
+from .pubsub import get_broker
+from .warmup import check_ready, warm_up
 from .routers import (
     profile,
     tape,
@@ -13,6 +21,7 @@ from .routers import (
     rule,
     console_achievements,
     notifications,
+    batch,
 )
 
 app = FastAPI(
@@ -33,6 +42,9 @@ app = FastAPI(
 )
 add_pagination(app)
 
+app.add_middleware(PrimaryPinMiddleware)
+# Added early so that CORS headers are set on cached responses too
+app.add_middleware(ResponseCacheMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -40,11 +52,38 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if settings.query_budget_mode != 'off':
+    app.add_middleware(QueryBudgetMiddleware,
+                       mode=settings.query_budget_mode)
+# Outermost, so cached responses are measured too
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event('startup')
-def on_startup():
-    get_engine()
+async def on_startup():
+    to_thread.current_default_thread_limiter().total_tokens = (
+        settings.threadpool_size
+    )
+
+    if settings.db_async:
+        get_async_engine()
+    else:
+        get_engine()
+
+    if settings.warmup:
+        await warm_up(app)
+
+
+@app.on_event('shutdown')
+async def on_shutdown():
+    await get_broker().close()
+    get_image_pool().shutdown(cancel_futures=True)
+
+
+@app.exception_handler(InvalidImage)
+async def invalid_image_handler(request: Request, exc: InvalidImage):
+    return JSONResponse(status_code=exc.status_code,
+                        content={'detail': str(exc)})
 
 
 @app.get('/docs', include_in_schema=False)
@@ -58,6 +97,7 @@ app.include_router(cartridge.router)
 app.include_router(rule.router)
 app.include_router(console_achievements.router)
 app.include_router(notifications.router)
+app.include_router(batch.router)
 
 
 class HealthResponse(BaseModel):
@@ -68,3 +108,24 @@ class HealthResponse(BaseModel):
 async def healthcheck() -> HealthResponse:
     """Simple Healthcheck. Always returns ok."""
     return {'status': 'ok'}
+
+
+class ReadyResponse(BaseModel):
+    status: str
+    problems: dict[str, str] = {}
+
+
+@app.get('/ready', include_in_schema=False)
+async def readiness(response: Response) -> ReadyResponse:
+    """Whether this worker can reach the database and has connections left"""
+    problems = await check_ready()
+    if problems:
+        response.status_code = 503
+        return {'status': 'unavailable', 'problems': problems}
+    return {'status': 'ok'}
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    """Prometheus metrics"""
+    return metrics_response()
@@ -0,0 +1,130 @@
+"""
+Prometheus metrics exposed at ``/metrics``
+
+With several workers, set ``PROMETHEUS_MULTIPROC_DIR`` to an empty directory
+so that every worker reports the metrics of all of them.
+"""
+import os
+import weakref
+
+from fastapi import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+
+DB_POOL_WAIT = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting to check out a connection from the pool',
+    ['engine'],
+    buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+             30),
+)
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts',
+    'Checkouts that gave up after waiting pool_timeout seconds',
+    ['engine'],
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    'response_cache_lookups',
+    'Lookups of cacheable responses in the response cache',
+    ['result'],
+)
+
+NOTIFICATION_STREAMS = Gauge(
+    'notification_streams',
+    'Open notification event streams',
+    multiprocess_mode='livesum',
+)
+
+# Labelled with the route template, never with the path itself
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Time to serve a request, response body included',
+    ['method', 'route', 'status'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+HTTP_RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes',
+    'Size of response bodies',
+    ['method', 'route'],
+    buckets=(100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000),
+)
+HTTP_REQUEST_DB_STATEMENTS = Histogram(
+    'http_request_db_statements',
+    'SQL statements executed to serve a request',
+    ['method', 'route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds',
+    'Time spent executing SQL statements to serve a request',
+    ['method', 'route'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+             5),
+)
+
+
+class PoolCollector:
+    """Reports the state of every registered connection pool on scrape"""
+
+    def __init__(self):
+        self._engines = weakref.WeakValueDictionary()
+
+    def register(self, name: str, engine):
+        self._engines[name] = engine
+
+    def collect(self):
+        gauges = {
+            'size': GaugeMetricFamily(
+                'db_pool_size', 'Connections the pool keeps open',
+                labels=['engine'],
+            ),
+            'checkedout': GaugeMetricFamily(
+                'db_pool_checked_out', 'Connections currently in use',
+                labels=['engine'],
+            ),
+            'checkedin': GaugeMetricFamily(
+                'db_pool_checked_in', 'Idle connections in the pool',
+                labels=['engine'],
+            ),
+            'overflow': GaugeMetricFamily(
+                'db_pool_overflow',
+                'Connections opened beyond pool_size (negative while the '
+                'pool is still filling up)',
+                labels=['engine'],
+            ),
+        }
+
+        for name, engine in list(self._engines.items()):
+            pool = getattr(engine, 'sync_engine', engine).pool
+            for attr, gauge in gauges.items():
+                method = getattr(pool, attr, None)
+                if method is not None:
+                    gauge.add_metric([name], method())
+
+        yield from gauges.values()
+
+
+POOL_COLLECTOR = PoolCollector()
+REGISTRY.register(POOL_COLLECTOR)
+
+
+def metrics_response() -> Response:
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Pools are still reported for the worker answering the scrape only
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(POOL_COLLECTOR)
+
+    return Response(content=generate_latest(registry),
+                    media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,187 @@
+"""
+Publish/subscribe of notifications to the streams of their profile
+
+Subscribers are always local to a worker. :class:`MemoryBroker` hands the
+events over to them directly, which is all a single process needs.
+:class:`PostgresBroker` relays events through Postgres ``LISTEN/NOTIFY`` so
+that every worker, on every node, delivers them to its own subscribers.
+"""
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from sqlalchemy import make_url
+
+from .config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7999
+
+# Events published to this address go to every subscriber
+BROADCAST = '*'
+
+
+class MemoryBroker:
+    """Fans events out to the subscribers of this process
+
+    Every subscriber gets a bounded queue. A subscriber that stops reading
+    misses events rather than holding on to an ever growing queue.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._queues = {}
+
+    @asynccontextmanager
+    async def subscribe(self, address: str):
+        """Queue receiving the events published to an address"""
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.setdefault(address, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._queues[address]
+            queues.discard(queue)
+            if not queues:
+                del self._queues[address]
+
+    def deliver(self, address: str, event: dict):
+        if address == BROADCAST:
+            queues = [
+                queue
+                for subscribers in self._queues.values()
+                for queue in subscribers
+            ]
+        else:
+            queues = self._queues.get(address, ())
+
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning('Dropped notification event for slow '
+                               'subscriber of %s', address)
+
+    async def publish(self, events: list[tuple[str, dict]]):
+        """Send events to the subscribers of their address
+
+        Parameters
+        ----------
+        events : list[tuple[str, dict]]
+            Pairs of address and event, the address being
+            :data:`BROADCAST` for events meant for every subscriber. Call it
+            after the commit of the rows the events describe.
+        """
+        for address, event in events:
+            self.deliver(address, event)
+
+    async def close(self):
+        pass
+
+
+class PostgresBroker(MemoryBroker):
+    """Relays events between workers through Postgres ``LISTEN/NOTIFY``
+
+    Each worker keeps one extra connection listening on the channel, no
+    matter how many subscribers it has.
+    """
+
+    CHANNEL = 'notifications'
+
+    def __init__(self, dsn: str, queue_size: int = 100):
+        super().__init__(queue_size)
+        self.dsn = dsn
+        self._pool = None
+        self._listener = None
+
+    async def _get_pool(self):
+        import asyncpg
+
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(self.dsn, min_size=1,
+                                                   max_size=2)
+        return self._pool
+
+    def _on_notify(self, connection, pid, channel, payload):
+        address, _, event = payload.partition('\n')
+        self.deliver(address, json.loads(event))
+
+    async def _listen(self):
+        import asyncpg
+
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(self.CHANNEL, self._on_notify)
+                await closed.wait()
+            except Exception:
+                # Whatever failed, the listener must keep reconnecting or
+                # this worker stops delivering events for good
+                logger.exception('Lost the notification listener connection')
+            finally:
+                if connection is not None:
+                    connection.terminate()
+            # Events published while reconnecting are missed, streams
+            # catch up from the database when clients reconnect
+            await asyncio.sleep(1)
+
+    @asynccontextmanager
+    async def subscribe(self, address: str):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+        async with super().subscribe(address) as queue:
+            yield queue
+
+    def _payload(self, address: str, event: dict) -> str:
+        payload = f'{address}\n{json.dumps(event, default=str)}'
+        if len(payload.encode()) > MAX_PAYLOAD:
+            # Too large to relay, the client fetches it by id
+            payload = f'{address}\n{json.dumps({"id": event["id"]})}'
+        return payload
+
+    async def publish(self, events):
+        if not events:
+            return
+        pool = await self._get_pool()
+        await pool.executemany(
+            'SELECT pg_notify($1, $2)',
+            [
+                (self.CHANNEL, self._payload(address, event))
+                for address, event in events
+            ],
+        )
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._pool is not None:
+            await self._pool.close()
+
+
+def _listen_dsn() -> str:
+    # asyncpg takes plain libpq URLs, without the SQLAlchemy driver
+    url = make_url(settings.broker_url or settings.db_url)
+    return url.set(drivername='postgresql').render_as_string(
+        hide_password=False
+    )
+
+
+BROKERS = {
+    'memory': lambda: MemoryBroker(settings.broker_queue_size),
+    'postgres': lambda: PostgresBroker(_listen_dsn(),
+                                       settings.broker_queue_size),
+}
+
+
+@lru_cache
+def get_broker() -> MemoryBroker:
+    """Instantiate the broker configured in ``broker_backend``"""
+    return BROKERS[settings.broker_backend]()
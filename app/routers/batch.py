@@ -0,0 +1,425 @@
+"""
+Routes for bulk ingestion of notices
+"""
+import logging
+from collections import defaultdict
+from typing import Any, Literal
+
+from fastapi import APIRouter, Request
+from pydantic import BaseModel, ValidationError
+from sqlmodel import Session, select
+
+from ..cache import invalidate, profile_tag
+from ..config import settings
+from ..db import models
+from ..db.session import open_session, create_or_update
+from ..db.stats import (
+    add_award,
+    ensure_profile_stats,
+    refresh_profile_stats,
+    save_cartridge,
+    save_holding,
+)
+from ..db.tape_ranks import save_tape
+from ..images import StoredImage, process_image, save_renditions
+from ..instrumentation import extend_query_budget, query_budget
+from ..pubsub import get_broker
+from .console_achievements import (
+    AwardedConsoleAchievementCreate,
+    ConsoleAchievementAPI,
+)
+from .notifications import NotificationCreate, notification_event
+from .rule import RuleInput
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(tags=['batch'])
+
+
+# Records are applied in this order within a chunk, so parents are always
+# written before the rows that reference them.
+RecordType = Literal[
+    'profile',
+    'cartridge',
+    'console_achievement',
+    'rule',
+    'tape',
+    'collected_cartridge',
+    'collected_tape',
+    'award',
+    'notification',
+]
+RECORD_PRIORITY = {
+    record_type: priority
+    for priority, record_type in enumerate(RecordType.__args__)
+}
+
+# Statements of a chunk: the parents of its records looked up in four tables
+# and inserted in five, profile stats included, then the rules of its
+# collected tapes. A chunk has at most one parent per table and record, so
+# each insert fits in a single statement.
+CHUNK_QUERY_BUDGET = 10
+# Statements of a record, its savepoint included, with the recount of the
+# profiles it changed. The most is a tape moving to another creator.
+RECORD_QUERY_BUDGET = 18
+
+
+class BatchRecord(BaseModel):
+    type: RecordType
+    data: dict[str, Any]
+
+
+class BatchRecordResult(BaseModel):
+    line: int
+    type: str | None = None
+    status: Literal['ok', 'error'] = 'ok'
+    detail: str | None = None
+
+
+class _Pending:
+    """A parsed record waiting for its chunk to be applied"""
+
+    def __init__(self, line: int, record_type: str, entity: BaseModel,
+                 image: StoredImage | None = None):
+        self.line = line
+        self.type = record_type
+        self.entity = entity
+        self.image = image
+        self.result = BatchRecordResult(line=line, type=record_type)
+        # Cached responses to drop once the record is committed
+        self.cache_tags = set()
+
+
+async def _parse_record(record: BatchRecord):
+    """Entity of a record, and its image stored with its renditions if any"""
+    if record.type == 'console_achievement':
+        ca = ConsoleAchievementAPI.model_validate(record.data)
+        image = await process_image(ca.image_data)
+        return ca.to_model(image), image
+    if record.type == 'rule':
+        rule = RuleInput.model_validate(record.data)
+        image = await process_image(rule.sponsor_image_data)
+        return rule.to_model(image), image
+
+    return _parse_entity(record), None
+
+
+def _parse_entity(record: BatchRecord) -> BaseModel:
+    data = record.data
+
+    if record.type == 'profile':
+        return models.Profile.model_validate(data)
+    if record.type == 'cartridge':
+        return models.Cartridge.model_validate(data)
+    if record.type == 'tape':
+        return models.Tape.model_validate(data)
+    if record.type == 'collected_cartridge':
+        return models.CollectedCartridges.model_validate(data)
+    if record.type == 'collected_tape':
+        return models.CollectedTapes.model_validate(data)
+    if record.type == 'award':
+        award = AwardedConsoleAchievementCreate.model_validate(data)
+        return models.AwardedConsoleAchievement.model_validate(award)
+    if record.type == 'notification':
+        notification = NotificationCreate.model_validate(data)
+        notification.profile_address = notification.profile_address.lower()
+        return models.Notification.model_validate(notification)
+
+    raise ValueError(f'Unknown record type {record.type}')
+
+
+async def _parse_line(line_number: int,
+                      line: bytes) -> _Pending | BatchRecordResult:
+    record = None
+    try:
+        record = BatchRecord.model_validate_json(line)
+        entity, image = await _parse_record(record)
+    except (ValidationError, ValueError) as exc:
+        return BatchRecordResult(
+            line=line_number,
+            type=record.type if record is not None else None,
+            status='error',
+            detail=str(exc),
+        )
+    return _Pending(line_number, record.type, entity, image)
+
+
+def _collect_parents(pending: list[_Pending]) -> dict[type, set[str]]:
+    parents = defaultdict(set)
+
+    for item in pending:
+        entity = item.entity
+        if item.type in ('cartridge', 'tape'):
+            parents[models.Profile].add(entity.creator_address)
+        if item.type == 'rule':
+            parents[models.Cartridge].add(entity.cartridge_id)
+        if item.type == 'tape':
+            parents[models.Rule].add(entity.rule_id)
+        if item.type == 'collected_cartridge':
+            parents[models.Profile].add(entity.profile_address)
+            parents[models.Cartridge].add(entity.cartridge_id)
+        if item.type in ('collected_tape', 'award'):
+            parents[models.Profile].add(entity.profile_address)
+            parents[models.Tape].add(entity.tape_id)
+        if item.type == 'notification':
+            parents[models.Profile].add(entity.profile_address)
+
+    for keys in parents.values():
+        keys.discard(None)
+
+    return parents
+
+
+def _create_missing_parents(session: Session,
+                            parents: dict[type, set[str]]):
+    """Create placeholder rows for every referenced parent in bulk
+
+    This replaces the ``create_or_update`` round trips that the single entity
+    routes do for each parent with one SELECT per parent table.
+    """
+    # Dependency order of the placeholders themselves
+    for model in (models.Profile, models.Cartridge, models.Rule, models.Tape):
+        keys = parents.get(model)
+        if not keys:
+            continue
+
+        pk_column = model.__table__.primary_key.columns.values()[0]
+        existing = set(
+            session.scalars(select(pk_column).where(pk_column.in_(keys)))
+        )
+        missing = keys - existing
+
+        session.add_all(model(**{pk_column.name: key}) for key in missing)
+        if model is models.Profile:
+            session.add_all(
+                models.ProfileStats(address=key) for key in missing
+            )
+
+    session.flush()
+
+
+def _cache_tags(item: _Pending) -> set[str]:
+    entity = item.entity
+
+    if item.type == 'console_achievement':
+        return {f'console_achievement:{entity.slug}', 'console_achievements'}
+    if item.type == 'rule':
+        return {f'rule:{entity.id}'}
+
+    tags = {'leaderboard'}
+    if item.type in ('cartridge', 'tape'):
+        address = entity.creator_address
+    elif item.type == 'profile':
+        address = entity.address
+    else:
+        address = entity.profile_address
+    if address is not None:
+        tags.add(profile_tag(address))
+
+    if item.type == 'tape':
+        tags.add(f'tape:{entity.id}')
+        if entity.rule_id is not None:
+            tags.add(f'rule:{entity.rule_id}')
+    elif item.type == 'collected_tape':
+        tags.add(f'tape:{entity.tape_id}')
+    elif item.type == 'award':
+        tags.add(f'console_achievement:{entity.ca_slug}')
+
+    return tags
+
+
+def _tag_collected_tape_rules(session: Session, pending: list[_Pending]):
+    # Rule leaderboards count the collections of their tapes
+    collected = [
+        item for item in pending
+        if item.type == 'collected_tape' and item.result.status == 'ok'
+    ]
+    if not collected:
+        return
+
+    rule_ids = dict(session.execute(
+        select(models.Tape.id, models.Tape.rule_id)
+        .where(models.Tape.id.in_({x.entity.tape_id for x in collected}))
+    ).all())
+    for item in collected:
+        rule_id = rule_ids.get(item.entity.tape_id)
+        if rule_id is not None:
+            item.cache_tags.add(f'rule:{rule_id}')
+
+
+def _apply_record(session: Session, item: _Pending,
+                  touched: set[str], awards: dict[str, list[int]]):
+    entity = item.entity
+    item.cache_tags = _cache_tags(item)
+
+    if item.type == 'award':
+        session.add(entity)
+        session.flush()
+        awarded = awards[entity.profile_address]
+        awarded[0] += entity.points
+        awarded[1] += 1
+        return
+
+    if item.type == 'notification':
+        session.add(entity)
+        session.flush()
+        return
+
+    save_renditions(session, item.image)
+    old_creator = None
+    if item.type == 'tape':
+        record, old_rule_id, old_creator = save_tape(session, entity)
+        if old_rule_id is not None:
+            item.cache_tags.add(f'rule:{old_rule_id}')
+    elif item.type == 'cartridge':
+        record, old_creator = save_cartridge(session, entity)
+    elif item.type in ('collected_cartridge', 'collected_tape'):
+        record = save_holding(session, entity)
+    else:
+        record = create_or_update(entity, session, commit=False)
+
+    if item.type == 'profile':
+        ensure_profile_stats(session, record.address)
+    elif item.type in ('cartridge', 'tape'):
+        # The previous creator, if any, loses the creation
+        for address in (record.creator_address, old_creator):
+            if address is not None:
+                touched.add(address)
+                item.cache_tags.add(profile_tag(address))
+    elif item.type in ('collected_cartridge', 'collected_tape'):
+        touched.add(record.profile_address)
+
+
+def _apply_chunk(session: Session,
+                 pending: list[_Pending]) -> list[BatchRecordResult]:
+    """Apply a chunk of records in a single transaction
+
+    Every record runs in its own savepoint, so a bad record is reported
+    without discarding the rest of the chunk.
+    """
+    # Collections lock the statistics row of their profile as they are
+    # applied, in address order like the recounts at the end
+    pending = sorted(pending, key=lambda x: (
+        RECORD_PRIORITY[x.type],
+        getattr(x.entity, 'profile_address', None) or '',
+        x.line,
+    ))
+    results = [item.result for item in pending]
+
+    try:
+        _create_missing_parents(session, _collect_parents(pending))
+    except Exception as exc:
+        logger.exception('Failed to create parents of batch chunk')
+        session.rollback()
+        for result in results:
+            result.status = 'error'
+            result.detail = f'Failed to create parent rows: {exc}'
+        return results
+
+    touched = set()
+    awards = defaultdict(lambda: [0, 0])
+
+    for item in pending:
+        try:
+            with session.begin_nested():
+                _apply_record(session, item, touched, awards)
+        except Exception as exc:
+            item.result.status = 'error'
+            item.result.detail = str(exc)
+
+    try:
+        _tag_collected_tape_rules(session, pending)
+        # Statistics rows are locked in the same order by every writer, so
+        # concurrent chunks don't deadlock
+        for address in sorted(touched | awards.keys()):
+            if address in touched:
+                refresh_profile_stats(session, address)
+            if address in awards:
+                add_award(session, address, *awards[address])
+        session.commit()
+    except Exception as exc:
+        logger.exception('Failed to commit batch chunk')
+        session.rollback()
+        for result in results:
+            if result.status == 'ok':
+                result.status = 'error'
+                result.detail = f'Failed to commit chunk: {exc}'
+
+    return results
+
+
+async def _apply_chunk_async(request: Request, pending: list[_Pending]):
+    extend_query_budget(
+        request, CHUNK_QUERY_BUDGET + RECORD_QUERY_BUDGET * len(pending)
+    )
+    async with open_session() as session:
+        results = await session.run_sync(_apply_chunk, pending)
+
+    applied = [item for item in pending if item.result.status == 'ok']
+    await invalidate(*{tag for item in applied for tag in item.cache_tags})
+    await get_broker().publish([
+        notification_event(item.entity)
+        for item in applied if item.type == 'notification'
+    ])
+    return results
+
+
+class BatchResponse(BaseModel):
+    applied: int
+    failed: int
+    results: list[BatchRecordResult]
+
+
+async def _lines(request: Request):
+    buffer = b''
+    async for data in request.stream():
+        buffer += data
+        *complete, buffer = buffer.split(b'\n')
+        for line in complete:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@router.post(
+    '/agg_rw/batch',
+    dependencies=[query_budget(0)],
+    summary='Apply a stream of records in bulk',
+    description=(
+        "Takes newline delimited JSON where each line is a record like "
+        "`{\"type\": \"tape\", \"data\": {...}}` and `data` has the same "
+        "body the single entity route accepts. Records are applied while the "
+        "body is being received, in chunks of one transaction each, parents "
+        "first. The response has a result for every non-empty line."
+    ),
+)
+async def ingest_batch(request: Request) -> BatchResponse:
+    results = []
+    pending = []
+
+    line_number = 0
+    async for line in _lines(request):
+        line_number += 1
+        if not line.strip():
+            continue
+
+        parsed = await _parse_line(line_number, line)
+        if isinstance(parsed, BatchRecordResult):
+            results.append(parsed)
+            continue
+
+        pending.append(parsed)
+        if len(pending) >= settings.batch_chunk_size:
+            results.extend(await _apply_chunk_async(request, pending))
+            pending = []
+
+    if pending:
+        results.extend(await _apply_chunk_async(request, pending))
+
+    results.sort(key=lambda x: x.line)
+    failed = sum(1 for x in results if x.status == 'error')
+    return BatchResponse(
+        applied=len(results) - failed,
+        failed=failed,
+        results=results,
+    )
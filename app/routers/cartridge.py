@@ -3,47 +3,78 @@ Routes for cartridge handling
 """
 from fastapi import APIRouter, Depends
 
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..cache import invalidate, profile_tag
 from ..db import models
-from ..db.session import get_session, create_or_update
+from ..db.session import get_write_session, async_create_or_update
+from ..db.stats import (
+    refresh_profile_stats,
+    save_cartridge,
+    save_holding,
+)
+from ..instrumentation import query_budget
 
 router = APIRouter(tags=['cartridge'])
 
 
 @router.put(
     '/agg_rw/cartridge',
+    dependencies=[query_budget(11)],
     summary='Create or update a cartridge',
     response_model=models.Cartridge,
 )
-def create_or_update_cartridge(
-    cartridge: models.Cartridge,
-    session: Session = Depends(get_session),
+async def create_or_update_cartridge(
+    cartridge: models.Validated[models.Cartridge],
+    session: AsyncSession = Depends(get_write_session),
 ):
     if cartridge.creator_address is not None:
-        create_or_update(models.Profile(address=cartridge.creator_address),
-                         session)
+        await async_create_or_update(
+            models.Profile(address=cartridge.creator_address),
+            session,
+        )
+
+    cartridge, old_creator = await session.run_sync(save_cartridge, cartridge)
+    # A cartridge moved to another creator leaves the count of the previous
+    # one
+    creators = {cartridge.creator_address, old_creator} - {None}
+    for address in sorted(creators):
+        await session.run_sync(refresh_profile_stats, address)
 
-    return create_or_update(cartridge, session)
+    await session.commit()
+    # The portfolio value of its holders follows the sell value
+    tags = {'leaderboard'}
+    tags.update(profile_tag(address) for address in creators)
+    await invalidate(*tags)
+    return cartridge
 
 
 @router.put(
     '/agg_rw/collected_cartridge',
+    dependencies=[query_budget(12)],
     summary='Create or update a collected cartridge',
     response_model=models.CollectedCartridges,
 )
-def create_or_update_collected_cartridge(
-    collected_cartridge: models.CollectedCartridges,
-    session: Session = Depends(get_session),
+async def create_or_update_collected_cartridge(
+    collected_cartridge: models.Validated[models.CollectedCartridges],
+    session: AsyncSession = Depends(get_write_session),
 ):
-    create_or_update(
+    await async_create_or_update(
         models.Profile(address=collected_cartridge.profile_address),
         session,
     )
 
-    create_or_update(
+    await async_create_or_update(
         models.Cartridge(id=collected_cartridge.cartridge_id),
         session,
     )
 
-    return create_or_update(collected_cartridge, session)
+    collected_cartridge = await session.run_sync(save_holding,
+                                                 collected_cartridge)
+    await session.run_sync(refresh_profile_stats,
+                           collected_cartridge.profile_address)
+
+    await session.commit()
+    await invalidate(profile_tag(collected_cartridge.profile_address),
+                     'leaderboard')
+    return collected_cartridge
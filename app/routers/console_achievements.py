@@ -4,20 +4,60 @@ Routes for Console Achievements handling
 import base64
 import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Response
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    UploadFile,
+)
 
 from fastapi_pagination import LimitOffsetPage
-from fastapi_pagination.ext.sqlmodel import paginate
 from pydantic import BaseModel, field_validator, field_serializer
-from sqlmodel import Session, select, Field
+from sqlmodel import select, update, Field
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..blob_store import BlobLoader
+from ..cache import cache_response, invalidate, profile_tag
 from ..db import models
-from ..db.session import get_session, create_or_update
-from ..file_signatures import guess_mime_type
+from ..db.pagination import (
+    CursorPage,
+    CursorParams,
+    keyset_paginate,
+    paginate,
+)
+from ..db.session import (
+    async_create_or_update,
+    get_read_session,
+    get_write_session,
+)
+from ..db.stats import add_award
+from ..images import (
+    DEFAULT_SIZE,
+    SIZE_DESCRIPTION,
+    ImageSize,
+    StoredImage,
+    accepts_webp,
+    decode_image_data,
+    image_response,
+    process_image,
+    process_upload,
+    rendition_query,
+    save_renditions,
+)
+from ..instrumentation import query_budget
 
 router = APIRouter(tags=['console_achievements'])
 
 
+def image_url_for(slug: str, image_hash: str | None) -> str | None:
+    """URL of the image route of a Console Achievement, if it has one"""
+    if image_hash is None:
+        return None
+    return f'/agg/console_achievement/{slug}/image'
+
+
 class ConsoleAchievementAPI(BaseModel):
     slug: str
     name: str | None = None
@@ -25,6 +65,7 @@ class ConsoleAchievementAPI(BaseModel):
     points: int = 0
     image_data: bytes | None = None
     image_type: str | None = None
+    image_url: str | None = None
 
     @field_validator('image_data', mode='before')
     @classmethod
@@ -33,39 +74,97 @@ class ConsoleAchievementAPI(BaseModel):
             return
         if isinstance(value, bytes):
             return value
-        return base64.b64decode(value)
+        return decode_image_data(value)
 
     @field_serializer('image_data', when_used='json-unless-none')
     def serialize_image_data(self, value: bytes, _info):
         return base64.b64encode(value)
 
+    @classmethod
+    def from_model(cls, achievement: models.ConsoleAchievement,
+                   blobs: BlobLoader | None = None):
+        """Build the response, with the image embedded by ``blobs``"""
+        image_hash = achievement.image_hash
+        response = cls(
+            **achievement.model_dump(exclude={'image_hash'}),
+            image_url=image_url_for(achievement.slug, image_hash),
+        )
+        if blobs is not None:
+            blobs.embed(response, 'image_data', image_hash)
+        return response
+
+    def to_model(self, image: StoredImage | None = None
+                 ) -> models.ConsoleAchievement:
+        """Build the database record
+
+        ``image`` is the result of :func:`process_image` on ``image_data``.
+        """
+        data = self.model_dump(exclude_unset=True,
+                               exclude={'image_data', 'image_url'})
+
+        if image is not None:
+            data['image_hash'] = image.hash
+            if self.image_type is None:
+                data['image_type'] = image.mime_type
+
+        return models.ConsoleAchievement.model_validate(data)
+
+
+INCLUDE_IMAGES_DESCRIPTION = (
+    'Embed base64 encoded images in the response instead of only returning '
+    'their URLs. Kept for backwards compatibility.'
+)
+
 
 @router.get(
     '/agg/console_achievement',
+    dependencies=[cache_response('console_achievements'), query_budget(2)],
     summary='List existing Console Achievements',
 )
-def list_console_achievements(
-    session: Session = Depends(get_session),
+async def list_console_achievements(
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ) -> LimitOffsetPage[ConsoleAchievementAPI]:
     query = select(models.ConsoleAchievement)
-    return paginate(session, query)
+    blobs = BlobLoader() if include_images else None
+    page = await paginate(
+        session,
+        query,
+        transformer=lambda items: [
+            ConsoleAchievementAPI.from_model(x, blobs) for x in items
+        ],
+    )
+    if blobs is not None:
+        await blobs.load()
+    return page
 
 
 @router.get(
     '/agg/console_achievement/{slug}',
+    dependencies=[
+        cache_response('console_achievement:{slug}', 'console_achievements'),
+        query_budget(1),
+    ],
     summary='List existing Console Achievements',
     response_model=ConsoleAchievementAPI,
 )
-def get_console_achievement(
+async def get_console_achievement(
     slug: str,
-    session: Session = Depends(get_session),
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ):
-    result = session.get(models.ConsoleAchievement, slug)
+    result = await session.get(models.ConsoleAchievement, slug)
 
     if result is None:
         raise HTTPException(status_code=404, detail='Not Found')
 
-    return result
+    blobs = BlobLoader() if include_images else None
+    response = ConsoleAchievementAPI.from_model(result, blobs)
+    if blobs is not None:
+        await blobs.load()
+    return response
 
 
 class ConsoleAchievementPlayer(BaseModel):
@@ -75,16 +174,10 @@ class ConsoleAchievementPlayer(BaseModel):
     tape_id: str | None
 
 
-@router.get(
-    '/agg/console_achievement/{slug}/players',
-    summary='List players who unlocked a given Console Achievement',
-)
-def list_console_achievement_players(
-    slug: str,
-    session: Session = Depends(get_session),
-) -> LimitOffsetPage[ConsoleAchievementPlayer]:
-    query = (
+def _players_query(slug: str):
+    return (
         select(
+            models.AwardedConsoleAchievement.id,
             models.AwardedConsoleAchievement.profile_address,
             models.AwardedConsoleAchievement.created_at,
             models.AwardedConsoleAchievement.points,
@@ -93,41 +186,99 @@ def list_console_achievement_players(
         .where(
             models.AwardedConsoleAchievement.ca_slug == slug
         )
+    )
+
+
+@router.get(
+    '/agg/console_achievement/{slug}/players',
+    dependencies=[
+        cache_response('console_achievement:{slug}'),
+        query_budget(2),
+    ],
+    summary='List players who unlocked a given Console Achievement',
+)
+async def list_console_achievement_players(
+    slug: str,
+    session: AsyncSession = Depends(get_read_session),
+) -> LimitOffsetPage[ConsoleAchievementPlayer]:
+    query = (
+        _players_query(slug)
         .order_by(models.AwardedConsoleAchievement.created_at.desc())
     )
-    return paginate(session, query)
+    return await paginate(session, query)
+
+
+@router.get(
+    '/agg/console_achievement/{slug}/players/cursor',
+    dependencies=[
+        cache_response('console_achievement:{slug}'),
+        query_budget(1),
+    ],
+    summary='List players who unlocked a given Console Achievement, by cursor',
+)
+async def list_console_achievement_players_by_cursor(
+    slug: str,
+    params: CursorParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> CursorPage[ConsoleAchievementPlayer]:
+    return await keyset_paginate(
+        session,
+        _players_query(slug),
+        [
+            models.AwardedConsoleAchievement.created_at,
+            models.AwardedConsoleAchievement.id,
+        ],
+        params,
+    )
 
 
 @router.get(
     '/agg/console_achievement/{slug}/image',
+    dependencies=[query_budget(1)],
     summary='List existing Console Achievements',
 )
-def get_console_achievement_image(
+async def get_console_achievement_image(
     slug: str,
-    session: Session = Depends(get_session),
+    request: Request,
+    size: ImageSize = Query(DEFAULT_SIZE, description=SIZE_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ):
-    result = session.get(models.ConsoleAchievement, slug)
+    query = (
+        rendition_query(
+            models.ConsoleAchievement.image_hash,
+            models.ConsoleAchievement.image_type,
+            size,
+            accepts_webp(request),
+        )
+        .where(models.ConsoleAchievement.slug == slug)
+    )
+    result = (await session.execute(query)).one_or_none()
 
-    if result is None:
+    if result is None or result.source_hash is None:
         raise HTTPException(status_code=404, detail='Not Found')
 
-    return Response(content=result.image_data, media_type=result.image_type)
+    return image_response(request, result)
 
 
 @router.put(
     '/agg_rw/console_achievement',
+    dependencies=[query_budget(3)],
     summary='Create or update a Console Achievement',
     response_model=ConsoleAchievementAPI,
 )
-def create_or_update_ca(
+async def create_or_update_ca(
     ca: ConsoleAchievementAPI,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    if (ca.image_data is not None) and (ca.image_type is None):
-        ca.image_type = guess_mime_type(ca.image_data)
-
-    console_achievement = models.ConsoleAchievement.model_validate(ca)
-    return create_or_update(console_achievement, session)
+    image = await process_image(ca.image_data)
+    await session.run_sync(save_renditions, image)
+    console_achievement = await async_create_or_update(
+        ca.to_model(image),
+        session,
+    )
+    await invalidate(f'console_achievement:{console_achievement.slug}',
+                     'console_achievements')
+    return ConsoleAchievementAPI.from_model(console_achievement)
 
 
 class AwardedConsoleAchievementCreate(BaseModel):
@@ -143,20 +294,21 @@ class AwardedConsoleAchievementCreate(BaseModel):
 
 @router.post(
     '/agg_rw/awarded_console_achievement',
+    dependencies=[query_budget(9)],
     summary='Award someone a Console Achievement',
     response_model=models.AwardedConsoleAchievement,
 )
-def create_or_update_award(
+async def create_or_update_award(
     award: AwardedConsoleAchievementCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    create_or_update(
+    await async_create_or_update(
         models.Profile(address=award.profile_address),
         session,
     )
 
     if award.tape_id is not None:
-        create_or_update(
+        await async_create_or_update(
             models.Tape(id=award.tape_id),
             session,
         )
@@ -164,34 +316,51 @@ def create_or_update_award(
     new_record = models.AwardedConsoleAchievement.model_validate(award)
 
     session.add(new_record)
-    session.commit()
-    session.refresh(new_record)
+    await session.run_sync(add_award, new_record.profile_address,
+                           new_record.points)
+    await session.commit()
+    await invalidate(profile_tag(new_record.profile_address), 'leaderboard',
+                     f'console_achievement:{new_record.ca_slug}')
 
     return new_record
 
 
-@router.put('/agg_rw/console_achievement/{slug}/image')
-def upload_image(
+@router.put(
+    '/agg_rw/console_achievement/{slug}/image',
+    dependencies=[query_budget(3)],
+)
+async def upload_image(
     slug: str,
     uploaded: UploadFile,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    # Get achievement
-    query = (
-        select(models.ConsoleAchievement)
+    # Checked before anything is stored, a 404 leaves no orphan blobs
+    achievement = await session.scalar(
+        select(models.ConsoleAchievement.slug)
         .where(models.ConsoleAchievement.slug == slug)
     )
-    achievement = session.exec(query).one_or_none()
-
     if achievement is None:
         raise HTTPException(status_code=404)
+    # No connection is held while the image is processed
+    await session.rollback()
 
-    data = uploaded.file.read()
-    mime_type = guess_mime_type(data)
+    image = await process_upload(uploaded)
+    await session.run_sync(save_renditions, image)
 
-    achievement.image_data = data
-    achievement.image_type = mime_type
+    stmt = (
+        update(models.ConsoleAchievement)
+        .where(models.ConsoleAchievement.slug == slug)
+        .values(
+            image_hash=image.hash,
+            image_type=image.mime_type,
+            version=models.ConsoleAchievement.version + 1,
+        )
+    )
+    result = await session.execute(stmt)
+
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404)
 
-    session.add(achievement)
-    session.commit()
+    await session.commit()
+    await invalidate(f'console_achievement:{slug}', 'console_achievements')
     return {'status': 'Ok'}
@@ -1,18 +1,41 @@
 """
 Routes for Notification
 """
+import asyncio
 import datetime
+import json
+from collections import deque
+from typing import Literal
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import RedirectResponse, StreamingResponse
 
 from fastapi_pagination import LimitOffsetPage
-from fastapi_pagination.ext.sqlmodel import paginate
-from pydantic import BaseModel
-from sqlmodel import Session, select
+from pydantic import BaseModel, Field, field_validator, model_validator
+from sqlalchemy import insert, literal
+from sqlmodel import Session, select, update, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..cache import invalidate, profile_tag
+from ..config import settings
 from ..db import models
-from ..db.session import get_session, create_or_update
+from ..db.pagination import (
+    CursorPage,
+    CursorParams,
+    keyset_paginate,
+    paginate,
+)
+from ..db.session import (
+    _upsert_for,
+    async_create_or_update,
+    get_read_session,
+    get_write_session,
+    open_session,
+)
+from ..db.stats import ensure_profile_stats
+from ..instrumentation import query_budget
+from ..metrics import NOTIFICATION_STREAMS
+from ..pubsub import BROADCAST, get_broker
 
 router = APIRouter(tags=['notifications'])
 
@@ -33,74 +56,468 @@ class NotificationCreate(NotificationBase):
     profile_address: str
 
 
+def notification_event(notification) -> tuple[str, dict]:
+    """Address and stream event of a committed notification"""
+    view = NotificationView.model_validate(notification, from_attributes=True)
+    return notification.profile_address, view.model_dump(mode='json')
+
+
+def _notifications_query(address: str, unread: bool | None):
+    query = (
+        select(models.Notification)
+        .where(models.Notification.profile_address == address.lower())
+    )
+
+    if unread is not None:
+        query = query.where(models.Notification.unread == unread)
+
+    return query
+
+
 @router.get(
     '/agg/notifications/{address}',
+    dependencies=[query_budget(2)],
     summary='Get notifications for the given user by address',
 )
-def list_notifications(
+async def list_notifications(
     address: str,
     unread: bool | None = None,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ) -> LimitOffsetPage[NotificationView]:
 
     query = (
-        select(models.Notification)
+        _notifications_query(address, unread)
+        .order_by(models.Notification.created_at.desc())
+    )
+    return await paginate(session, query)
+
+
+@router.get(
+    '/agg/notifications/{address}/cursor',
+    dependencies=[query_budget(1)],
+    summary='Get notifications for the given user by address, by cursor',
+)
+async def list_notifications_by_cursor(
+    address: str,
+    unread: bool | None = None,
+    params: CursorParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> CursorPage[NotificationView]:
+    return await keyset_paginate(
+        session,
+        _notifications_query(address, unread),
+        [models.Notification.created_at, models.Notification.id],
+        params,
+    )
+
+
+class UnreadCount(BaseModel):
+    unread: int
+
+
+@router.get(
+    '/agg/notifications/{address}/unread_count',
+    dependencies=[query_budget(1)],
+    summary='Count the unread notifications of the given user',
+)
+async def count_unread_notifications(
+    address: str,
+    session: AsyncSession = Depends(get_read_session),
+) -> UnreadCount:
+    unread = await session.scalar(
+        select(func.count())
+        .select_from(models.Notification)
         .where(models.Notification.profile_address == address.lower())
+        .where(models.Notification.unread)
     )
+    return UnreadCount(unread=unread)
 
-    if unread is not None:
-        query = query.where(models.Notification.unread == unread)
 
-    query = (
-        query
-        .order_by(models.Notification.created_at.desc())
+def broadcast_events(after_id: int,
+                     addresses: list[str] | None) -> list[tuple[str, dict]]:
+    """Stream events of a broadcast
+
+    A broadcast may notify every profile, so rather than an event per
+    notification, the streams of its recipients look up their own
+    notifications created after ``after_id``. Listed recipients get the
+    event on their own stream. The recipients of other audiences are only
+    known to the database, so their event goes to every stream.
+    """
+    event = {'broadcast_after': after_id}
+    if addresses is None:
+        return [(BROADCAST, event)]
+    return [(address, event) for address in addresses]
+
+
+def _sse(event: dict) -> str:
+    return (
+        f'id: {event["id"]}\n'
+        'event: notification\n'
+        f'data: {json.dumps(event)}\n\n'
     )
-    return paginate(session, query)
+
+
+async def _missed_events(address: str, last_event_id: int) -> list[dict]:
+    # Only while catching up, idle streams don't hold a connection
+    async with open_session() as session:
+        notifications = await session.scalars(
+            select(models.Notification)
+            .where(models.Notification.profile_address == address)
+            .where(models.Notification.id > last_event_id)
+            .order_by(models.Notification.id)
+            .limit(settings.broker_queue_size)
+        )
+        return [notification_event(x)[1] for x in notifications]
+
+
+# Broadcasts to every stream would otherwise have each of them open a
+# session at once, so only this many of a worker catch up at a time
+_broadcast_catch_ups = asyncio.Semaphore(
+    settings.notification_catch_up_concurrency
+)
+
+
+class _SentIds:
+    """Ids of the last events sent on a stream
+
+    Ids come from a sequence but commit in any order, so an event may
+    arrive after one with a greater id, and catch ups repeat what was
+    already sent live.
+    """
+
+    def __init__(self, size: int):
+        self._order = deque()
+        self._ids = set()
+        self.size = size
+
+    def add(self, event_id: int) -> bool:
+        """Remember an id, returning whether it was not sent yet"""
+        if event_id in self._ids:
+            return False
+        self._ids.add(event_id)
+        self._order.append(event_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+async def _event_stream(address: str, last_event_id: int | None):
+    NOTIFICATION_STREAMS.inc()
+    try:
+        async with get_broker().subscribe(address) as queue:
+            # Room for a catch up and a full queue of live events
+            sent = _SentIds(2 * settings.broker_queue_size)
+
+            # Subscribed first so nothing falls between the catch up and the
+            # live events, which may then repeat a few of the missed ones
+            if last_event_id is not None:
+                for event in await _missed_events(address, last_event_id):
+                    sent.add(event['id'])
+                    yield _sse(event)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        queue.get(), settings.notification_stream_keepalive
+                    )
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing idle streams
+                    yield ': keepalive\n\n'
+                    continue
+
+                if 'broadcast_after' in event:
+                    async with _broadcast_catch_ups:
+                        events = await _missed_events(
+                            address, event['broadcast_after'],
+                        )
+                else:
+                    events = [event]
+
+                for event in events:
+                    if sent.add(event['id']):
+                        yield _sse(event)
+    finally:
+        NOTIFICATION_STREAMS.dec()
+
+
+@router.get(
+    '/agg/notifications/{address}/stream',
+    dependencies=[query_budget(1)],
+    summary='Stream new notifications of the given user',
+    description=(
+        'Server-Sent Events with a `notification` event for every new '
+        'notification. Reconnecting with `Last-Event-ID` first replays the '
+        'notifications created since that one. Notifications too large to '
+        'be relayed between servers only carry their `id`.'
+    ),
+    response_class=StreamingResponse,
+)
+async def stream_notifications(address: str, request: Request):
+    last_event_id = request.headers.get('last-event-id')
+    if last_event_id is not None:
+        last_event_id = int(last_event_id) if last_event_id.isdigit() \
+            else None
+
+    return StreamingResponse(
+        _event_stream(address.lower(), last_event_id),
+        media_type='text/event-stream',
+        headers={'cache-control': 'no-cache', 'x-accel-buffering': 'no'},
+    )
+
+
+class MarkRead(BaseModel):
+    ids: list[int] | Literal['all']
+
+
+class MarkReadResponse(BaseModel):
+    updated: int
+
+
+@router.post(
+    '/agg/notifications/{address}/mark_read',
+    dependencies=[query_budget(1)],
+    summary='Mark notifications of the given user as read',
+    description=(
+        'Takes either a list of notification ids or `"all"`. Ids that belong '
+        'to another user or are already read are ignored.'
+    ),
+)
+async def mark_notifications_read(
+    address: str,
+    mark: MarkRead,
+    session: AsyncSession = Depends(get_write_session),
+) -> MarkReadResponse:
+    stmt = (
+        update(models.Notification)
+        .where(models.Notification.profile_address == address.lower())
+        .where(models.Notification.unread)
+        .values(unread=False)
+    )
+    if mark.ids != 'all':
+        stmt = stmt.where(models.Notification.id.in_(mark.ids))
+
+    result = await session.execute(stmt)
+    await session.commit()
+
+    return MarkReadResponse(updated=result.rowcount)
 
 
 @router.get(
     '/agg/notifications/{address}/{notification_id}',
+    dependencies=[query_budget(1)],
     summary='Follow notification and mark as read',
 )
-def follow_notifications(
+async def follow_notifications(
     address: str,
     notification_id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    query = (
-        select(models.Notification)
+    stmt = (
+        update(models.Notification)
         .where(models.Notification.profile_address == address.lower())
         .where(models.Notification.id == notification_id)
+        .values(unread=False)
+        .returning(models.Notification.url)
     )
-    notification = session.exec(query).one_or_none()
+    result = (await session.execute(stmt)).one_or_none()
 
-    if notification is None:
+    if result is None:
         raise HTTPException(status_code=404, detail='Not Found')
 
-    if notification.unread:
-        notification.unread = False
-        session.add(notification)
-        session.commit()
-
-    return RedirectResponse(notification.url)
+    await session.commit()
+    return RedirectResponse(result.url)
 
 
 @router.put(
     '/agg_rw/notifications',
+    dependencies=[query_budget(5)],
     summary='Create a Notification',
 )
-def create_notifications(
+async def create_notifications(
     notification: NotificationCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ) -> NotificationView:
 
     profile_address = notification.profile_address.lower()
     notification.profile_address = profile_address
 
-    create_or_update(
+    await async_create_or_update(
         models.Profile(address=profile_address),
         session
     )
 
+    created = await session.run_sync(ensure_profile_stats, profile_address)
+
     new_notification = models.Notification.model_validate(notification)
-    return create_or_update(new_notification, session)
+    new_notification = await async_create_or_update(new_notification, session)
+    # Notifications are not cached, only a new profile changes what is
+    if created:
+        await invalidate(profile_tag(profile_address), 'leaderboard')
+    await get_broker().publish([notification_event(new_notification)])
+    return new_notification
+
+
+# Listed addresses are created in chunks of this many rows per INSERT, well
+# under the bind parameter limits of asyncpg and SQLite
+PROFILE_CHUNK_SIZE = 1000
+MAX_BROADCAST_ADDRESSES = 10 * PROFILE_CHUNK_SIZE
+
+
+class BroadcastAudience(BaseModel):
+    addresses: list[str] | None = Field(
+        None, max_length=MAX_BROADCAST_ADDRESSES,
+    )
+    rule_id: str | None = None
+    cartridge_id: str | None = None
+    all: bool = False
+
+    @field_validator('addresses')
+    @classmethod
+    def normalize_addresses(cls, value: list[str] | None):
+        if value is None:
+            return
+        return sorted({x.lower() for x in value})
+
+    @model_validator(mode='after')
+    def check_single_selector(self):
+        selected = [
+            self.addresses is not None,
+            self.rule_id is not None,
+            self.cartridge_id is not None,
+            self.all,
+        ]
+        if sum(selected) != 1:
+            raise ValueError(
+                'Exactly one of addresses, rule_id, cartridge_id or all must '
+                'be given'
+            )
+        return self
+
+
+class NotificationBroadcast(NotificationBase):
+    audience: BroadcastAudience
+
+
+class BroadcastResponse(BaseModel):
+    notified: int
+
+
+def _create_profiles(session: Session, addresses: list[str]):
+    insert_ = _upsert_for(session)
+    for start in range(0, len(addresses), PROFILE_CHUNK_SIZE):
+        rows = [
+            {'address': x}
+            for x in addresses[start:start + PROFILE_CHUNK_SIZE]
+        ]
+        session.execute(
+            insert_(models.Profile).values(rows).on_conflict_do_nothing()
+        )
+        session.execute(
+            insert_(models.ProfileStats).values(rows).on_conflict_do_nothing()
+        )
+
+
+def _audience_query(audience: BroadcastAudience):
+    if audience.rule_id is not None:
+        # Players of a rule are the creators of its tapes
+        return (
+            select(models.Tape.creator_address)
+            .where(models.Tape.rule_id == audience.rule_id)
+            .where(models.Tape.creator_address.is_not(None))
+            .distinct()
+        )
+
+    if audience.cartridge_id is not None:
+        return (
+            select(models.CollectedCartridges.profile_address)
+            .where(
+                models.CollectedCartridges.cartridge_id
+                == audience.cartridge_id
+            )
+            .distinct()
+        )
+
+    if audience.all:
+        return select(models.Profile.address)
+
+    return (
+        select(models.Profile.address)
+        .where(models.Profile.address.in_(audience.addresses))
+    )
+
+
+def broadcast_notification(
+    session: Session,
+    broadcast: NotificationBroadcast,
+) -> tuple[int, int]:
+    """Notify every profile of an audience with a single INSERT ... SELECT
+
+    The notifications are never loaded back, there may be one per profile.
+
+    Parameters
+    ----------
+    session : Session
+        Session of the transaction being written
+    broadcast : NotificationBroadcast
+        Notification and audience to send it to
+
+    Returns
+    -------
+    tuple[int, int]
+        Number of notifications created, and an id that all of them are
+        greater than
+    """
+    if broadcast.audience.addresses:
+        _create_profiles(session, broadcast.audience.addresses)
+
+    # Ids come from a sequence, the new rows take greater ones
+    after_id = session.scalar(
+        select(func.coalesce(func.max(models.Notification.id), 0))
+    )
+
+    audience = _audience_query(broadcast.audience).subquery()
+    values = broadcast.model_dump(exclude={'audience'})
+
+    stmt = insert(models.Notification).from_select(
+        [*values, 'profile_address'],
+        select(
+            *(
+                literal(value, models.Notification.__table__.c[name].type)
+                for name, value in values.items()
+            ),
+            audience.c[0],
+        ),
+    )
+    return session.execute(stmt).rowcount, after_id
+
+
+@router.put(
+    '/agg_rw/notifications/broadcast',
+    # Two statements per chunk of listed addresses, then the last id and
+    # the INSERT
+    dependencies=[query_budget(
+        2 * MAX_BROADCAST_ADDRESSES // PROFILE_CHUNK_SIZE + 2
+    )],
+    summary='Send a Notification to many users at once',
+    description=(
+        'The audience is either a list of `addresses`, the players of a '
+        '`rule_id`, the collectors of a `cartridge_id` or `all` profiles. '
+        'Listed addresses without a profile get one, and at most '
+        f'{MAX_BROADCAST_ADDRESSES} addresses can be listed.'
+    ),
+)
+async def broadcast_notifications(
+    broadcast: NotificationBroadcast,
+    session: AsyncSession = Depends(get_write_session),
+) -> BroadcastResponse:
+    notified, after_id = await session.run_sync(broadcast_notification,
+                                                broadcast)
+    await session.commit()
+
+    addresses = broadcast.audience.addresses
+    if addresses:
+        await invalidate('leaderboard', *map(profile_tag, addresses))
+    if notified:
+        await get_broker().publish(broadcast_events(after_id, addresses))
+
+    return BroadcastResponse(notified=notified)
@@ -4,16 +4,43 @@ Routes for profile retrieval
 import base64
 import datetime
 import logging
+from typing import Literal
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi_pagination import LimitOffsetPage
-from fastapi_pagination.ext.sqlmodel import paginate
 from pydantic import BaseModel, field_serializer
 
-from sqlmodel import Session, select, func
-
+from sqlalchemy import tuple_
+from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..blob_store import BlobLoader
+from ..cache import (
+    cache_response,
+    etag_for,
+    invalidate,
+    not_modified,
+    profile_tag,
+)
 from ..db import models
-from ..db.session import get_session, create_or_update
+from ..db.pagination import (
+    CursorPage,
+    CursorParams,
+    keyset_paginate,
+    paginate,
+)
+from ..db.session import (
+    async_create_or_update,
+    get_read_session,
+    get_write_session,
+)
+from ..db.stats import (
+    ensure_profile_stats,
+    rank_expression,
+    ranks_for_points,
+)
+from ..instrumentation import query_budget
+from .console_achievements import INCLUDE_IMAGES_DESCRIPTION, image_url_for
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +50,11 @@ router = APIRouter(tags=['profiles', ])
 class Tape(BaseModel):
     tape_id: str
     rule_id: str
-    outcard_hash: str
+    outcard_hash: str | None = None
     score: int | None = None
-    creator: str
+    creator: str | None = None
     title: str | None = None
+    created_at: datetime.datetime | None = None
     n_collected: int
     buy_value: int
     sell_value: int
@@ -53,120 +81,239 @@ class ProfileResponse(BaseModel):
     n_console_achievements: int
 
     rives_points: int = 0
+    rank: int | None = None
+
+
+def _leaderboard_query():
+    return select(
+        models.ProfileStats.address,
+        models.ProfileStats.n_tapes_collected,
+        models.ProfileStats.n_cartridges_collected,
+        models.ProfileStats.n_tapes_created,
+        models.ProfileStats.n_cartridges_created,
+        models.ProfileStats.n_console_achievements,
+        models.ProfileStats.rives_points,
+        models.ProfileStats.portfolio_value,
+    )
+
+
+LeaderboardSort = Literal['rives_points', 'portfolio_value']
+
+SORT_BY_QUERY = Query(
+    'rives_points',
+    description=(
+        'Order of the leaderboard, from the highest value down. The `rank` '
+        'of each profile is always its rank by rives points.'
+    ),
+)
 
 
 @router.get(
     '/agg/profile',
+    dependencies=[cache_response('leaderboard'), query_budget(4)],
 )
-def list_profiles(
-    session: Session = Depends(get_session),
+async def list_profiles(
+    sort_by: LeaderboardSort = SORT_BY_QUERY,
+    session: AsyncSession = Depends(get_read_session),
 ) -> LimitOffsetPage[ProfileResponse]:
 
     query = (
-        select(
-            models.Profile.address,
+        _leaderboard_query()
+        .order_by(
+            getattr(models.ProfileStats, sort_by).desc(),
+            models.ProfileStats.address.desc(),
         )
     )
+    page = await paginate(session, query)
 
-    col_profile = query.selected_columns['address']
-
-    query = query.add_columns(
-        # Collected Tapes
-        select(func.count(models.CollectedTapes.tape_id))
-        .where(models.CollectedTapes.profile_address == col_profile)
-        .scalar_subquery().label('n_tapes_collected'),
-        # Collected Cartridges
-        select(func.count(models.CollectedCartridges.cartridge_id))
-        .where(models.CollectedCartridges.profile_address == col_profile)
-        .scalar_subquery().label('n_cartridges_collected'),
-        # Collected Tapes
-        select(func.count(models.Tape.id))
-        .where(models.Tape.creator_address == col_profile)
-        .scalar_subquery().label('n_tapes_created'),
-        # Collected Cartridges
-        select(func.count(models.Cartridge.id))
-        .where(models.Cartridge.creator_address == col_profile)
-        .scalar_subquery().label('n_cartridges_created'),
-        # Number of achievements
-        select(func.count(models.AwardedConsoleAchievement.id))
-        .where(models.AwardedConsoleAchievement.profile_address == col_profile)
-        .scalar_subquery().label('n_console_achievements'),
-        # Total points from achievements
-        select(
-            func.coalesce(func.sum(models.AwardedConsoleAchievement.points), 0)
-        )
-        .where(models.AwardedConsoleAchievement.profile_address == col_profile)
-        .scalar_subquery().label('rives_points'),
+    ranks = await session.run_sync(
+        ranks_for_points, {item.rives_points for item in page.items}
+    )
+    for item in page.items:
+        item.rank = ranks[item.rives_points]
+
+    return page
+
+
+@router.get(
+    '/agg/profile/cursor',
+    dependencies=[cache_response('leaderboard'), query_budget(3)],
+    summary='List profiles by rives points or portfolio value, by cursor',
+)
+async def list_profiles_by_cursor(
+    sort_by: LeaderboardSort = SORT_BY_QUERY,
+    params: CursorParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> CursorPage[ProfileResponse]:
+    page = await keyset_paginate(
+        session,
+        _leaderboard_query(),
+        [getattr(models.ProfileStats, sort_by), models.ProfileStats.address],
+        params,
+    )
+
+    ranks = await session.run_sync(
+        ranks_for_points, {row.rives_points for row in page['items']}
     )
+    page['items'] = [
+        {**row._asdict(), 'rank': ranks[row.rives_points]}
+        for row in page['items']
+    ]
 
-    query = query.order_by(query.selected_columns['rives_points'].desc())
-    return paginate(session, query)
+    return page
 
 
 @router.get(
     '/agg/profile/{address}',
+    dependencies=[
+        cache_response('profile:{address}', 'leaderboard'),
+        query_budget(2),
+    ],
     response_model=ProfileResponse,
 )
-def get_profile(
+async def get_profile(
     address: str,
-    session: Session = Depends(get_session),
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_read_session),
 ):
     address = address.lower()
+    # Only what the ETag is made of, conditional requests stop here
+    points = func.coalesce(models.ProfileStats.rives_points, 0)
     stmt = (
         select(
             models.Profile.address,
-            models.Profile.points,
+            models.ProfileStats.version,
+            rank_expression(points).label('rank'),
         )
+        .outerjoin(models.ProfileStats)
         .where(models.Profile.address == address)
     )
 
-    col_profile = stmt.selected_columns['address']
-
-    stmt = stmt.add_columns(
-        # Collected Tapes
-        select(func.count(models.CollectedTapes.tape_id))
-        .where(models.CollectedTapes.profile_address == col_profile)
-        .scalar_subquery().label('n_collected_tapes'),
-        # Collected Cartridges
-        select(func.count(models.CollectedCartridges.cartridge_id))
-        .where(models.CollectedCartridges.profile_address == col_profile)
-        .scalar_subquery().label('n_collected_cartridges'),
-        # Collected Tapes
-        select(func.count(models.Tape.id))
-        .where(models.Tape.creator_address == col_profile)
-        .scalar_subquery().label('n_created_tapes'),
-        # Collected Cartridges
-        select(func.count(models.Cartridge.id))
-        .where(models.Cartridge.creator_address == col_profile)
-        .scalar_subquery().label('n_created_cartridges'),
-        # Number of achievements
-        select(func.count(models.AwardedConsoleAchievement.id))
-        .where(models.AwardedConsoleAchievement.profile_address == col_profile)
-        .scalar_subquery().label('n_console_achievements'),
-        # Total points from achievements
-        select(func.sum(models.AwardedConsoleAchievement.points))
-        .where(models.AwardedConsoleAchievement.profile_address == col_profile)
-        .scalar_subquery().label('total_points'),
+    resp = (await session.execute(stmt)).one_or_none()
+
+    if resp is None:
+        raise HTTPException(status_code=404, detail='Profile not found.')
+
+    # The rank moves with the points of other profiles, so it is part of the
+    # ETag along with the version of the stats
+    etag = etag_for(resp.version or 1, resp.rank)
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    response.headers['etag'] = etag
+
+    stats = await session.get(models.ProfileStats, address) \
+        or models.ProfileStats(address=address)
+
+    return ProfileResponse(
+        address=address,
+        portfolio_value=stats.portfolio_value,
+        n_cartridges_created=stats.n_cartridges_created,
+        n_cartridges_collected=stats.n_cartridges_collected,
+        n_tapes_created=stats.n_tapes_created,
+        n_tapes_collected=stats.n_tapes_collected,
+        n_console_achievements=stats.n_console_achievements,
+        rives_points=stats.rives_points,
+        rank=resp.rank,
     )
 
-    logger.info("Executing query %s", str(stmt))
-    resp = session.execute(stmt).one_or_none()
+
+class RankedProfile(BaseModel):
+    address: str
+    rives_points: int
+    rank: int
+
+
+class ProfileRankResponse(RankedProfile):
+    neighbours: list[RankedProfile]
+
+
+@router.get(
+    '/agg/profile/{address}/rank',
+    dependencies=[cache_response('leaderboard'), query_budget(6)],
+    summary='Get the rank of a profile on the points leaderboard',
+    description=(
+        'Tied profiles share a rank. The neighbours are the `k` profiles '
+        'before and after this one on the leaderboard, this one included.'
+    ),
+)
+async def get_profile_rank(
+    address: str,
+    k: int = Query(5, ge=0, le=50,
+                   description='Number of neighbours on each side'),
+    session: AsyncSession = Depends(get_read_session),
+) -> ProfileRankResponse:
+    address = address.lower()
+    stmt = (
+        select(models.Profile.address, models.ProfileStats.rives_points)
+        .outerjoin(models.ProfileStats)
+        .where(models.Profile.address == address)
+    )
+    resp = (await session.execute(stmt)).one_or_none()
 
     if resp is None:
         raise HTTPException(status_code=404, detail='Profile not found.')
 
-    return ProfileResponse(
+    points = resp.rives_points or 0
+    key = tuple_(models.ProfileStats.rives_points, models.ProfileStats.address)
+    neighbours = select(
+        models.ProfileStats.address,
+        models.ProfileStats.rives_points,
+    )
+
+    above = (await session.execute(
+        neighbours
+        .where(key > tuple_(points, address))
+        .order_by(
+            models.ProfileStats.rives_points,
+            models.ProfileStats.address,
+        )
+        .limit(k)
+    )).all()
+    below = (await session.execute(
+        neighbours
+        .where(key < tuple_(points, address))
+        .order_by(
+            models.ProfileStats.rives_points.desc(),
+            models.ProfileStats.address.desc(),
+        )
+        .limit(k)
+    )).all()
+
+    rows = [*reversed(above), (address, points), *below]
+    ranks = await session.run_sync(
+        ranks_for_points, {row_points for _, row_points in rows}
+    )
+
+    return ProfileRankResponse(
         address=address,
-        portfolio_value=0,
-        n_cartridges_created=resp.n_created_cartridges,
-        n_cartridges_collected=resp.n_collected_cartridges,
-        n_tapes_created=resp.n_created_tapes,
-        n_tapes_collected=resp.n_collected_tapes,
-        n_console_achievements=resp.n_console_achievements,
-        rives_points=resp.total_points or 0,
+        rives_points=points,
+        rank=ranks[points],
+        neighbours=[
+            RankedProfile(
+                address=row_address,
+                rives_points=row_points,
+                rank=ranks[row_points],
+            )
+            for row_address, row_points in rows
+        ],
     )
 
 
+def _with_images(rows, model, blobs: BlobLoader | None):
+    items = []
+    for row in rows:
+        item = model(
+            **row._asdict(),
+            image_url=image_url_for(row.ca_slug, row.image_hash),
+        )
+        if blobs is not None:
+            blobs.embed(item, 'image_data', row.image_hash)
+        items.append(item)
+    return items
+
+
 class AchievementResponse(BaseModel):
     ca_slug: str | None = None
     name: str | None = None
@@ -177,26 +324,21 @@ class AchievementResponse(BaseModel):
     tape_id: str | None = None
     image_data: bytes | None = None
     image_type: str | None = None
+    image_url: str | None = None
 
     @field_serializer('image_data', when_used='json-unless-none')
     def serialize_image_data(self, value: bytes, _info):
         return base64.b64encode(value)
 
 
-@router.get(
-    '/agg/profile/{address}/console_achievements',
-)
-def get_profile_achievements(
-    address: str,
-    session: Session = Depends(get_session),
-) -> LimitOffsetPage[AchievementResponse]:
-    address = address.lower()
-    query = (
+def _achievements_query(address: str):
+    return (
         select(
+            models.AwardedConsoleAchievement.id,
             models.AwardedConsoleAchievement.ca_slug,
             models.ConsoleAchievement.name,
             models.ConsoleAchievement.description,
-            models.ConsoleAchievement.image_data,
+            models.ConsoleAchievement.image_hash,
             models.ConsoleAchievement.image_type,
             models.AwardedConsoleAchievement.created_at,
             models.AwardedConsoleAchievement.points,
@@ -205,9 +347,67 @@ def get_profile_achievements(
         )
         .join(models.AwardedConsoleAchievement.achievement)
         .where(models.AwardedConsoleAchievement.profile_address == address)
+    )
+
+
+@router.get(
+    '/agg/profile/{address}/console_achievements',
+    dependencies=[
+        cache_response('profile:{address}', 'console_achievements'),
+        query_budget(2),
+    ],
+)
+async def get_profile_achievements(
+    address: str,
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
+) -> LimitOffsetPage[AchievementResponse]:
+    query = (
+        _achievements_query(address.lower())
         .order_by(models.AwardedConsoleAchievement.created_at.desc())
     )
-    return paginate(session, query)
+    blobs = BlobLoader() if include_images else None
+    page = await paginate(
+        session,
+        query,
+        transformer=lambda rows: _with_images(rows, AchievementResponse,
+                                              blobs),
+    )
+    if blobs is not None:
+        await blobs.load()
+    return page
+
+
+@router.get(
+    '/agg/profile/{address}/console_achievements/cursor',
+    dependencies=[
+        cache_response('profile:{address}', 'console_achievements'),
+        query_budget(1),
+    ],
+)
+async def get_profile_achievements_by_cursor(
+    address: str,
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    params: CursorParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> CursorPage[AchievementResponse]:
+    blobs = BlobLoader() if include_images else None
+    page = await keyset_paginate(
+        session,
+        _achievements_query(address.lower()),
+        [
+            models.AwardedConsoleAchievement.created_at,
+            models.AwardedConsoleAchievement.id,
+        ],
+        params,
+        transformer=lambda rows: _with_images(rows, AchievementResponse,
+                                              blobs),
+    )
+    if blobs is not None:
+        await blobs.load()
+    return page
 
 
 class SummarizedConsoleAchievement(BaseModel):
@@ -217,8 +417,9 @@ class SummarizedConsoleAchievement(BaseModel):
     count: int
     name: str | None
     description: str | None
-    image_data: bytes | None
+    image_data: bytes | None = None
     image_type: str | None
+    image_url: str | None = None
 
     @field_serializer('image_data', when_used='json-unless-none')
     def serialize_image_data(self, value: bytes, _info):
@@ -227,10 +428,16 @@ class SummarizedConsoleAchievement(BaseModel):
 
 @router.get(
     '/agg/profile/{address}/console_achievements_summary',
+    dependencies=[
+        cache_response('profile:{address}', 'console_achievements'),
+        query_budget(2),
+    ],
 )
-def get_profile_achievements_summary(
+async def get_profile_achievements_summary(
     address: str,
-    session: Session = Depends(get_session),
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ) -> LimitOffsetPage[SummarizedConsoleAchievement]:
     address = address.lower()
     cte = (
@@ -259,23 +466,39 @@ def get_profile_achievements_summary(
             cte,
             models.ConsoleAchievement.name,
             models.ConsoleAchievement.description,
-            models.ConsoleAchievement.image_data,
+            models.ConsoleAchievement.image_hash,
             models.ConsoleAchievement.image_type,
         )
         .join(models.ConsoleAchievement)
         .order_by(cte.c.latest.desc())
     )
 
-    return paginate(session, query)
+    blobs = BlobLoader() if include_images else None
+    page = await paginate(
+        session,
+        query,
+        transformer=lambda rows: _with_images(
+            rows, SummarizedConsoleAchievement, blobs,
+        ),
+    )
+    if blobs is not None:
+        await blobs.load()
+    return page
 
 
 @router.put(
     '/agg_rw/profile',
+    dependencies=[query_budget(4)],
     summary='Create or do Partial Update on a Profile record',
     response_model=models.Profile,
 )
-def create_or_update_profile(
-    profile: models.Profile,
-    session: Session = Depends(get_session),
+async def create_or_update_profile(
+    profile: models.Validated[models.Profile],
+    session: AsyncSession = Depends(get_write_session),
 ):
-    return create_or_update(profile, session)
+    profile = await async_create_or_update(profile, session, commit=False)
+    await session.run_sync(ensure_profile_stats, profile.address)
+
+    await session.commit()
+    await invalidate(profile_tag(profile.address), 'leaderboard')
+    return profile
@@ -4,18 +4,59 @@ Routes for rule handling
 import base64
 import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, Response, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
 from pydantic import BaseModel, field_validator, field_serializer
-from sqlmodel import Session, select, exists
+from sqlalchemy.orm import load_only, selectinload
+from sqlmodel import select, update, exists, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..blob_store import BlobLoader
+from ..cache import cache_response, etag_for, invalidate, not_modified
 from ..db import models
-from ..db.session import get_session, create_or_update
-from ..file_signatures import guess_mime_type
-from .console_achievements import ConsoleAchievementAPI
+from ..db.pagination import CursorPage, CursorParams, keyset_paginate
+from ..db.session import (
+    async_create_or_update,
+    get_read_session,
+    get_write_session,
+)
+from ..images import (
+    DEFAULT_SIZE,
+    SIZE_DESCRIPTION,
+    ImageSize,
+    StoredImage,
+    accepts_webp,
+    decode_image_data,
+    image_response,
+    process_image,
+    process_upload,
+    rendition_query,
+    save_renditions,
+)
+from ..instrumentation import query_budget
+from .console_achievements import (
+    INCLUDE_IMAGES_DESCRIPTION,
+    ConsoleAchievementAPI,
+)
+from .profile import Tape
 
 router = APIRouter(tags=['rule'])
 
 
+def sponsor_image_url_for(rule_id: str, image_hash: str | None) -> str | None:
+    """URL of the sponsor image route of a rule, if it has one"""
+    if image_hash is None:
+        return None
+    return f'/agg/rule/{rule_id}/sponsor_image'
+
+
 class RuleInput(BaseModel):
     id: str
     name: str | None = None
@@ -32,6 +73,7 @@ class RuleInput(BaseModel):
     sponsor_name: str | None = None
     sponsor_image_data: bytes | None = None
     sponsor_image_type: str | None = None
+    sponsor_image_url: str | None = None
 
     prize: str | None = None
 
@@ -42,32 +84,59 @@ class RuleInput(BaseModel):
             return
         if isinstance(value, bytes):
             return value
-        return base64.b64decode(value)
+        return decode_image_data(value)
 
     @field_serializer('sponsor_image_data', when_used='json-unless-none')
     def serialize_image_data(self, value: bytes, _info):
         return base64.b64encode(value)
 
+    @classmethod
+    def from_model(cls, rule: models.Rule):
+        return cls(
+            **rule.model_dump(exclude={'sponsor_image_hash'}),
+            sponsor_image_url=sponsor_image_url_for(
+                rule.id, rule.sponsor_image_hash,
+            ),
+        )
+
+    def to_model(self, image: StoredImage | None = None) -> models.Rule:
+        """Build the database record
+
+        ``image`` is the result of :func:`process_image` on
+        ``sponsor_image_data``.
+        """
+        data = self.model_dump(
+            exclude_unset=True,
+            exclude={'sponsor_image_data', 'sponsor_image_url'},
+        )
+
+        if image is not None:
+            data['sponsor_image_hash'] = image.hash
+            if self.sponsor_image_type is None:
+                data['sponsor_image_type'] = image.mime_type
+
+        return models.Rule.model_validate(data)
+
 
 @router.put(
     '/agg_rw/rule',
+    dependencies=[query_budget(5)],
     summary='Create or update a rule',
     response_model=RuleInput,
 )
-def create_or_update_rule(
+async def create_or_update_rule(
     rule: RuleInput,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
     if rule.cartridge_id is not None:
-        create_or_update(models.Cartridge(id=rule.cartridge_id), session)
+        await async_create_or_update(models.Cartridge(id=rule.cartridge_id),
+                                     session)
 
-    if (
-        (rule.sponsor_image_data is not None)
-        and (rule.sponsor_image_type is None)
-    ):
-        rule.sponsor_image_type = guess_mime_type(rule.sponsor_image_data)
-    rule_model = models.Rule.model_validate(rule)
-    return create_or_update(rule_model, session)
+    image = await process_image(rule.sponsor_image_data)
+    await session.run_sync(save_renditions, image)
+    rule_model = await async_create_or_update(rule.to_model(image), session)
+    await invalidate(f'rule:{rule_model.id}')
+    return RuleInput.from_model(rule_model)
 
 
 class RuleResponse(BaseModel):
@@ -84,6 +153,7 @@ class RuleResponse(BaseModel):
     sponsor_name: str | None = None
     sponsor_image_data: bytes | None = None
     sponsor_image_type: str | None = None
+    sponsor_image_url: str | None = None
 
     prize: str | None = None
 
@@ -94,27 +164,186 @@ class RuleResponse(BaseModel):
         return base64.b64encode(value)
 
 
+# Columns of the rule that RuleResponse shows as they are
+RULE_COLUMNS = [
+    'id', 'name', 'description', 'created_at', 'start', 'end',
+    'cartridge_id', 'sponsor_name', 'sponsor_image_type', 'prize',
+]
+
+
+def _rule_query(rule_id: str):
+    # Only the columns of the response, and the achievements in a second
+    # statement, which async sessions need since they can't lazy load
+    return (
+        select(models.Rule)
+        .where(models.Rule.id == rule_id)
+        .options(
+            load_only(
+                *(getattr(models.Rule, name) for name in RULE_COLUMNS),
+                models.Rule.sponsor_image_hash,
+                models.Rule.version,
+            ),
+            selectinload(models.Rule.achievements),
+        )
+    )
+
+
+def _rule_versions(rule_id: str):
+    # Links are never removed and versions only go up, so the count and the
+    # sum change whenever the achievements listed with the rule do
+    return (
+        select(
+            models.Rule.version,
+            func.count(models.ConsoleAchievement.slug),
+            func.coalesce(func.sum(models.ConsoleAchievement.version), 0),
+        )
+        .select_from(models.Rule)
+        .outerjoin(models.RuleConsoleAchievement)
+        .outerjoin(models.ConsoleAchievement)
+        .where(models.Rule.id == rule_id)
+        .group_by(models.Rule.id, models.Rule.version)
+    )
+
+
+def _rule_response(rule: models.Rule,
+                   blobs: BlobLoader | None) -> RuleResponse:
+    image_hash = rule.sponsor_image_hash
+    response = RuleResponse(
+        **{name: getattr(rule, name) for name in RULE_COLUMNS},
+        sponsor_image_url=sponsor_image_url_for(rule.id, image_hash),
+        achievements=[
+            ConsoleAchievementAPI.from_model(x, blobs)
+            for x in rule.achievements
+        ],
+    )
+    if blobs is not None:
+        blobs.embed(response, 'sponsor_image_data', image_hash)
+    return response
+
+
 @router.get(
     '/agg/rule/{rule_id}',
+    dependencies=[
+        cache_response('rule:{rule_id}', 'console_achievements'),
+        query_budget(3),
+    ],
     summary='Get details for a rule',
     response_model=RuleResponse,
 )
-def get_rule(
+async def get_rule(
     rule_id: str,
-    session: Session = Depends(get_session),
+    request: Request,
+    response: Response,
+    include_images: bool = Query(False,
+                                 description=INCLUDE_IMAGES_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ):
-    rule = session.get(models.Rule, rule_id)
+    # Images are part of the representation when they are included
+    if 'if-none-match' in request.headers:
+        # A single aggregate answers clients that are up to date, without
+        # loading the rule and its achievements
+        versions = (
+            await session.execute(_rule_versions(rule_id))
+        ).one_or_none()
+        if versions is None:
+            raise HTTPException(status_code=404, detail='Rule not found.')
+        unchanged = not_modified(request,
+                                 etag_for(*versions, int(include_images)))
+        if unchanged is not None:
+            return unchanged
+
+    rule = (await session.scalars(_rule_query(rule_id))).one_or_none()
     if rule is None:
         raise HTTPException(status_code=404, detail='Rule not found.')
-    return rule
+
+    # The same versions, as loaded
+    response.headers['etag'] = etag_for(
+        rule.version,
+        len(rule.achievements),
+        sum(x.version for x in rule.achievements),
+        int(include_images),
+    )
+    blobs = BlobLoader() if include_images else None
+    rule_response = _rule_response(rule, blobs)
+    if blobs is not None:
+        await blobs.load()
+    return rule_response
 
 
 class AddRuleConsoleAchievementLink(BaseModel):
     ca_slug: str
 
 
+def _leaderboard_items(rows):
+    return [
+        {
+            **row._asdict(),
+            'tape_id': row.id,
+            'creator': row.creator_address,
+        }
+        for row in rows
+    ]
+
+
+@router.get(
+    '/agg/rule/{rule_id}/tapes',
+    dependencies=[cache_response('rule:{rule_id}'), query_budget(2)],
+    summary='List the tapes of a rule by score',
+    description=(
+        'Tapes with the same score share a dense rank and are listed by '
+        'submission time, tapes without one last.'
+    ),
+)
+async def list_rule_tapes(
+    rule_id: str,
+    params: CursorParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> CursorPage[Tape]:
+    rule_exists = await session.scalar(
+        select(exists().where(models.Rule.id == rule_id))
+    )
+    if not rule_exists:
+        raise HTTPException(status_code=404, detail='Rule not found.')
+
+    n_collected = (
+        select(func.count())
+        .select_from(models.CollectedTapes)
+        .where(models.CollectedTapes.tape_id == models.Tape.id)
+        .scalar_subquery()
+    )
+    query = (
+        select(
+            models.Tape.id,
+            models.Tape.rule_id,
+            models.Tape.score,
+            models.Tape.creator_address,
+            models.Tape.title,
+            models.Tape.created_at,
+            models.Tape.buy_value,
+            models.Tape.sell_value,
+            models.Tape.rank,
+            n_collected.label('n_collected'),
+        )
+        .where(models.Tape.rule_id == rule_id)
+        .where(models.Tape.score.is_not(None))
+    )
+
+    return await keyset_paginate(
+        session,
+        query,
+        [
+            models.Tape.score,
+            models.Tape.created_at.asc(),
+            models.Tape.id.asc(),
+        ],
+        params,
+        transformer=_leaderboard_items,
+    )
+
+
 @router.put(
     '/agg_rw/rule/{rule_id}/achievement',
+    dependencies=[query_budget(5)],
     summary='Assign an achievement to this rule',
     response_model=models.RuleConsoleAchievement,
     description=(
@@ -122,65 +351,94 @@ class AddRuleConsoleAchievementLink(BaseModel):
         " the achievement must have already been created."
     )
 )
-def assign_achievement_rule(
+async def assign_achievement_rule(
     rule_id: str,
     link: AddRuleConsoleAchievementLink,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    ca_exists = session.exec(
+    ca_exists = await session.scalar(
         select(
             exists()
             .where(
                 models.ConsoleAchievement.slug == link.ca_slug)  # type:ignore
         )
-    ).one()
-    print(f'{ca_exists=}')
+    )
     if not ca_exists:
         raise HTTPException(status_code=404,
                             detail='Console Achievement not found.')
-    create_or_update(models.Rule(id=rule_id), session)
+    await async_create_or_update(models.Rule(id=rule_id), session)
     instance = models.RuleConsoleAchievement(
         rule_id=rule_id,
         ca_slug=link.ca_slug,
     )
-    return create_or_update(instance, session)
+    instance = await async_create_or_update(instance, session)
+    await invalidate(f'rule:{rule_id}')
+    return instance
 
 
 @router.get(
     '/agg/rule/{rule_id}/sponsor_image',
+    dependencies=[query_budget(1)],
     summary='Display sponsor image',
 )
-def get_sponsor_image(
+async def get_sponsor_image(
     rule_id: str,
-    session: Session = Depends(get_session),
+    request: Request,
+    size: ImageSize = Query(DEFAULT_SIZE, description=SIZE_DESCRIPTION),
+    session: AsyncSession = Depends(get_read_session),
 ):
-    result = session.get(models.Rule, rule_id)
+    query = (
+        rendition_query(
+            models.Rule.sponsor_image_hash,
+            models.Rule.sponsor_image_type,
+            size,
+            accepts_webp(request),
+        )
+        .where(models.Rule.id == rule_id)
+    )
+    result = (await session.execute(query)).one_or_none()
 
-    if result is None:
+    if result is None or result.source_hash is None:
         raise HTTPException(status_code=404, detail='Not Found')
 
-    return Response(content=result.sponsor_image_data,
-                    media_type=result.sponsor_image_type)
+    return image_response(request, result)
 
 
-@router.put('/agg_rw/rule/{rule_id}/sponsor_image')
-def upload_sponsor_image(
+@router.put(
+    '/agg_rw/rule/{rule_id}/sponsor_image',
+    dependencies=[query_budget(3)],
+)
+async def upload_sponsor_image(
     rule_id: str,
     uploaded: UploadFile,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_write_session),
 ):
-    # Get achievement
-    rule = session.get(models.Rule, rule_id)
-
+    # Checked before anything is stored, a 404 leaves no orphan blobs
+    rule = await session.scalar(
+        select(models.Rule.id).where(models.Rule.id == rule_id)
+    )
     if rule is None:
         raise HTTPException(status_code=404)
+    # No connection is held while the image is processed
+    await session.rollback()
+
+    image = await process_upload(uploaded)
+    await session.run_sync(save_renditions, image)
+
+    stmt = (
+        update(models.Rule)
+        .where(models.Rule.id == rule_id)
+        .values(
+            sponsor_image_hash=image.hash,
+            sponsor_image_type=image.mime_type,
+            version=models.Rule.version + 1,
+        )
+    )
+    result = await session.execute(stmt)
 
-    data = uploaded.file.read()
-    mime_type = guess_mime_type(data)
-
-    rule.sponsor_image_data = data
-    rule.sponsor_image_type = mime_type
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404)
 
-    session.add(rule)
-    session.commit()
+    await session.commit()
+    await invalidate(f'rule:{rule_id}')
     return {'status': 'Ok'}
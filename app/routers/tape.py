@@ -1,66 +1,133 @@
 """
 Routes for profile retrieval
 """
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
-from sqlmodel import Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..cache import (
+    cache_response,
+    etag_for,
+    invalidate,
+    not_modified,
+    profile_tag,
+    tag_response,
+)
 from ..db import models
-from ..db.session import get_session, create_or_update
+from ..db.session import (
+    async_create_or_update,
+    get_read_session,
+    get_write_session,
+)
+from ..db.stats import refresh_profile_stats, save_holding
+from ..db.tape_ranks import save_tape
+from ..instrumentation import query_budget
 
 router = APIRouter(tags=['tapes'])
 
 
 @router.put(
     '/agg_rw/tape',
+    dependencies=[query_budget(23)],
     summary='Create or update a tape',
     response_model=models.Tape,
 )
-def create_or_update_tape(
-    tape: models.Tape,
-    session: Session = Depends(get_session),
+async def create_or_update_tape(
+    tape: models.Validated[models.Tape],
+    session: AsyncSession = Depends(get_write_session),
 ):
     if tape.creator_address is not None:
-        create_or_update(models.Profile(address=tape.creator_address), session)
+        await async_create_or_update(
+            models.Profile(address=tape.creator_address),
+            session,
+        )
 
     if tape.rule_id is not None:
-        create_or_update(models.Rule(id=tape.rule_id), session)
+        await async_create_or_update(models.Rule(id=tape.rule_id), session)
 
-    return create_or_update(tape, session)
+    tape, old_rule_id, old_creator = await session.run_sync(save_tape, tape)
+    # A tape moved to another creator leaves the count of the previous one
+    creators = {tape.creator_address, old_creator} - {None}
+    for address in sorted(creators):
+        await session.run_sync(refresh_profile_stats, address)
+
+    await session.commit()
+
+    tags = {f'tape:{tape.id}', 'leaderboard'}
+    for rule_id in (tape.rule_id, old_rule_id):
+        if rule_id is not None:
+            tags.add(f'rule:{rule_id}')
+    tags.update(profile_tag(address) for address in creators)
+    await invalidate(*tags)
+    return tape
 
 
 @router.put(
     '/agg_rw/collected_tape',
+    dependencies=[query_budget(13)],
     summary='Create or update a collected tape',
     response_model=models.CollectedTapes,
 )
-def create_or_update_collected_tape(
-    collected_tape: models.CollectedTapes,
-    session: Session = Depends(get_session),
+async def create_or_update_collected_tape(
+    collected_tape: models.Validated[models.CollectedTapes],
+    session: AsyncSession = Depends(get_write_session),
 ):
-    create_or_update(
+    await async_create_or_update(
         models.Profile(address=collected_tape.profile_address),
         session,
     )
 
-    create_or_update(
+    tape = await async_create_or_update(
         models.Tape(id=collected_tape.tape_id),
         session,
     )
 
-    return create_or_update(collected_tape, session)
+    collected_tape = await session.run_sync(save_holding, collected_tape)
+    await session.run_sync(refresh_profile_stats,
+                           collected_tape.profile_address)
+
+    await session.commit()
+
+    # The rule leaderboard shows how many times its tapes were collected
+    tags = {
+        f'tape:{tape.id}',
+        profile_tag(collected_tape.profile_address),
+        'leaderboard',
+    }
+    if tape.rule_id is not None:
+        tags.add(f'rule:{tape.rule_id}')
+    await invalidate(*tags)
+    return collected_tape
+
 
 @router.get(
     '/agg/tape/{tape_id}',
+    dependencies=[cache_response('tape:{tape_id}'), query_budget(2)],
     summary='Get tape data',
     response_model=models.Tape,
 )
-def get_tape(
+async def get_tape(
     tape_id: str,
-    session: Session = Depends(get_session),
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_read_session),
 ):
-    tape = session.get(models.Tape, tape_id)
+    version = await session.scalar(
+        select(models.Tape.version).where(models.Tape.id == tape_id)
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail='Tape not found.')
+
+    unchanged = not_modified(request, etag_for(version))
+    if unchanged is not None:
+        return unchanged
+
+    tape = await session.get(models.Tape, tape_id)
     if tape is None:
         raise HTTPException(status_code=404, detail='Tape not found.')
+    # Tapes added to or leaving the rule move the rank of this one
+    if tape.rule_id is not None:
+        tag_response(request, f'rule:{tape.rule_id}')
+    response.headers['etag'] = etag_for(tape.version)
     return tape
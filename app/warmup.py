@@ -0,0 +1,161 @@
+"""
+Warm-up and readiness of a worker
+
+:func:`warm_up` runs on startup, before the worker takes traffic. It fills
+the connection pool and sends a sample of the hot read requests through the
+app, which compiles and caches their statements, builds their validators and
+serializers and builds the OpenAPI schema. :func:`check_ready` backs the
+``/ready`` probe.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+from sqlmodel import select
+
+from .config import settings
+from .db import models
+from .db.session import (
+    get_async_engine,
+    get_async_replicas,
+    get_engine,
+    get_replicas,
+    open_session,
+)
+
+
+logger = logging.getLogger(__name__)
+
+WARMUP_REQUESTS = [
+    '/agg/profile',
+    '/agg/profile/cursor',
+    '/agg/profile/{address}',
+    '/agg/profile/{address}/rank',
+    '/agg/profile/{address}/console_achievements',
+    '/agg/profile/{address}/console_achievements_summary',
+    '/agg/rule/{rule_id}',
+    '/agg/rule/{rule_id}/tapes',
+    '/agg/tape/{tape_id}',
+    '/agg/console_achievement',
+    '/agg/notifications/{address}',
+    '/agg/notifications/{address}/unread_count',
+]
+
+
+async def _fill_pool():
+    # Connections are held together, otherwise the pool hands out the same
+    # one every time. Replicas serve the reads, so they are filled too.
+    n = min(settings.warmup_connections, settings.db_pool_size)
+
+    if settings.db_async:
+        engines = [get_async_engine(), *get_async_replicas().engines]
+        async with contextlib.AsyncExitStack() as stack:
+            connections = await asyncio.gather(*(
+                stack.enter_async_context(engine.connect())
+                for engine in engines
+                for _ in range(n)
+            ))
+            for connection in connections:
+                await connection.execute(text('SELECT 1'))
+        return
+
+    def fill():
+        engines = [get_engine(), *get_replicas().engines]
+        with contextlib.ExitStack() as stack:
+            for engine in engines:
+                for _ in range(n):
+                    connection = stack.enter_context(engine.connect())
+                    connection.execute(text('SELECT 1'))
+
+    await run_in_threadpool(fill)
+
+
+async def _sample_path_params() -> dict[str, str]:
+    """Existing keys to warm up with, so the routes go past their 404"""
+    queries = {
+        'address': (
+            select(models.ProfileStats.address)
+            .order_by(models.ProfileStats.rives_points.desc())
+        ),
+        'rule_id': select(models.Rule.id),
+        'tape_id': select(models.Tape.id),
+    }
+    params = {}
+    async with open_session() as session:
+        for name, query in queries.items():
+            params[name] = await session.scalar(query.limit(1)) or '-'
+    return params
+
+
+async def warm_up(app: FastAPI):
+    """Get a worker ready to serve at full speed
+
+    Failures are logged rather than raised, the readiness probe reports
+    whatever is still wrong.
+    """
+    start = time.monotonic()
+    app.openapi()
+
+    try:
+        await _fill_pool()
+        params = await _sample_path_params()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://warmup') as client:
+            for path in WARMUP_REQUESTS:
+                await client.get(path.format(**params))
+    except Exception:
+        logger.exception('Warm-up failed')
+
+    logger.info('Warm-up done in %.2fs', time.monotonic() - start)
+
+
+def _pool_headroom() -> int | None:
+    engine = get_async_engine() if settings.db_async else get_engine()
+    pool = getattr(engine, 'sync_engine', engine).pool
+    if not hasattr(pool, 'checkedout'):
+        # SQLite pools don't have a fixed size
+        return None
+    capacity = settings.db_pool_size + settings.db_max_overflow
+    return capacity - pool.checkedout()
+
+
+async def _ping():
+    if settings.db_async:
+        async with get_async_engine().connect() as connection:
+            await connection.execute(text('SELECT 1'))
+        return
+
+    def ping():
+        with get_engine().connect() as connection:
+            connection.execute(text('SELECT 1'))
+
+    await run_in_threadpool(ping)
+
+
+async def check_ready() -> dict[str, str]:
+    """Problems that keep this worker from serving, if any
+
+    Returns
+    -------
+    dict[str, str]
+        Description of each failed check, empty when ready
+    """
+    problems = {}
+
+    headroom = _pool_headroom()
+    if headroom is not None and headroom < settings.ready_min_pool_headroom:
+        problems['pool'] = f'{headroom} connections left in the pool'
+    else:
+        # Only when a connection is free, or the probe would queue for one
+        try:
+            await asyncio.wait_for(_ping(), settings.ready_timeout)
+        except Exception as exc:
+            problems['database'] = repr(exc)
+
+    return problems
@@ -0,0 +1,3 @@
+"""
+Synthetic dataset and load driver for benchmarking the API
+"""
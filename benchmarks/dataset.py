@@ -0,0 +1,90 @@
+"""
+Sizes and identifiers of the synthetic benchmark dataset
+
+Identifiers are derived from the index of each record, so the load driver can
+address the records of a generated dataset without reading the database. Both
+must be given the same scale.
+"""
+import argparse
+import dataclasses
+import hashlib
+import random
+
+
+@dataclasses.dataclass(frozen=True)
+class Scale:
+    """Number of records of each table at scale 1"""
+    profiles: int = 10_000
+    cartridges: int = 200
+    rules: int = 1_000
+    console_achievements: int = 100
+    tapes: int = 50_000
+    collected_tapes: int = 50_000
+    collected_cartridges: int = 10_000
+    awards: int = 100_000
+    notifications: int = 50_000
+
+    def scaled(self, factor: float) -> 'Scale':
+        return Scale(**{
+            field.name: max(1, int(getattr(self, field.name) * factor))
+            for field in dataclasses.fields(self)
+        })
+
+
+def add_scale_arguments(parser: argparse.ArgumentParser):
+    """Add ``--scale`` and one override per table to a parser"""
+    parser.add_argument(
+        '--scale', type=float, default=1,
+        help='Multiplier of the default table sizes, 100 gives 1M profiles, '
+             '10M awards and 5M notifications',
+    )
+    for field in dataclasses.fields(Scale):
+        parser.add_argument(
+            f'--{field.name.replace("_", "-")}', type=int, default=None,
+            help=f'Number of {field.name.replace("_", " ")} '
+                 f'(default {field.default} times the scale)',
+        )
+
+
+def scale_from_args(args: argparse.Namespace) -> Scale:
+    scale = Scale().scaled(args.scale)
+    overrides = {
+        field.name: getattr(args, field.name)
+        for field in dataclasses.fields(Scale)
+        if getattr(args, field.name) is not None
+    }
+    return dataclasses.replace(scale, **overrides)
+
+
+def _digest(kind: str, i: int, size: int) -> str:
+    return hashlib.sha256(f'{kind}-{i}'.encode()).hexdigest()[:size]
+
+
+def profile_address(i: int) -> str:
+    return '0x' + _digest('profile', i, 40)
+
+
+def cartridge_id(i: int) -> str:
+    return _digest('cartridge', i, 64)
+
+
+def rule_id(i: int) -> str:
+    return _digest('rule', i, 64)
+
+
+def tape_id(i: int) -> str:
+    return _digest('tape', i, 64)
+
+
+def console_achievement_slug(i: int) -> str:
+    return f'achievement-{i}'
+
+
+def pick(rng: random.Random, n: int) -> int:
+    """Pick an index in ``range(n)``, favouring the lowest ones
+
+    Activity on the platform is skewed: a few players, tapes and rules get
+    most of the traffic. Cubing a uniform sample gives about a third of the
+    picks to the first 4% of the records.
+    """
+    return int(n * rng.random() ** 3)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Replay a mix of reads and writes against a running API
+
+Each client picks an operation by weight, fills its route template with
+records of the dataset made by ``benchmarks.generate``, and sends the
+request as soon as the previous one is answered. Latency and throughput are
+reported per route template. Give the driver the same scale and table sizes
+as the generator.
+
+Usage::
+
+    python -m benchmarks.driver --base-url http://localhost:8000 \\
+        --scale 100 --clients 64 --duration 60 --json results.json
+"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import random
+import time
+import uuid
+from collections.abc import Callable
+
+import httpx
+
+from .dataset import (
+    add_scale_arguments,
+    console_achievement_slug,
+    pick,
+    profile_address,
+    rule_id,
+    scale_from_args,
+    tape_id,
+)
+
+
+@dataclasses.dataclass
+class Operation:
+    method: str
+    route: str
+    weight: int
+    # Builds the path parameters and the request options
+    build: Callable[[random.Random, object], tuple[dict, dict]]
+    write: bool = False
+    # Reported instead of the method and route when set
+    name: str | None = None
+
+    @property
+    def key(self) -> str:
+        return self.name or f'{self.method} {self.route}'
+
+
+def _profile(rng, scale):
+    return {'address': profile_address(pick(rng, scale.profiles))}, {}
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+OPERATIONS = [
+    Operation('GET', '/agg/profile', 4, lambda rng, scale: ({}, {})),
+    Operation(
+        'GET', '/agg/profile', 1,
+        lambda rng, scale: ({}, {
+            'params': {'offset': rng.randrange(scale.profiles // 2 + 1)},
+        }),
+        name='GET /agg/profile?offset=<deep>',
+    ),
+    Operation('GET', '/agg/profile/cursor', 2, lambda rng, scale: ({}, {})),
+    Operation('GET', '/agg/profile/{address}', 15, _profile),
+    Operation('GET', '/agg/profile/{address}/console_achievements', 8,
+              _profile),
+    Operation('GET', '/agg/profile/{address}/console_achievements_summary',
+              5, _profile),
+    Operation('GET', '/agg/notifications/{address}', 12, _profile),
+    Operation('GET', '/agg/notifications/{address}/cursor', 4, _profile),
+    Operation(
+        'GET', '/agg/tape/{tape_id}', 10,
+        lambda rng, scale: (
+            {'tape_id': tape_id(pick(rng, scale.tapes))}, {}
+        ),
+    ),
+    Operation(
+        'GET', '/agg/rule/{rule_id}', 8,
+        lambda rng, scale: (
+            {'rule_id': rule_id(pick(rng, scale.rules))}, {}
+        ),
+    ),
+    Operation(
+        'GET', '/agg/rule/{rule_id}/tapes', 10,
+        lambda rng, scale: (
+            {'rule_id': rule_id(pick(rng, scale.rules))}, {}
+        ),
+    ),
+    Operation('GET', '/agg/console_achievement', 2,
+              lambda rng, scale: ({}, {})),
+    Operation(
+        'GET', '/agg/console_achievement/{slug}/players', 4,
+        lambda rng, scale: ({
+            'slug': console_achievement_slug(
+                pick(rng, scale.console_achievements)
+            ),
+        }, {}),
+    ),
+    Operation(
+        'PUT', '/agg_rw/notifications', 5,
+        lambda rng, scale: ({}, {'json': {
+            'profile_address': profile_address(pick(rng, scale.profiles)),
+            'created_at': _now(),
+            'title': 'Benchmark',
+            'message': 'Benchmark notification',
+            'url': 'https://rives.io',
+        }}),
+        write=True,
+    ),
+    Operation(
+        'POST', '/agg_rw/awarded_console_achievement', 5,
+        lambda rng, scale: ({}, {'json': {
+            'profile_address': profile_address(pick(rng, scale.profiles)),
+            'ca_slug': console_achievement_slug(
+                pick(rng, scale.console_achievements)
+            ),
+            'points': rng.choice((1, 5, 10, 50, 100)),
+            'tape_id': tape_id(pick(rng, scale.tapes)),
+        }}),
+        write=True,
+    ),
+    Operation(
+        'PUT', '/agg_rw/tape', 3,
+        lambda rng, scale: ({}, {'json': {
+            'id': uuid.UUID(int=rng.getrandbits(128)).hex,
+            'score': rng.randrange(100_000),
+            'creator_address': profile_address(pick(rng, scale.profiles)),
+            'rule_id': rule_id(pick(rng, scale.rules)),
+        }}),
+        write=True,
+    ),
+    Operation(
+        'PUT', '/agg_rw/collected_tape', 3,
+        lambda rng, scale: ({}, {'json': {
+            'tape_id': tape_id(pick(rng, scale.tapes)),
+            'profile_address': profile_address(pick(rng, scale.profiles)),
+            'contract_address': '0x' + '0' * 40,
+            'asset_id': None,
+            'ballance': rng.randrange(1, 10),
+        }}),
+        write=True,
+    ),
+]
+
+
+@dataclasses.dataclass
+class RouteStats:
+    latencies: list[float] = dataclasses.field(default_factory=list)
+    errors: int = 0
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return float('nan')
+    index = max(0, min(len(values) - 1, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def client_loop(client: httpx.AsyncClient, operations, scale,
+                      rng: random.Random, deadline: float, stats: dict):
+    weights = [op.weight for op in operations]
+    while time.monotonic() < deadline:
+        op = rng.choices(operations, weights)[0]
+        path_params, options = op.build(rng, scale)
+
+        start = time.monotonic()
+        try:
+            response = await client.request(
+                op.method, op.route.format(**path_params), **options
+            )
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        elapsed = time.monotonic() - start
+
+        route_stats = stats.setdefault(op.key, RouteStats())
+        if failed:
+            route_stats.errors += 1
+        else:
+            route_stats.latencies.append(elapsed)
+
+
+async def run_load(args, operations, scale, duration: float) -> dict:
+    stats = {}
+    limits = httpx.Limits(max_connections=args.clients)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits,
+                                 timeout=60) as client:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(
+            client_loop(client, operations, scale,
+                        random.Random(f'{args.seed}-{i}'), deadline, stats)
+            for i in range(args.clients)
+        ))
+    return stats
+
+
+def summarize(stats: dict, duration: float) -> list[dict]:
+    rows = []
+    everything = RouteStats()
+    for route_stats in stats.values():
+        everything.latencies.extend(route_stats.latencies)
+        everything.errors += route_stats.errors
+    for key, route_stats in [*sorted(stats.items()), ('total', everything)]:
+        latencies = sorted(route_stats.latencies)
+        rows.append({
+            'route': key,
+            'requests': len(latencies),
+            'errors': route_stats.errors,
+            'rps': len(latencies) / duration,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+        })
+    return rows
+
+
+def print_report(rows: list[dict]):
+    width = max(len(row['route']) for row in rows)
+    print(f'{"route":<{width}} {"req":>8} {"req/s":>9} {"p50 ms":>8} '
+          f'{"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for row in rows:
+        print(f'{row["route"]:<{width}} {row["requests"]:>8} '
+              f'{row["rps"]:>9.1f} {row["p50"]:>8.1f} {row["p95"]:>8.1f} '
+              f'{row["p99"]:>8.1f} {row["errors"]:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_scale_arguments(parser)
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='Seconds of load before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--read-only', action='store_true',
+                        help='Leave out the /agg_rw writes')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    scale = scale_from_args(args)
+    operations = [
+        op for op in OPERATIONS if not (args.read_only and op.write)
+    ]
+
+    if args.warmup > 0:
+        asyncio.run(run_load(args, operations, scale, args.warmup))
+    stats = asyncio.run(run_load(args, operations, scale, args.duration))
+
+    rows = summarize(stats, args.duration)
+    print(f'{args.clients} clients for {args.duration:.0f}s against '
+          f'{args.base_url}')
+    print_report(rows)
+
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump({
+                'clients': args.clients,
+                'duration': args.duration,
+                'scale': dataclasses.asdict(scale),
+                'routes': rows,
+            }, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""
+Gunicorn settings, driven by the app settings (WEB_WORKERS etc.)
+"""
+import os
+
+from app.config import settings
+
+
+bind = settings.web_bind
+workers = settings.web_workers
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = settings.web_preload
+accesslog = '-'
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of dead workers in multiprocess mode
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,50 @@
+"""Add indexes for the filters and orderings of the read routes
+
+Revision ID: 2b7e4f9a1c3d
+Revises: 9f2c47b1e8a6
+Create Date: 2026-10-18 14:02:51.334870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7e4f9a1c3d'
+down_revision = '9f2c47b1e8a6'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_notification_profile_address_created_at', 'notification',
+     ['profile_address', 'created_at', 'id']),
+    ('ix_awardedconsoleachievement_profile_address_created_at',
+     'awardedconsoleachievement', ['profile_address', 'created_at', 'id']),
+    ('ix_awardedconsoleachievement_ca_slug_created_at',
+     'awardedconsoleachievement', ['ca_slug', 'created_at', 'id']),
+    ('ix_tape_creator_address', 'tape', ['creator_address']),
+    ('ix_tape_rule_id', 'tape', ['rule_id']),
+    ('ix_cartridge_creator_address', 'cartridge', ['creator_address']),
+    ('ix_collectedtapes_profile_address', 'collectedtapes',
+     ['profile_address']),
+    ('ix_collectedcartridges_profile_address', 'collectedcartridges',
+     ['profile_address']),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, but it keeps
+    # the tables writable while the indexes are built
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
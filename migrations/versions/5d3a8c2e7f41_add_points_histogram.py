@@ -0,0 +1,39 @@
+"""Add points histogram
+
+Revision ID: 5d3a8c2e7f41
+Revises: 2b7e4f9a1c3d
+Create Date: 2026-10-18 15:27:06.581912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '5d3a8c2e7f41'
+down_revision = '2b7e4f9a1c3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('pointshistogram',
+    sa.Column('rives_points', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('n_profiles', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('rives_points')
+    )
+
+    op.execute(
+        """
+        INSERT INTO pointshistogram (rives_points, n_profiles)
+        SELECT rives_points, count(*)
+        FROM profilestats
+        WHERE rives_points <> 0
+        GROUP BY rives_points
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('pointshistogram')
@@ -0,0 +1,58 @@
+"""Add tape rank
+
+Revision ID: 8e1f6b0c4a92
+Revises: 5d3a8c2e7f41
+Create Date: 2026-10-18 16:48:13.902144
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '8e1f6b0c4a92'
+down_revision = '5d3a8c2e7f41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('tape', sa.Column('rank', sa.Integer(), nullable=True))
+
+    op.execute(
+        """
+        UPDATE tape
+        SET rank = ranked.rank
+        FROM (
+            SELECT
+                id,
+                dense_rank() OVER (
+                    PARTITION BY rule_id ORDER BY score DESC
+                ) AS rank
+            FROM tape
+            WHERE rule_id IS NOT NULL AND score IS NOT NULL
+        ) AS ranked
+        WHERE tape.id = ranked.id
+        """
+    )
+
+    # The new index starts with rule_id, so it replaces the old one
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tape_rule_id_score', 'tape',
+            ['rule_id', sa.text('score DESC'), 'created_at', 'id'],
+            unique=False, postgresql_concurrently=True,
+        )
+        op.drop_index('ix_tape_rule_id', table_name='tape',
+                      postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_tape_rule_id', 'tape', ['rule_id'],
+                        unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_tape_rule_id_score', table_name='tape',
+                      postgresql_concurrently=True)
+
+    op.drop_column('tape', 'rank')
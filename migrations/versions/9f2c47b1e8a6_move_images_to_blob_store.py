@@ -0,0 +1,97 @@
+"""Move images to blob store
+
+Revision ID: 9f2c47b1e8a6
+Revises: c5e1a9d03f7b
+Create Date: 2026-10-18 11:03:17.402951
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+from app.blob_store import get_blob_store
+from app.config import settings
+
+
+# revision identifiers, used by Alembic.
+revision = '9f2c47b1e8a6'
+down_revision = 'c5e1a9d03f7b'
+branch_labels = None
+depends_on = None
+
+
+# (table, primary key, data column, hash column)
+IMAGE_COLUMNS = [
+    ('consoleachievement', 'slug', 'image_data', 'image_hash'),
+    ('rule', 'id', 'sponsor_image_data', 'sponsor_image_hash'),
+]
+
+
+def _check_online():
+    if op.get_context().as_sql:
+        raise RuntimeError(
+            'This migration moves data to the blob store and must run online'
+        )
+
+
+def _check_persistent_store():
+    # The images only survive in the store once their columns are dropped,
+    # a relative path would put them in the container's writable layer
+    if settings.blob_store_backend == 'local' \
+            and not os.path.isabs(settings.blob_store_path):
+        raise RuntimeError(
+            'This migration moves images out of the database, set '
+            'BLOB_STORE_PATH to an absolute path on persistent storage, '
+            f'not {settings.blob_store_path!r}'
+        )
+
+
+def upgrade() -> None:
+    _check_online()
+    _check_persistent_store()
+    conn = op.get_bind()
+    store = get_blob_store()
+
+    for table, pk, data_column, hash_column in IMAGE_COLUMNS:
+        op.add_column(table, sa.Column(hash_column, sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+        # Fetch one image at a time to keep memory usage bounded
+        keys = conn.execute(sa.text(
+            f'SELECT {pk} FROM {table} WHERE {data_column} IS NOT NULL'
+        )).scalars().all()
+
+        for key in keys:
+            data = conn.execute(
+                sa.text(f'SELECT {data_column} FROM {table} WHERE {pk} = :key'),
+                {'key': key},
+            ).scalar_one()
+            conn.execute(
+                sa.text(f'UPDATE {table} SET {hash_column} = :hash WHERE {pk} = :key'),
+                {'hash': store.put(bytes(data)), 'key': key},
+            )
+
+        op.drop_column(table, data_column)
+
+
+def downgrade() -> None:
+    _check_online()
+    conn = op.get_bind()
+    store = get_blob_store()
+
+    for table, pk, data_column, hash_column in IMAGE_COLUMNS:
+        op.add_column(table, sa.Column(data_column, sa.LargeBinary(), nullable=True))
+
+        rows = conn.execute(sa.text(
+            f'SELECT {pk}, {hash_column} FROM {table} '
+            f'WHERE {hash_column} IS NOT NULL'
+        )).all()
+
+        for key, image_hash in rows:
+            conn.execute(
+                sa.text(f'UPDATE {table} SET {data_column} = :data WHERE {pk} = :key'),
+                {'data': store.read(image_hash), 'key': key},
+            )
+
+        op.drop_column(table, hash_column)
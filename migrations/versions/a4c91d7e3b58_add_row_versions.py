@@ -0,0 +1,32 @@
+"""Add row versions
+
+Revision ID: a4c91d7e3b58
+Revises: 8e1f6b0c4a92
+Create Date: 2026-10-18 18:05:27.431906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c91d7e3b58'
+down_revision = '8e1f6b0c4a92'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['tape', 'cartridge', 'profilestats', 'rule', 'consoleachievement']
+
+
+def upgrade() -> None:
+    # A constant default doesn't rewrite the table
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(),
+                                       nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.drop_column(table, 'version')
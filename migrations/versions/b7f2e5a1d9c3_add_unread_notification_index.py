@@ -0,0 +1,34 @@
+"""Add unread notification index
+
+Revision ID: b7f2e5a1d9c3
+Revises: a4c91d7e3b58
+Create Date: 2026-10-18 18:41:52.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7f2e5a1d9c3'
+down_revision = 'a4c91d7e3b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_notification_profile_address_unread', 'notification',
+            ['profile_address'], unique=False,
+            postgresql_where=sa.text('unread'),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_notification_profile_address_unread',
+                      table_name='notification',
+                      postgresql_concurrently=True)
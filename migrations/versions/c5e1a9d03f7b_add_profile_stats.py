@@ -0,0 +1,67 @@
+"""Add profile stats
+
+Revision ID: c5e1a9d03f7b
+Revises: 7b8d8135feae
+Create Date: 2026-10-18 09:12:40.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e1a9d03f7b'
+down_revision = '7b8d8135feae'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('profilestats',
+    sa.Column('address', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('n_tapes_collected', sa.Integer(), nullable=False),
+    sa.Column('n_cartridges_collected', sa.Integer(), nullable=False),
+    sa.Column('n_tapes_created', sa.Integer(), nullable=False),
+    sa.Column('n_cartridges_created', sa.Integer(), nullable=False),
+    sa.Column('n_console_achievements', sa.Integer(), nullable=False),
+    sa.Column('rives_points', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['address'], ['profile.address'], ),
+    sa.PrimaryKeyConstraint('address')
+    )
+    op.create_index('ix_profilestats_rives_points', 'profilestats', ['rives_points', 'address'], unique=False)
+
+    # Backfill the counters of existing profiles
+    op.execute(
+        """
+        INSERT INTO profilestats (
+            address,
+            n_tapes_collected,
+            n_cartridges_collected,
+            n_tapes_created,
+            n_cartridges_created,
+            n_console_achievements,
+            rives_points
+        )
+        SELECT
+            p.address,
+            (SELECT count(*) FROM collectedtapes c
+             WHERE c.profile_address = p.address),
+            (SELECT count(*) FROM collectedcartridges c
+             WHERE c.profile_address = p.address),
+            (SELECT count(*) FROM tape t
+             WHERE t.creator_address = p.address),
+            (SELECT count(*) FROM cartridge c
+             WHERE c.creator_address = p.address),
+            (SELECT count(*) FROM awardedconsoleachievement a
+             WHERE a.profile_address = p.address),
+            (SELECT coalesce(sum(a.points), 0) FROM awardedconsoleachievement a
+             WHERE a.profile_address = p.address)
+        FROM profile p
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_profilestats_rives_points', table_name='profilestats')
+    op.drop_table('profilestats')
@@ -0,0 +1,33 @@
+"""Add image renditions
+
+Revision ID: d3f8a2c61e94
+Revises: b7f2e5a1d9c3
+Create Date: 2026-10-18 21:12:40.118374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f8a2c61e94'
+down_revision = 'b7f2e5a1d9c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('imagerendition',
+    sa.Column('source_hash', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('size', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('mime_type', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('width', sa.Integer(), nullable=False),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('blob_hash', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.PrimaryKeyConstraint('source_hash', 'size', 'mime_type')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('imagerendition')
@@ -0,0 +1,57 @@
+"""Add portfolio value
+
+Revision ID: e6b4c7d25a13
+Revises: d3f8a2c61e94
+Create Date: 2026-10-18 22:31:07.541862
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b4c7d25a13'
+down_revision = 'd3f8a2c61e94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('profilestats',
+                  sa.Column('portfolio_value', sa.BigInteger(),
+                            nullable=False, server_default='0'))
+
+    # Backfill the value of existing holdings, only once
+    op.execute(
+        """
+        UPDATE profilestats
+        SET portfolio_value = (
+            SELECT coalesce(sum(CAST(c.ballance AS BIGINT) * t.sell_value), 0)
+            FROM collectedtapes c
+            JOIN tape t ON t.id = c.tape_id
+            WHERE c.profile_address = profilestats.address
+        ) + (
+            SELECT coalesce(sum(CAST(c.balance AS BIGINT) * k.sell_value), 0)
+            FROM collectedcartridges c
+            JOIN cartridge k ON k.id = c.cartridge_id
+            WHERE c.profile_address = profilestats.address
+        )
+        """
+    )
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_profilestats_portfolio_value', 'profilestats',
+            ['portfolio_value', 'address'],
+            unique=False, postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_profilestats_portfolio_value',
+                      table_name='profilestats',
+                      postgresql_concurrently=True)
+
+    op.drop_column('profilestats', 'portfolio_value')
@@ -0,0 +1,66 @@
+"""
+Fixtures running the API against a throwaway SQLite database
+
+Every request is checked against the statement budget of its route, so a
+route going over its budget fails the test that called it.
+"""
+import io
+import os
+import tempfile
+
+# Settings are read on import, they must be set before the app is imported
+DATA_DIR = tempfile.mkdtemp(prefix='aggregator-tests-')
+os.environ.update(
+    DB_URL=f'sqlite:///{DATA_DIR}/aggregator.db',
+    DB_REPLICA_URLS='[]',
+    BLOB_STORE_PATH=f'{DATA_DIR}/blobs',
+    QUERY_BUDGET_MODE='raise',
+    CACHE_BACKEND='memory',
+    BROKER_BACKEND='memory',
+    WARMUP='false',
+)
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from PIL import Image  # noqa: E402
+from sqlmodel import SQLModel  # noqa: E402
+
+from app.cache import get_cache  # noqa: E402
+from app.config import settings  # noqa: E402
+from app.db.session import get_engine  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_client():
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(params=[True, False], ids=['async', 'sync'])
+def client(request, app_client, monkeypatch):
+    """Client of the API on empty tables and an empty response cache
+
+    Runs the test once with the async driver and once with the sync one.
+    """
+    monkeypatch.setattr(settings, 'db_async', request.param)
+
+    engine = get_engine()
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    get_cache.cache_clear()
+
+    yield app_client
+
+
+def ok(response):
+    """The response, after checking it is not an error"""
+    assert response.status_code < 400, (response.status_code, response.text)
+    return response
+
+
+@pytest.fixture(scope='session')
+def png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
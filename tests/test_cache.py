@@ -0,0 +1,147 @@
+"""
+Cached responses and their invalidation by the writes
+"""
+import json
+
+from prometheus_client import REGISTRY
+
+from app.cache import get_cache
+from app.config import settings
+
+from .conftest import ok
+
+
+def _hits() -> float:
+    return REGISTRY.get_sample_value('response_cache_lookups_total',
+                                     {'result': 'hit'}) or 0
+
+
+def _tape(tape_id: str, score: int, **fields) -> dict:
+    return {'id': tape_id, 'rule_id': 'r1', 'creator_address': '0xa',
+            'score': score, 'created_at': '2024-01-01T00:00:00', **fields}
+
+
+def test_reads_are_cached(client):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+
+    hits = _hits()
+    first = ok(client.get('/agg/rule/r1')).json()
+    assert ok(client.get('/agg/rule/r1')).json() == first
+    assert _hits() == hits + 1
+
+    # Query parameters are part of the key
+    ok(client.get('/agg/rule/r1', params={'include_images': True}))
+    assert _hits() == hits + 1
+
+
+def test_writes_invalidate(client):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    ok(client.put('/agg_rw/tape', json=_tape('t1', 10)))
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    ok(client.put('/agg_rw/rule/r1/achievement', json={'ca_slug': 'ach'}))
+
+    ok(client.get('/agg/rule/r1/tapes'))
+    ok(client.post('/agg_rw/batch', content=json.dumps(
+        {'type': 'tape', 'data': _tape('t2', 20)}
+    )))
+    tapes = ok(client.get('/agg/rule/r1/tapes')).json()['items']
+    assert [x['tape_id'] for x in tapes] == ['t2', 't1']
+
+    ok(client.put('/agg_rw/collected_tape', json={
+        'tape_id': 't2', 'profile_address': '0xb',
+        'contract_address': '0x1', 'asset_id': '1', 'ballance': 1,
+    }))
+    tapes = ok(client.get('/agg/rule/r1/tapes')).json()['items']
+    assert tapes[0]['n_collected'] == 1
+
+    before = ok(client.get('/agg/profile/0xB')).json()
+    ok(client.post('/agg_rw/awarded_console_achievement', json={
+        'profile_address': '0xb', 'ca_slug': 'ach', 'points': 3,
+    }))
+    after = ok(client.get('/agg/profile/0xb')).json()
+    assert after['rives_points'] == before['rives_points'] + 3
+
+    ok(client.get('/agg/console_achievement/ach'))
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Renamed'}))
+    assert ok(client.get('/agg/console_achievement/ach')).json()['name'] \
+        == 'Renamed'
+    assert ok(client.get('/agg/rule/r1')).json()['achievements'][0]['name'] \
+        == 'Renamed'
+
+
+def test_notifications_only_invalidate_new_profiles(client):
+    ok(client.put('/agg_rw/profile', json={'address': '0xa'}))
+
+    def notify(address: str):
+        ok(client.put('/agg_rw/notifications', json={
+            'profile_address': address, 'message': 'Hello',
+            'created_at': '2024-01-01T00:00:00',
+        }))
+
+    ok(client.get('/agg/profile'))
+    hits = _hits()
+    notify('0xa')
+    ok(client.get('/agg/profile'))
+    assert _hits() == hits + 1
+
+    # A notification to an unknown address creates its profile
+    notify('0xb')
+    board = ok(client.get('/agg/profile')).json()['items']
+    assert {x['address'] for x in board} == {'0xa', '0xb'}
+    assert _hits() == hits + 1
+
+
+def test_conditional_reads(client):
+    ok(client.put('/agg_rw/profile', json={'address': '0xa'}))
+
+    etag = ok(client.get('/agg/profile/0xa')).headers['etag']
+    for _ in range(2):
+        # From the route, then from the cache
+        response = client.get('/agg/profile/0xa',
+                              headers={'if-none-match': etag})
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag
+
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    ok(client.post('/agg_rw/awarded_console_achievement', json={
+        'profile_address': '0xa', 'ca_slug': 'ach', 'points': 3,
+    }))
+    response = ok(client.get('/agg/profile/0xa',
+                             headers={'if-none-match': etag}))
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+
+def _statements(route: str) -> float:
+    return REGISTRY.get_sample_value('http_request_db_statements_sum', {
+        'method': 'GET', 'route': route,
+    }) or 0
+
+
+def test_conditional_rule_reads(client, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_backend', 'none')
+    get_cache.cache_clear()
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    ok(client.put('/agg_rw/rule/r1/achievement', json={'ca_slug': 'ach'}))
+
+    etag = ok(client.get('/agg/rule/r1')).headers['etag']
+    statements = _statements('/agg/rule/{rule_id}')
+    response = client.get('/agg/rule/r1', headers={'if-none-match': etag})
+    assert response.status_code == 304
+    # Answered from the versions alone
+    assert _statements('/agg/rule/{rule_id}') == statements + 1
+
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Renamed'}))
+    response = ok(client.get('/agg/rule/r1',
+                             headers={'if-none-match': etag}))
+    assert response.json()['achievements'][0]['name'] == 'Renamed'
+    assert response.headers['etag'] != etag
+
+    response = client.get('/agg/rule/nope', headers={'if-none-match': etag})
+    assert response.status_code == 404
@@ -0,0 +1,50 @@
+"""
+Images embedded in the responses that include them
+"""
+import base64
+
+from .conftest import ok
+
+
+def test_included_images(client, png):
+    upload = {'files': {'uploaded': ('image.png', png)}}
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    ok(client.put('/agg_rw/console_achievement/ach/image', **upload))
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    ok(client.put('/agg_rw/rule/r1/sponsor_image', **upload))
+    ok(client.put('/agg_rw/rule/r1/achievement', json={'ca_slug': 'ach'}))
+    for _ in range(2):
+        ok(client.post('/agg_rw/awarded_console_achievement', json={
+            'profile_address': '0xa', 'ca_slug': 'ach', 'points': 1,
+        }))
+
+    # The originals, the image routes may serve renditions of them
+    image = sponsor_image = png
+    params = {'include_images': True}
+
+    def images(path: str) -> list:
+        body = ok(client.get(path, params=params)).json()
+        return [
+            base64.b64decode(item['image_data'])
+            for item in body.get('items', [body])
+        ]
+
+    assert images('/agg/console_achievement') == [image]
+    assert images('/agg/console_achievement/ach') == [image]
+    assert images('/agg/profile/0xa/console_achievements') == [image] * 2
+    assert images('/agg/profile/0xa/console_achievements/cursor') \
+        == [image] * 2
+    assert images('/agg/profile/0xa/console_achievements_summary') \
+        == [image]
+
+    rule = ok(client.get('/agg/rule/r1', params=params)).json()
+    assert base64.b64decode(rule['sponsor_image_data']) == sponsor_image
+    assert [
+        base64.b64decode(x['image_data']) for x in rule['achievements']
+    ] == [image]
+
+    # Only URLs without the parameter
+    rule = ok(client.get('/agg/rule/r1')).json()
+    assert rule['sponsor_image_data'] is None
+    assert rule['sponsor_image_url'] == '/agg/rule/r1/sponsor_image'
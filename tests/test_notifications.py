@@ -0,0 +1,182 @@
+"""
+Notification state, broadcasts and streams
+"""
+import json
+import time
+
+from app.pubsub import get_broker
+from app.routers.notifications import _event_stream
+
+from .conftest import ok
+
+
+def _notify(client, address: str, message: str, **data):
+    return ok(client.put('/agg_rw/notifications', json={
+        'profile_address': address, 'message': message,
+        'created_at': '2024-01-01T00:00:00', **data,
+    })).json()
+
+
+def _unread(client, address: str) -> int:
+    return ok(
+        client.get(f'/agg/notifications/{address}/unread_count')
+    ).json()['unread']
+
+
+def test_mark_read(client):
+    ids = [_notify(client, '0xa', f'm{i}')['id'] for i in range(3)]
+    _notify(client, '0xb', 'other')
+    assert _unread(client, '0xa') == 3
+
+    def mark_read(address: str, notification_ids):
+        return ok(client.post(f'/agg/notifications/{address}/mark_read',
+                              json={'ids': notification_ids})).json()
+
+    # Read notifications and those of other profiles are left alone
+    assert mark_read('0xa', ids[:1]) == {'updated': 1}
+    assert mark_read('0xa', ids[:1]) == {'updated': 0}
+    assert mark_read('0xb', ids[1:]) == {'updated': 0}
+    assert _unread(client, '0xa') == 2
+
+    assert mark_read('0xA', 'all') == {'updated': 2}
+    assert _unread(client, '0xa') == 0
+    assert _unread(client, '0xb') == 1
+
+    # Following a notification marks it read
+    notification = _notify(client, '0xa', 'link', url='https://rives.io')
+    response = client.get(f'/agg/notifications/0xa/{notification["id"]}',
+                          follow_redirects=False)
+    assert response.headers['location'] == 'https://rives.io'
+    assert _unread(client, '0xa') == 0
+
+
+def _broadcast(client, audience: dict) -> int:
+    return ok(client.put('/agg_rw/notifications/broadcast', json={
+        'message': 'Hello', 'created_at': '2024-01-01T00:00:00',
+        'audience': audience,
+    })).json()['notified']
+
+
+def test_broadcast_audiences(client):
+    for address in ('0xa', '0xb', '0xc'):
+        ok(client.put('/agg_rw/profile', json={'address': address}))
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    for i, address in enumerate(['0xa', '0xa', '0xb']):
+        ok(client.put('/agg_rw/tape', json={
+            'id': f't{i}', 'rule_id': 'r1', 'creator_address': address,
+            'score': i,
+        }))
+    ok(client.put('/agg_rw/collected_cartridge', json={
+        'cartridge_id': 'c1', 'profile_address': '0xc',
+        'contract_address': '0x1', 'asset_id': '1', 'balance': 1,
+    }))
+
+    assert _broadcast(client, {'all': True}) == 3
+    # One notification per player, however many tapes
+    assert _broadcast(client, {'rule_id': 'r1'}) == 2
+    assert _broadcast(client, {'cartridge_id': 'c1'}) == 1
+    # Listed addresses get a profile if they have none
+    assert _broadcast(client, {'addresses': ['0xA', '0xd', '0xd']}) == 2
+
+    assert {
+        address: _unread(client, address)
+        for address in ('0xa', '0xb', '0xc', '0xd')
+    } == {'0xa': 3, '0xb': 2, '0xc': 2, '0xd': 1}
+    board = ok(client.get('/agg/profile')).json()['items']
+    assert '0xd' in {x['address'] for x in board}
+
+
+def test_broadcast_needs_one_audience(client):
+    for audience in ({}, {'all': True, 'rule_id': 'r1'}):
+        response = client.put('/agg_rw/notifications/broadcast', json={
+            'message': 'Hello', 'created_at': '2024-01-01T00:00:00',
+            'audience': audience,
+        })
+        assert response.status_code == 422
+
+
+async def _read_stream(address: str, last_event_id: int, received: list,
+                       n_events: int):
+    stream = _event_stream(address, last_event_id)
+    try:
+        async for chunk in stream:
+            event = dict(
+                line.split(': ', 1) for line in chunk.strip().split('\n')
+                if not line.startswith(':')
+            )
+            if 'data' in event:
+                received.append(json.loads(event['data']))
+            if len(received) == n_events:
+                return
+    finally:
+        await stream.aclose()
+
+
+def _stream(client, address: str, last_event_id: int, received: list,
+            n_events: int):
+    """Read a stream in the background, once it replayed its first event"""
+    reading = client.portal.start_task_soon(
+        _read_stream, address, last_event_id, received, n_events,
+    )
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert received
+    return reading
+
+
+def test_stream(client):
+    first = _notify(client, '0xa', 'first')
+
+    received = []
+    reading = _stream(client, '0xa', first['id'] - 1, received, 5)
+    try:
+        _notify(client, '0xA', 'second')
+        _notify(client, '0xb', 'not for 0xa')
+        _broadcast(client, {'addresses': ['0xa', '0xb']})
+        _broadcast(client, {'all': True})
+        ok(client.post('/agg_rw/batch', content=json.dumps({
+            'type': 'notification', 'data': {
+                'profile_address': '0xa', 'message': 'fourth',
+                'created_at': '2024-01-01T00:00:00',
+            },
+        })))
+
+        reading.result(timeout=5)
+    finally:
+        reading.cancel()
+    assert [x['message'] for x in received] == [
+        'first', 'second', 'Hello', 'Hello', 'fourth',
+    ]
+
+
+def test_stream_events_out_of_order(client):
+    first = _notify(client, '0xa', 'first')
+
+    received = []
+    reading = _stream(client, '0xa', first['id'] - 1, received, 3)
+    try:
+        # Committed in the opposite order of their ids, and repeated
+        later, earlier = (
+            ('0xa', {'id': first['id'] + i, 'message': f'm{i}'})
+            for i in (2, 1)
+        )
+        client.portal.call(get_broker().publish, [later, earlier, later])
+        reading.result(timeout=5)
+    finally:
+        reading.cancel()
+    assert [x['message'] for x in received] == ['first', 'm2', 'm1']
+
+
+def test_broadcasts_wake_their_recipients(client, monkeypatch):
+    broker = get_broker()
+    published = []
+    publish = broker.publish
+
+    async def record(events):
+        published.extend(address for address, _ in events)
+        await publish(events)
+
+    monkeypatch.setattr(broker, 'publish', record)
+    _broadcast(client, {'addresses': ['0xA', '0xb']})
+    assert published == ['0xa', '0xb']
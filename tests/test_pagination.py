@@ -0,0 +1,104 @@
+"""
+Keyset pages, walked to the end
+"""
+import datetime
+
+from sqlmodel import Session
+
+from app.db import models
+from app.db.session import get_engine
+
+from .conftest import ok
+
+
+def _walk(client, url: str, size: int = 2, **params) -> list[dict]:
+    """Items of every page, following the cursors"""
+    items, cursor = [], None
+    while True:
+        page = ok(client.get(url, params={
+            'size': size, **params, **({'cursor': cursor} if cursor else {}),
+        })).json()
+        items += page['items']
+        cursor = page['next_cursor']
+        if cursor is None:
+            return items
+
+
+def _award(client, address: str, points: int):
+    ok(client.post('/agg_rw/awarded_console_achievement', json={
+        'profile_address': address, 'ca_slug': 'ach', 'points': points,
+    }))
+
+
+def test_leaderboard_pages(client):
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    for i, points in enumerate([5, 10, 5, 0, 5, 20, 10]):
+        _award(client, f'0x{i}', points)
+
+    pages = {}
+    for sort_by in ('rives_points', 'portfolio_value'):
+        pages[sort_by] = _walk(client, '/agg/profile/cursor', sort_by=sort_by)
+        offset = ok(client.get('/agg/profile', params={
+            'sort_by': sort_by, 'limit': 50,
+        })).json()['items']
+        assert pages[sort_by] == offset
+
+    assert [x['rives_points'] for x in pages['rives_points']] == [
+        20, 10, 10, 5, 5, 5, 0,
+    ]
+    # All tied, by address
+    assert [x['address'] for x in pages['portfolio_value']] == [
+        f'0x{i}' for i in reversed(range(7))
+    ]
+
+
+def test_cursor_of_another_ordering(client):
+    for i in range(3):
+        ok(client.put('/agg_rw/profile', json={'address': f'0x{i}'}))
+
+    cursor = ok(client.get('/agg/profile/cursor',
+                           params={'size': 1})).json()['next_cursor']
+    assert ok(client.get('/agg/profile/cursor', params={
+        'size': 1, 'cursor': cursor,
+    }))
+    response = client.get('/agg/profile/cursor', params={
+        'size': 1, 'cursor': cursor, 'sort_by': 'portfolio_value',
+    })
+    assert response.status_code == 400
+
+    response = client.get('/agg/profile/cursor', params={'cursor': 'nope'})
+    assert response.status_code == 400
+
+
+def test_pages_through_null_keys(client):
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    with Session(get_engine()) as session:
+        for i in range(7):
+            session.add(models.Profile(address=f'0x{i}'))
+        session.flush()
+        for i in range(7):
+            session.add(models.AwardedConsoleAchievement(
+                profile_address=f'0x{i}', ca_slug='ach', points=1,
+                created_at=None if i % 2 else datetime.datetime(2024, 1, 1),
+            ))
+        session.commit()
+
+    url = '/agg/console_achievement/ach/players/cursor'
+    players = _walk(client, url)
+    assert players == ok(client.get(url, params={'size': 50})).json()['items']
+    assert len(players) == 7
+
+
+def test_notification_pages(client):
+    for i in range(5):
+        ok(client.put('/agg_rw/notifications', json={
+            'profile_address': '0xa', 'message': f'm{i}',
+            'created_at': f'2024-02-0{i % 2 + 1}T00:00:00',
+        }))
+
+    notifications = _walk(client, '/agg/notifications/0xa/cursor')
+    assert [x['message'] for x in notifications] == [
+        'm3', 'm1', 'm4', 'm2', 'm0',
+    ]
@@ -0,0 +1,117 @@
+"""
+Reads on a replica database, writes and pinned reads on the primary
+"""
+import pytest
+from sqlmodel import SQLModel, Session, create_engine
+
+from app.config import settings
+from app.db import models
+from app.db.session import (
+    PRIMARY_PIN_COOKIE,
+    get_async_replicas,
+    get_replicas,
+)
+
+from .conftest import ok
+
+
+def _use_replicas(client, monkeypatch, urls: list[str]):
+    monkeypatch.setattr(settings, 'db_replica_urls', urls)
+    get_replicas.cache_clear()
+    get_async_replicas.cache_clear()
+
+
+@pytest.fixture
+def replica(client, monkeypatch, tmp_path):
+    """Engine of a second SQLite database, the only read replica"""
+    url = f'sqlite:///{tmp_path}/replica.db'
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    _use_replicas(client, monkeypatch, [url])
+
+    yield engine
+
+    for replica_engine in get_async_replicas().engines:
+        client.portal.call(replica_engine.dispose)
+    _use_replicas(client, monkeypatch, [])
+    client.cookies.clear()
+
+
+def test_reads_go_to_the_replica(client, replica):
+    response = ok(client.put('/agg_rw/profile', json={'address': '0xa'}))
+    assert PRIMARY_PIN_COOKIE in response.cookies
+
+    # Not replicated, the replica has no such profile
+    client.cookies.clear()
+    assert client.get('/agg/profile/0xa').status_code == 404
+
+    client.cookies.set(PRIMARY_PIN_COOKIE, '1')
+    assert ok(client.get('/agg/profile/0xa')).json()['address'] == '0xa'
+
+
+def test_redirects_pin_the_client(client, replica):
+    notification = ok(client.put('/agg_rw/notifications', json={
+        'profile_address': '0xa', 'message': 'Hello',
+        'url': 'https://rives.io', 'created_at': '2024-01-01T00:00:00',
+    })).json()
+    client.cookies.clear()
+
+    # Marking it read is a write, even though the route returns a redirect
+    response = client.get(f'/agg/notifications/0xa/{notification["id"]}',
+                          follow_redirects=False)
+    assert response.headers['location'] == 'https://rives.io'
+    assert PRIMARY_PIN_COOKIE in response.cookies
+
+
+def _rename(replica, name: str):
+    with Session(replica) as session:
+        session.merge(models.Rule(id='r1', name=name))
+        session.commit()
+
+
+def test_lagging_replica_answers_are_not_cached(client, replica):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Old'}))
+    _rename(replica, 'Old')
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'New'}))
+
+    client.cookies.clear()
+    assert ok(client.get('/agg/rule/r1')).json()['name'] == 'Old'
+
+    client.cookies.set(PRIMARY_PIN_COOKIE, '1')
+    assert ok(client.get('/agg/rule/r1')).json()['name'] == 'New'
+
+    # Once the replica caught up, the stale answer is not served from cache
+    _rename(replica, 'New')
+    client.cookies.clear()
+    assert ok(client.get('/agg/rule/r1')).json()['name'] == 'New'
+
+
+def test_pinned_reads_skip_the_cache(client, replica, monkeypatch):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'New'}))
+    _rename(replica, 'Old')
+
+    # Cached right away, as if the write was long enough ago
+    monkeypatch.setattr(settings, 'db_primary_pin_seconds', 0)
+    client.cookies.clear()
+    for _ in range(2):
+        assert ok(client.get('/agg/rule/r1')).json()['name'] == 'Old'
+
+    client.cookies.set(PRIMARY_PIN_COOKIE, '1')
+    assert ok(client.get('/agg/rule/r1')).json()['name'] == 'New'
+
+
+def test_unreachable_replica(client, monkeypatch):
+    _use_replicas(client, monkeypatch,
+                  ['sqlite:////nonexistent/replica.db'])
+    try:
+        ok(client.put('/agg_rw/profile', json={'address': '0xa'}))
+        client.cookies.clear()
+
+        # Served by the primary instead, while the replica is left out
+        assert ok(client.get('/agg/profile/0xa')).json()['address'] == '0xa'
+        replicas = get_async_replicas() if settings.db_async \
+            else get_replicas()
+        assert replicas.pick() is None
+    finally:
+        _use_replicas(client, monkeypatch, [])
+        client.cookies.clear()
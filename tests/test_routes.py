@@ -0,0 +1,221 @@
+"""
+Every route, called within its statement budget
+"""
+import base64
+import json
+
+from fastapi.routing import APIRoute
+
+from app.config import settings
+from app.instrumentation import query_budget
+from app.main import app
+
+from .conftest import ok
+
+
+ADDRESS = '0xabc'
+COLLECTOR = '0xdef'
+
+# Endless, the notification tests read it directly
+STREAM_ROUTE = '/agg/notifications/{address}/stream'
+# Served by FastAPI itself
+DOCS_ROUTES = {'/agg/openapi.json', '/agg/docs', '/docs/oauth2-redirect',
+               '/docs'}
+# Routes of app.routers that may go without a statement budget
+UNBUDGETED_ROUTES = set()
+
+
+def _requests(png: bytes) -> list[tuple[str, str, dict, dict]]:
+    """Method, path template, path parameters and arguments of each request
+
+    In order, the writes first so that the reads find something.
+    """
+    path = {'address': ADDRESS, 'rule_id': 'r1', 'tape_id': 't1',
+            'slug': 'ach'}
+    image = base64.b64encode(png).decode()
+    upload = {'files': {'uploaded': ('image.png', png)}}
+
+    return [
+        ('PUT', '/agg_rw/profile', {}, {'json': {'address': ADDRESS}}),
+        ('PUT', '/agg_rw/cartridge', {}, {'json': {
+            'id': 'c1', 'name': 'Cartridge', 'creator_address': ADDRESS,
+            'sell_value': 10,
+        }}),
+        ('PUT', '/agg_rw/rule', {}, {'json': {
+            'id': 'r1', 'cartridge_id': 'c1', 'name': 'Rule',
+        }}),
+        ('PUT', '/agg_rw/tape', {}, {'json': {
+            'id': 't1', 'rule_id': 'r1', 'creator_address': ADDRESS,
+            'score': 10, 'sell_value': 5,
+        }}),
+        ('PUT', '/agg_rw/collected_tape', {}, {'json': {
+            'tape_id': 't1', 'profile_address': COLLECTOR,
+            'contract_address': '0x1', 'asset_id': '1', 'ballance': 2,
+        }}),
+        ('PUT', '/agg_rw/collected_cartridge', {}, {'json': {
+            'cartridge_id': 'c1', 'profile_address': COLLECTOR,
+            'contract_address': '0x1', 'asset_id': '1', 'balance': 1,
+        }}),
+        ('PUT', '/agg_rw/console_achievement', {}, {'json': {
+            'slug': 'ach', 'name': 'Achievement', 'points': 5,
+            'image_data': image,
+        }}),
+        ('POST', '/agg_rw/awarded_console_achievement', {}, {'json': {
+            'profile_address': ADDRESS, 'ca_slug': 'ach', 'points': 5,
+            'tape_id': 't1',
+        }}),
+        ('PUT', '/agg_rw/rule/{rule_id}/achievement', path,
+         {'json': {'ca_slug': 'ach'}}),
+        ('PUT', '/agg_rw/rule/{rule_id}/sponsor_image', path, upload),
+        ('PUT', '/agg_rw/console_achievement/{slug}/image', path, upload),
+        ('PUT', '/agg_rw/notifications', {}, {'json': {
+            'profile_address': ADDRESS, 'message': 'Hello',
+            'url': 'https://rives.io', 'created_at': '2024-01-01T00:00:00',
+        }}),
+        ('PUT', '/agg_rw/notifications/broadcast', {}, {'json': {
+            'message': 'Everyone', 'created_at': '2024-01-02T00:00:00',
+            'audience': {'addresses': [ADDRESS, COLLECTOR]},
+        }}),
+        ('POST', '/agg_rw/batch', {}, {'content': '\n'.join(
+            json.dumps(record) for record in [
+                {'type': 'profile', 'data': {'address': '0xbatch'}},
+                {'type': 'tape', 'data': {
+                    'id': 't2', 'rule_id': 'r1', 'creator_address': '0xbatch',
+                    'score': 20, 'created_at': '2024-01-01T00:00:00',
+                }},
+            ]
+        )}),
+        ('GET', '/agg/profile', {}, {}),
+        ('GET', '/agg/profile/cursor', {}, {}),
+        ('GET', '/agg/profile/{address}', path, {}),
+        ('GET', '/agg/profile/{address}/rank', path, {}),
+        ('GET', '/agg/profile/{address}/console_achievements', path,
+         {'params': {'include_images': True}}),
+        ('GET', '/agg/profile/{address}/console_achievements/cursor', path,
+         {}),
+        ('GET', '/agg/profile/{address}/console_achievements_summary', path,
+         {'params': {'include_images': True}}),
+        ('GET', '/agg/tape/{tape_id}', path, {}),
+        ('GET', '/agg/rule/{rule_id}', path,
+         {'params': {'include_images': True}}),
+        ('GET', '/agg/rule/{rule_id}/tapes', path, {}),
+        ('GET', '/agg/rule/{rule_id}/sponsor_image', path, {}),
+        ('GET', '/agg/console_achievement', {},
+         {'params': {'include_images': True}}),
+        ('GET', '/agg/console_achievement/{slug}', path, {}),
+        ('GET', '/agg/console_achievement/{slug}/players', path, {}),
+        ('GET', '/agg/console_achievement/{slug}/players/cursor', path, {}),
+        ('GET', '/agg/console_achievement/{slug}/image', path, {}),
+        ('GET', '/agg/notifications/{address}', path, {}),
+        ('GET', '/agg/notifications/{address}/cursor', path, {}),
+        ('GET', '/agg/notifications/{address}/unread_count', path, {}),
+        ('POST', '/agg/notifications/{address}/mark_read', path,
+         {'json': {'ids': 'all'}}),
+        ('GET', '/health', {}, {}),
+        ('GET', '/ready', {}, {}),
+        ('GET', '/metrics', {}, {}),
+    ]
+
+
+def test_every_route_within_budget(client, png):
+    called = set()
+
+    for method, template, params, kwargs in _requests(png):
+        ok(client.request(method, template.format(**params), **kwargs))
+        called.add((method, template))
+
+        # A second time, now from the response cache for the cached routes
+        if method == 'GET':
+            ok(client.request(method, template.format(**params), **kwargs))
+
+    notification = ok(
+        client.get(f'/agg/notifications/{ADDRESS}/cursor')
+    ).json()['items'][-1]
+    response = client.get(
+        f'/agg/notifications/{ADDRESS}/{notification["id"]}',
+        follow_redirects=False,
+    )
+    assert response.headers['location'] == 'https://rives.io'
+    called.add(('GET', '/agg/notifications/{address}/{notification_id}'))
+
+    routes = {
+        (method, route.path)
+        for route in app.routes
+        if route.path not in DOCS_ROUTES | {STREAM_ROUTE}
+        for method in route.methods - {'HEAD'}
+    }
+    assert routes - called == set()
+
+
+def test_missing_entities(client, png):
+    upload = {'files': {'uploaded': ('image.png', png)}}
+
+    for method, path, kwargs in [
+        ('GET', '/agg/profile/0xnobody', {}),
+        ('GET', '/agg/profile/0xnobody/rank', {}),
+        ('GET', '/agg/tape/nope', {}),
+        ('GET', '/agg/rule/nope', {}),
+        ('GET', '/agg/rule/nope/sponsor_image', {}),
+        ('GET', '/agg/console_achievement/nope', {}),
+        ('GET', '/agg/console_achievement/nope/image', {}),
+        ('PUT', '/agg_rw/rule/nope/sponsor_image', upload),
+        ('PUT', '/agg_rw/console_achievement/nope/image', upload),
+    ]:
+        response = client.request(method, path, **kwargs)
+        assert response.status_code == 404, (path, response.text)
+
+
+def test_every_route_has_a_budget():
+    budget_dependency = query_budget(0).dependency.__qualname__
+
+    unbudgeted = {
+        route.path
+        for route in app.routes
+        if isinstance(route, APIRoute)
+        and route.endpoint.__module__.startswith('app.routers.')
+        and not any(
+            dependency.call.__qualname__ == budget_dependency
+            for dependency in route.dependant.dependencies
+        )
+    }
+    assert unbudgeted == UNBUDGETED_ROUTES
+
+
+def test_batch_within_budget(client, monkeypatch):
+    monkeypatch.setattr(settings, 'batch_chunk_size', 4)
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+
+    def records(creator: str):
+        for i in range(5):
+            yield {'type': 'cartridge', 'data': {
+                'id': f'c{i}', 'name': 'Cartridge',
+                'creator_address': f'{creator}{i}', 'sell_value': i,
+            }}
+            yield {'type': 'rule', 'data': {'id': f'r{i}', 'name': 'Rule'}}
+            yield {'type': 'tape', 'data': {
+                'id': f't{i}', 'rule_id': 'r0', 'score': i,
+                'creator_address': f'{creator}{i}', 'sell_value': i,
+            }}
+            yield {'type': 'collected_tape', 'data': {
+                'tape_id': f't{i}', 'profile_address': f'0xh{i}',
+                'contract_address': '0x1', 'asset_id': '1', 'ballance': 2,
+            }}
+            yield {'type': 'collected_cartridge', 'data': {
+                'cartridge_id': f'c{i}', 'profile_address': f'0xh{i}',
+                'contract_address': '0x1', 'asset_id': '1', 'balance': 2,
+            }}
+            yield {'type': 'award', 'data': {
+                'profile_address': f'0xh{i}', 'ca_slug': 'ach', 'points': 1,
+            }}
+            yield {'type': 'notification', 'data': {
+                'profile_address': f'0xh{i}', 'message': 'Hello',
+                'created_at': '2024-01-01T00:00:00',
+            }}
+
+    # Then again, with every tape and cartridge moving to another creator
+    for creator in ('0xa', '0xb'):
+        response = ok(client.post('/agg_rw/batch', content='\n'.join(
+            json.dumps(record) for record in records(creator)
+        ))).json()
+        assert response['failed'] == 0, response
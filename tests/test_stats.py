@@ -0,0 +1,153 @@
+"""
+The incrementally maintained profile statistics
+"""
+import json
+
+from .conftest import ok
+
+
+def _award(client, address: str, points: int):
+    ok(client.post('/agg_rw/awarded_console_achievement', json={
+        'profile_address': address, 'ca_slug': 'ach', 'points': points,
+    }))
+
+
+def _stats(client, address: str) -> dict:
+    return ok(client.get(f'/agg/profile/{address}')).json()
+
+
+def test_created_counts_follow_the_creator(client):
+    ok(client.put('/agg_rw/cartridge', json={
+        'id': 'c1', 'name': 'Cartridge', 'creator_address': '0xa',
+    }))
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'cartridge_id': 'c1'}))
+    ok(client.put('/agg_rw/tape', json={
+        'id': 't1', 'rule_id': 'r1', 'creator_address': '0xa', 'score': 1,
+    }))
+    stats = _stats(client, '0xa')
+    assert stats['n_tapes_created'] == 1
+    assert stats['n_cartridges_created'] == 1
+
+    ok(client.put('/agg_rw/tape',
+                  json={'id': 't1', 'creator_address': '0xb'}))
+    ok(client.put('/agg_rw/cartridge', json={
+        'id': 'c1', 'name': 'Cartridge', 'creator_address': '0xb',
+    }))
+    old, new = _stats(client, '0xa'), _stats(client, '0xb')
+    assert (old['n_tapes_created'], old['n_cartridges_created']) == (0, 0)
+    assert (new['n_tapes_created'], new['n_cartridges_created']) == (1, 1)
+
+    ok(client.post('/agg_rw/batch', content=json.dumps({
+        'type': 'tape', 'data': {'id': 't1', 'creator_address': '0xc'},
+    })))
+    assert _stats(client, '0xb')['n_tapes_created'] == 0
+    assert _stats(client, '0xc')['n_tapes_created'] == 1
+
+
+def test_collected_counts_and_points(client):
+    ok(client.put('/agg_rw/tape', json={'id': 't1', 'score': 1}))
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+
+    for balance in (1, 3):
+        ok(client.put('/agg_rw/collected_tape', json={
+            'tape_id': 't1', 'profile_address': '0xa',
+            'contract_address': '0x1', 'asset_id': '1', 'ballance': balance,
+        }))
+    _award(client, '0xa', 5)
+    _award(client, '0xa', 7)
+
+    stats = _stats(client, '0xa')
+    assert stats['n_tapes_collected'] == 1
+    assert stats['n_console_achievements'] == 2
+    assert stats['rives_points'] == 12
+
+
+def test_ranks(client):
+    ok(client.put('/agg_rw/console_achievement',
+                  json={'slug': 'ach', 'name': 'Achievement'}))
+    for address, points in [('0xa', 20), ('0xb', 10), ('0xc', 10),
+                            ('0xd', 5), ('0xf', -3)]:
+        _award(client, address, points)
+    ok(client.put('/agg_rw/profile', json={'address': '0xe'}))
+    ok(client.put('/agg_rw/profile', json={'address': '0xg'}))
+
+    # Tied profiles share a rank, the next one skips the ties
+    expected = {'0xa': 1, '0xb': 2, '0xc': 2, '0xd': 4, '0xe': 5, '0xg': 5,
+                '0xf': 7}
+
+    board = ok(client.get('/agg/profile')).json()['items']
+    assert {x['address']: x['rank'] for x in board} == expected
+    board = ok(client.get('/agg/profile/cursor')).json()['items']
+    assert {x['address']: x['rank'] for x in board} == expected
+    for address, rank in expected.items():
+        assert _stats(client, address)['rank'] == rank
+
+    rank = ok(client.get('/agg/profile/0xd/rank', params={'k': 1})).json()
+    assert rank['rank'] == 4
+    assert [(x['address'], x['rank']) for x in rank['neighbours']] == [
+        ('0xb', 2), ('0xd', 4), ('0xg', 5),
+    ]
+
+    _award(client, '0xd', 30)
+    assert _stats(client, '0xd')['rank'] == 1
+    assert _stats(client, '0xa')['rank'] == 2
+
+
+def test_portfolio_value(client):
+    def collect(kind: str, asset_id: str, address: str, balance: int,
+                contract: str = '0x1'):
+        key, balance_field = {
+            'tape': ('tape_id', 'ballance'),
+            'cartridge': ('cartridge_id', 'balance'),
+        }[kind]
+        return {'type': f'collected_{kind}', 'data': {
+            key: asset_id, 'profile_address': address,
+            'contract_address': contract, 'asset_id': '1',
+            balance_field: balance,
+        }}
+
+    def value(address: str) -> int:
+        return _stats(client, address)['portfolio_value']
+
+    # Collected before the tape has a sell value
+    ok(client.put('/agg_rw/collected_tape',
+                  json=collect('tape', 't1', '0xa', 2)['data']))
+    assert value('0xa') == 0
+
+    ok(client.put('/agg_rw/tape', json={'id': 't1', 'sell_value': 10}))
+    assert value('0xa') == 20
+
+    ok(client.put('/agg_rw/collected_tape',
+                  json=collect('tape', 't1', '0xa', 5)['data']))
+    assert value('0xa') == 50
+
+    ok(client.put('/agg_rw/collected_tape',
+                  json=collect('tape', 't1', '0xa', 1, '0x2')['data']))
+    ok(client.put('/agg_rw/collected_tape',
+                  json=collect('tape', 't1', '0xb', 1)['data']))
+    ok(client.put('/agg_rw/tape', json={'id': 't1', 'sell_value': 3}))
+    assert (value('0xa'), value('0xb')) == (18, 3)
+
+    ok(client.put('/agg_rw/cartridge',
+                  json={'id': 'c1', 'name': 'Cartridge', 'sell_value': 100}))
+    ok(client.put('/agg_rw/collected_cartridge',
+                  json=collect('cartridge', 'c1', '0xb', 4)['data']))
+    assert value('0xb') == 403
+
+    ok(client.post('/agg_rw/batch', content='\n'.join(json.dumps(x) for x in [
+        collect('tape', 't1', '0xc', 7),
+        {'type': 'cartridge',
+         'data': {'id': 'c1', 'name': 'Cartridge', 'sell_value': 50}},
+        collect('cartridge', 'c1', '0xc', 1),
+        # Created, then updated in the same chunk
+        collect('tape', 't1', '0xd', 1),
+        collect('tape', 't1', '0xd', 4),
+    ])))
+    assert (value('0xb'), value('0xc'), value('0xd')) == (203, 71, 12)
+
+    board = ok(client.get('/agg/profile',
+                          params={'sort_by': 'portfolio_value'})).json()
+    assert [x['address'] for x in board['items']] == [
+        '0xb', '0xc', '0xa', '0xd',
+    ]
@@ -0,0 +1,39 @@
+"""
+Ranks of tapes on the leaderboard of their rule
+"""
+from .conftest import ok
+from .test_pagination import _walk
+
+
+def _tape(client, tape_id: str, score: int, **data):
+    ok(client.put('/agg_rw/tape', json={
+        'id': tape_id, 'rule_id': 'r1', 'score': score, **data,
+    }))
+
+
+def test_rule_tape_pages(client):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    for i, score in enumerate([5, 5, 3, 9]):
+        _tape(client, f't{i}', score)
+    _tape(client, 't4', 5, created_at='2024-01-01T00:00:00')
+
+    # Tapes without created_at are paged through too
+    tapes = _walk(client, '/agg/rule/r1/tapes')
+    assert [(x['tape_id'], x['rank']) for x in tapes] == [
+        ('t3', 1), ('t4', 2), ('t0', 2), ('t1', 2), ('t2', 3),
+    ]
+
+
+def test_reranked_tapes_are_not_served_from_cache(client):
+    ok(client.put('/agg_rw/rule', json={'id': 'r1', 'name': 'Rule'}))
+    _tape(client, 't1', 5)
+    _tape(client, 't2', 3)
+    assert ok(client.get('/agg/tape/t2')).json()['rank'] == 2
+
+    # Moves the tapes below it, t2 among them
+    _tape(client, 't3', 4)
+    assert ok(client.get('/agg/tape/t2')).json()['rank'] == 3
+
+    # And back up when the score is left
+    _tape(client, 't3', 5)
+    assert ok(client.get('/agg/tape/t2')).json()['rank'] == 2